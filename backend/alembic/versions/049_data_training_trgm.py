@@ -0,0 +1,35 @@
+"""049_data_training_trgm
+
+Revision ID: 8a3e61f4b2d7
+Revises: 5d2f8c1e7a90
+Create Date: 2025-10-22 15:40:12.518231
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '8a3e61f4b2d7'
+down_revision = '5d2f8c1e7a90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # pg_trgm is optional, without it (or without the privilege to create it) lexical retrieval of
+    # data training examples falls back to the in-process n-gram index
+    op.execute("""
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            CREATE INDEX IF NOT EXISTS ix_data_training_question_trgm
+                ON data_training USING gin (question gin_trgm_ops);
+        END IF;
+    EXCEPTION WHEN OTHERS THEN
+        RAISE NOTICE 'pg_trgm not available: %', SQLERRM;
+    END $$;
+    """)
+
+
+def downgrade():
+    op.execute("DROP INDEX IF EXISTS ix_data_training_question_trgm;")
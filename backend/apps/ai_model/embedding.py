@@ -1,12 +1,16 @@
 import os.path
 import threading
-from typing import Optional
+import time
+from typing import List, Optional
 
 from langchain_core.embeddings import Embeddings
 from langchain_huggingface import HuggingFaceEmbeddings
 from pydantic import BaseModel
 
+from apps.ai_model.embedding_cache import CachedEmbeddings, EmbeddingDiskCache
 from common.core.config import settings
+from common.utils.metrics import EMBEDDING_SECONDS
+from common.utils.utils import SQLBotLogUtil
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
@@ -27,6 +31,27 @@ locks = {}
 _embedding_model: dict[str, Optional[Embeddings]] = {}
 
 
+class ObservedEmbeddings(Embeddings):
+    """Records the time of every embedding call, disk cache hits included"""
+
+    def __init__(self, model: Embeddings):
+        self.model = model
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        start = time.perf_counter()
+        try:
+            return self.model.embed_documents(texts)
+        finally:
+            EMBEDDING_SECONDS.observe(time.perf_counter() - start, kind='documents')
+
+    def embed_query(self, text: str) -> List[float]:
+        start = time.perf_counter()
+        try:
+            return self.model.embed_query(text)
+        finally:
+            EMBEDDING_SECONDS.observe(time.perf_counter() - start, kind='query')
+
+
 class EmbeddingModelCache:
 
     @staticmethod
@@ -36,6 +61,16 @@ class EmbeddingModelCache:
                                      encode_kwargs={'normalize_embeddings': True}
                                      )
 
+    @staticmethod
+    def _with_disk_cache(key: str, model: Embeddings) -> Embeddings:
+        if not settings.EMBEDDING_CACHE_ENABLED:
+            return model
+        try:
+            return CachedEmbeddings(model, EmbeddingDiskCache(settings.EMBEDDING_CACHE_DIR, key))
+        except Exception as e:
+            SQLBotLogUtil.warning(f'embedding disk cache disabled: {e}')
+            return model
+
     @staticmethod
     def _get_lock(key: str = settings.DEFAULT_EMBEDDING_MODEL):
         lock = locks.get(key)
@@ -57,7 +92,12 @@ class EmbeddingModelCache:
             with lock:
                 model_instance = _embedding_model.get(key)
                 if model_instance is None:
-                    model_instance = EmbeddingModelCache._new_instance(config)
+                    model_instance = ObservedEmbeddings(EmbeddingModelCache._with_disk_cache(
+                        key, EmbeddingModelCache._new_instance(config)))
                     _embedding_model[key] = model_instance
 
         return model_instance
+
+    @staticmethod
+    def is_loaded(key: str = settings.DEFAULT_EMBEDDING_MODEL) -> bool:
+        return _embedding_model.get(key) is not None
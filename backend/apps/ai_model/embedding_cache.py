@@ -0,0 +1,202 @@
+import hashlib
+import mmap
+import os
+import re
+import struct
+import threading
+from array import array
+from typing import List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+from common.utils.utils import SQLBotLogUtil
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover, not available on windows
+    fcntl = None
+
+_MAGIC = b'SQLBOTEC'
+_HEADER = struct.Struct('<8sI4x')  # magic, dimension, padding
+_INDEX_ENTRY = struct.Struct('<32sQ')  # sha256 key, record number in the vector file
+
+
+class EmbeddingDiskCache:
+    """
+    Content addressed, append-only embedding cache shared by every worker on the host.
+
+    `<model>.vec` holds a header followed by fixed size float32 records and is read through a read-only mmap,
+    so all processes share the same page cache. `<model>.idx` maps sha256(model id + text) to a record number.
+    Writers append the vector first and the index entry second under an exclusive file lock, so an index entry
+    never points to a missing record; a crash in between only leaves an unreferenced record behind.
+    """
+
+    def __init__(self, folder: str, model_id: str):
+        os.makedirs(folder, exist_ok=True)
+        name = re.sub(r'[^0-9A-Za-z_.-]', '_', model_id)
+        self._model_id = model_id
+        self._vec_path = os.path.join(folder, f'{name}.vec')
+        self._idx_path = os.path.join(folder, f'{name}.idx')
+        self._lock = threading.RLock()
+        self._index: dict[bytes, int] = {}
+        self._idx_offset = 0
+        self._dim: Optional[int] = None
+        self._vec_fd: Optional[int] = None
+        self._mm: Optional[mmap.mmap] = None
+
+    def key(self, text: str) -> bytes:
+        return hashlib.sha256(f'{self._model_id}\0{text}'.encode('utf-8')).digest()
+
+    def get_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        keys = [self.key(text) for text in texts]
+        with self._lock:
+            if any(key not in self._index for key in keys):
+                # other workers may have appended since the last look
+                self._refresh()
+            return [self._read(self._index.get(key)) for key in keys]
+
+    def put_many(self, texts: List[str], vectors: List[List[float]]):
+        if not texts:
+            return
+        with self._lock, open(self._idx_path, 'ab') as idx_file:
+            if fcntl:
+                fcntl.flock(idx_file.fileno(), fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                items = {}
+                for text, vector in zip(texts, vectors, strict=True):
+                    key = self.key(text)
+                    if key not in self._index:
+                        items[key] = vector
+                if not items:
+                    return
+
+                dim = len(next(iter(items.values())))
+                if any(len(vector) != dim for vector in items.values()):
+                    raise ValueError('embedding vectors must have the same dimension')
+                data = array('f')
+                for vector in items.values():
+                    data.extend(vector)
+                with open(self._vec_path, 'ab') as vec_file:
+                    size = vec_file.tell()
+                    if size == 0:
+                        vec_file.write(_HEADER.pack(_MAGIC, dim))
+                        size = _HEADER.size
+                        self._dim = dim
+                    elif self._dim is None:
+                        self._dim = self._read_dim()
+                    if self._dim != dim:
+                        SQLBotLogUtil.warning(
+                            f'embedding cache {self._vec_path} has dimension {self._dim}, got {dim}, skip writing')
+                        return
+                    record_size = dim * 4
+                    first_record = (size - _HEADER.size) // record_size
+                    # drop a partial record left by an interrupted writer
+                    vec_file.truncate(_HEADER.size + first_record * record_size)
+                    vec_file.seek(0, os.SEEK_END)
+                    vec_file.write(data.tobytes())
+                    vec_file.flush()
+
+                entries = b''.join(_INDEX_ENTRY.pack(key, first_record + i) for i, key in enumerate(items))
+                idx_file.write(entries)
+                idx_file.flush()
+                for i, key in enumerate(items):
+                    self._index[key] = first_record + i
+                self._idx_offset += len(entries)
+            finally:
+                if fcntl:
+                    fcntl.flock(idx_file.fileno(), fcntl.LOCK_UN)
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._index)
+
+    def _refresh(self):
+        if not os.path.exists(self._idx_path):
+            return
+        with open(self._idx_path, 'rb') as idx_file:
+            idx_file.seek(self._idx_offset)
+            data = idx_file.read()
+        usable = len(data) - len(data) % _INDEX_ENTRY.size
+        for key, record in _INDEX_ENTRY.iter_unpack(data[:usable]):
+            self._index[key] = record
+        self._idx_offset += usable
+
+    def _read_dim(self) -> Optional[int]:
+        if not os.path.exists(self._vec_path):
+            return None
+        with open(self._vec_path, 'rb') as vec_file:
+            header = vec_file.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return None
+        magic, dim = _HEADER.unpack(header)
+        if magic != _MAGIC:
+            raise ValueError(f'{self._vec_path} is not an embedding cache file')
+        return dim
+
+    def _read(self, record: Optional[int]) -> Optional[List[float]]:
+        if record is None:
+            return None
+        if self._dim is None:
+            self._dim = self._read_dim()
+            if self._dim is None:
+                return None
+        record_size = self._dim * 4
+        offset = _HEADER.size + record * record_size
+        if self._mm is None or offset + record_size > len(self._mm):
+            self._remap()
+            if self._mm is None or offset + record_size > len(self._mm):
+                return None
+        with memoryview(self._mm) as view:
+            return view[offset:offset + record_size].cast('f').tolist()
+
+    def _remap(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._vec_fd is None:
+            self._vec_fd = os.open(self._vec_path, os.O_RDONLY)
+        if os.fstat(self._vec_fd).st_size > 0:
+            self._mm = mmap.mmap(self._vec_fd, 0, access=mmap.ACCESS_READ)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embedding model with an EmbeddingDiskCache, only texts missing from the cache reach the model.
+    Queries and documents share entries, which holds for the symmetric local models used here.
+    """
+
+    def __init__(self, model: Embeddings, cache: EmbeddingDiskCache):
+        self.model = model
+        self.cache = cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        results = self._get(texts)
+        missing = [i for i, vector in enumerate(results) if vector is None]
+        if missing:
+            vectors = self.model.embed_documents([texts[i] for i in missing])
+            for i, vector in zip(missing, vectors, strict=True):
+                results[i] = vector
+            self._put([texts[i] for i in missing], vectors)
+        return results
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = self._get([text])[0]
+        if vector is None:
+            vector = self.model.embed_query(text)
+            self._put([text], [vector])
+        return vector
+
+    def _get(self, texts: List[str]) -> List[Optional[List[float]]]:
+        try:
+            return self.cache.get_many(texts)
+        except Exception as e:
+            SQLBotLogUtil.warning(f'read embedding cache failed: {e}')
+            return [None] * len(texts)
+
+    def _put(self, texts: List[str], vectors: List[List[float]]):
+        try:
+            self.cache.put_many(texts, vectors)
+        except Exception as e:
+            SQLBotLogUtil.warning(f'write embedding cache failed: {e}')
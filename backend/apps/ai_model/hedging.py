@@ -0,0 +1,182 @@
+import asyncio
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from common.core.config import settings
+from common.utils.metrics import LLM_HEDGES
+from common.utils.utils import SQLBotLogUtil
+
+# produce(token_usage) -> processed stream ({"content", "reasoning_content"} chunks) of one LLM request
+Producer = Callable[[Dict[str, Any]], AsyncIterator[Dict[str, str]]]
+
+_STREAM_END = object()
+
+
+class LLMDeadlineExceeded(TimeoutError):
+    pass
+
+
+def parse_step_deadlines(value: str) -> Dict[str, Tuple[float, float]]:
+    """'GENERATE_SQL:20/180,GENERATE_CHART:10' -> {operation name: (ttft seconds, total seconds)}, 0 is no limit"""
+    deadlines = {}
+    for item in (value or '').split(','):
+        name, _, limits = item.strip().partition(':')
+        if not name or not limits.strip():
+            continue
+        ttft, _, total = limits.partition('/')
+        deadlines[name.strip().upper()] = (float(ttft or 0), float(total or 0))
+    return deadlines
+
+
+_step_deadlines = parse_step_deadlines(settings.LLM_STEP_DEADLINES)
+
+
+def step_deadlines(operation: Any) -> Tuple[float, float]:
+    name = str(getattr(operation, 'name', operation)).upper()
+    return _step_deadlines.get(name, (settings.LLM_TTFT_TIMEOUT, settings.LLM_TOTAL_TIMEOUT))
+
+
+async def _first_chunk(stream: AsyncIterator[Dict[str, str]]):
+    try:
+        return await stream.__anext__()
+    except StopAsyncIteration:
+        return _STREAM_END
+
+
+class _Attempt:
+    """One request of a hedged call, its first chunk is awaited in a task so several requests can race"""
+
+    def __init__(self, label: str, produce: Producer):
+        self.label = label
+        self.token_usage: Dict[str, Any] = {}
+        self.stream = produce(self.token_usage)
+        self.first = asyncio.create_task(_first_chunk(self.stream))
+        self.failed = False
+
+    async def close(self):
+        # cancelling the pending read closes the upstream response, the connection goes back to the pool
+        if not self.first.done():
+            self.first.cancel()
+            try:
+                await self.first
+            except BaseException:
+                pass
+        try:
+            await self.stream.aclose()
+        except Exception:
+            pass
+
+
+async def guarded_stream(operation: Any, produce: Producer, token_usage: Dict[str, Any],
+                         fallback: Optional[Producer] = None) -> AsyncIterator[Dict[str, str]]:
+    """
+    Runs produce() under the time-to-first-token and total deadlines of the operation.
+
+    With LLM_HEDGE_DELAY a second request (to the fallback model, or the same model without one) is fired when the
+    first chunk is late, the request streaming first wins and the other one is cancelled. The second request is
+    also used when the first fails or misses its first-token deadline before anything was streamed. Once content
+    has been streamed the call is never switched, deadlines past that point fail the step.
+    """
+    name = str(getattr(operation, 'name', operation))
+    ttft, total = step_deadlines(operation)
+    hedge_delay = settings.LLM_HEDGE_DELAY
+    secondary = fallback or (produce if hedge_delay > 0 else None)
+    if not ttft and not total and secondary is None:
+        async for chunk in produce(token_usage):
+            yield chunk
+        return
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    ttft_at = started + ttft if ttft else None
+    total_at = started + total if total else None
+    attempts: List[_Attempt] = [_Attempt('primary', produce)]
+    hedge_reason = None
+    hedged_at = 0.0
+    winner: Optional[_Attempt] = None
+    first = None
+    error: Optional[BaseException] = None
+
+    def fire_secondary(reason: str):
+        nonlocal hedge_reason, hedged_at, ttft_at
+        hedge_reason = reason
+        hedged_at = loop.time() - started
+        attempts.append(_Attempt('fallback' if fallback else 'hedge', secondary))
+        if ttft and reason != 'hedge':
+            # a replacement request gets a first-token window of its own
+            ttft_at = loop.time() + ttft
+        SQLBotLogUtil.info(f'LLM hedge fired for {name}: {reason} after {hedged_at:.2f}s')
+
+    try:
+        while winner is None:
+            running = [attempt for attempt in attempts if not attempt.failed]
+            if not running:
+                if secondary is not None and hedge_reason is None:
+                    fire_secondary('error')
+                    continue
+                raise error
+
+            now = loop.time()
+            waits = []
+            if secondary is not None and hedge_reason is None and hedge_delay > 0:
+                waits.append(started + hedge_delay - now)
+            if ttft_at is not None:
+                waits.append(ttft_at - now)
+            if total_at is not None:
+                waits.append(total_at - now)
+            timeout = max(min(waits), 0) if waits else None
+            done, _ = await asyncio.wait([attempt.first for attempt in running], timeout=timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+
+            for attempt in running:
+                if attempt.first not in done:
+                    continue
+                try:
+                    first = attempt.first.result()
+                except Exception as e:
+                    attempt.failed = True
+                    error = e
+                    SQLBotLogUtil.warning(f'LLM {attempt.label} request of {name} failed: {e}')
+                    continue
+                winner = attempt
+                break
+            if winner is not None or done:
+                continue
+
+            now = loop.time()
+            if total_at is not None and now >= total_at:
+                raise LLMDeadlineExceeded(f'{name}: no complete response within {total}s')
+            if ttft_at is not None and now >= ttft_at:
+                if secondary is not None and hedge_reason is None:
+                    fire_secondary('ttft')
+                    continue
+                raise LLMDeadlineExceeded(f'{name}: no response within {ttft}s')
+            if secondary is not None and hedge_reason is None and now >= started + hedge_delay:
+                fire_secondary('hedge')
+
+        if hedge_reason is not None:
+            LLM_HEDGES.inc(operation=name, reason=hedge_reason, winner=winner.label)
+            SQLBotLogUtil.info(f'LLM hedge of {name} ({hedge_reason} after {hedged_at:.2f}s) won by {winner.label}, '
+                               f'first token after {loop.time() - started:.2f}s')
+        for attempt in attempts:
+            if attempt is not winner:
+                await attempt.close()
+
+        if first is _STREAM_END:
+            return
+        yield first
+        while True:
+            if total_at is None:
+                chunk = await _first_chunk(winner.stream)
+            else:
+                try:
+                    chunk = await asyncio.wait_for(_first_chunk(winner.stream), max(total_at - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    raise LLMDeadlineExceeded(f'{name}: no complete response within {total}s') from None
+            if chunk is _STREAM_END:
+                break
+            yield chunk
+    finally:
+        if winner is not None:
+            token_usage.update(winner.token_usage)
+        for attempt in attempts:
+            await attempt.close()
@@ -0,0 +1,62 @@
+import threading
+from typing import Dict, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+from common.core.config import settings
+from common.utils.utils import SQLBotLogUtil
+
+try:
+    import h2  # noqa: F401, http/2 support of httpx is optional
+
+    _http2_available = True
+except ImportError:
+    _http2_available = False
+
+_lock = threading.Lock()
+# upstream (scheme, host, port) -> (sync client, async client)
+_clients: Dict[Tuple[str, str, int], Tuple[httpx.Client, httpx.AsyncClient]] = {}
+
+
+def _upstream(base_url: str) -> Tuple[str, str, int]:
+    parts = urlsplit(base_url or '')
+    scheme = parts.scheme or 'https'
+    return scheme, parts.hostname or '', parts.port or (443 if scheme == 'https' else 80)
+
+
+def _new_clients() -> Tuple[httpx.Client, httpx.AsyncClient]:
+    limits = httpx.Limits(max_connections=settings.LLM_HTTP_MAX_CONNECTIONS,
+                          max_keepalive_connections=settings.LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                          keepalive_expiry=settings.LLM_HTTP_KEEPALIVE_EXPIRY)
+    # the openai sdk passes its own read timeout with every request
+    timeout = httpx.Timeout(settings.LLM_HTTP_TIMEOUT, connect=settings.LLM_HTTP_CONNECT_TIMEOUT)
+    http2 = settings.LLM_HTTP2_ENABLED and _http2_available
+    return (httpx.Client(limits=limits, timeout=timeout, http2=http2),
+            httpx.AsyncClient(limits=limits, timeout=timeout, http2=http2))
+
+
+def get_http_clients(base_url: str) -> Tuple[httpx.Client, httpx.AsyncClient]:
+    """
+    Process-wide keep-alive clients for one LLM upstream, shared by every model instance calling it.
+    Each upstream has its own connection pool and limits, TLS connections are reused across requests.
+    """
+    key = _upstream(base_url)
+    clients = _clients.get(key)
+    if clients is None:
+        with _lock:
+            clients = _clients.get(key)
+            if clients is None:
+                clients = _new_clients()
+                _clients[key] = clients
+                SQLBotLogUtil.info(f'LLM http pool created for {key[0]}://{key[1]}:{key[2]}')
+    return clients
+
+
+async def close_http_clients():
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for sync_client, async_client in clients:
+        sync_client.close()
+        await async_client.aclose()
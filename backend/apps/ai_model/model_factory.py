@@ -1,17 +1,24 @@
-from functools import lru_cache
+import asyncio
+import copy
+import hashlib
 import json
+import threading
+from collections import OrderedDict
 from abc import ABC, abstractmethod
-from typing import Optional, Dict, Any, Type
+from typing import Optional, Dict, Any, Tuple, Type
 
 from langchain.chat_models.base import BaseChatModel
 from pydantic import BaseModel
 from sqlmodel import Session, select
 
+from apps.ai_model.http_client import get_http_clients
 from apps.ai_model.openai.llm import BaseChatOpenAI
 from apps.system.models.system_model import AiModelDetail
+from common.core.config import settings
 from common.core.db import engine
+from common.core.sqlbot_cache import bump_cache_version, get_cache_version, peek_cache_version
 from common.utils.crypto import sqlbot_decrypt
-from common.utils.utils import prepare_model_arg
+from common.utils.utils import SQLBotLogUtil, prepare_model_arg
 from langchain_community.llms import VLLMOpenAI
 from langchain_openai import AzureChatOpenAI
 # from langchain_community.llms import Tongyi, VLLM
@@ -43,12 +50,22 @@ class LLMConfig(BaseModel):
             hashable_params
         ))
 
+    def fingerprint(self) -> str:
+        """Stable digest of every field, nested additional params included"""
+        raw = json.dumps(self.model_dump(), ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def frozen_copy(self) -> 'LLMConfig':
+        """Copy that owns its additional params, changes of the caller's dict do not reach it"""
+        return self.model_copy(update={'additional_params': copy.deepcopy(self.additional_params)})
+
 
 class BaseLLM(ABC):
     """Abstract base class for large language models"""
 
     def __init__(self, config: LLMConfig):
         self.config = config
+        self.http_client, self.http_async_client = get_http_clients(config.api_base_url)
         self._llm = self._init_llm()
 
     @abstractmethod
@@ -68,17 +85,17 @@ class OpenAIvLLM(BaseLLM):
             openai_api_base=self.config.api_base_url,
             model_name=self.config.model_name,
             streaming=True,
+            http_client=self.http_client,
+            http_async_client=self.http_async_client,
             **self.config.additional_params,
         )
 
 class OpenAIAzureLLM(BaseLLM):
     def _init_llm(self) -> AzureChatOpenAI:
-        api_version = self.config.additional_params.get("api_version")
-        deployment_name = self.config.additional_params.get("deployment_name")
-        if api_version:
-            self.config.additional_params.pop("api_version")
-        if deployment_name:
-            self.config.additional_params.pop("deployment_name")
+        # the config is shared by cached instances, take the azure only params from a copy
+        additional_params = dict(self.config.additional_params)
+        api_version = additional_params.pop("api_version", None)
+        deployment_name = additional_params.pop("deployment_name", None)
         return AzureChatOpenAI(
             azure_endpoint=self.config.api_base_url,
             api_key=self.config.api_key or 'Empty',
@@ -86,7 +103,9 @@ class OpenAIAzureLLM(BaseLLM):
             api_version=api_version,
             deployment_name=deployment_name,
             streaming=True,
-            **self.config.additional_params,
+            http_client=self.http_client,
+            http_async_client=self.http_async_client,
+            **additional_params,
         )
 class OpenAILLM(BaseLLM):
     def _init_llm(self) -> BaseChatModel:
@@ -95,6 +114,8 @@ class OpenAILLM(BaseLLM):
             api_key=self.config.api_key or 'Empty',
             base_url=self.config.api_base_url,
             stream_usage=True,
+            http_client=self.http_client,
+            http_async_client=self.http_async_client,
             **self.config.additional_params,
         )
 
@@ -112,13 +133,28 @@ class LLMFactory:
         "azure": OpenAIAzureLLM,
     }
 
+    _instances: 'OrderedDict[str, BaseLLM]' = OrderedDict()
+    _lock = threading.Lock()
+
     @classmethod
-    @lru_cache(maxsize=32)
     def create_llm(cls, config: LLMConfig) -> BaseLLM:
+        """Model instances are cached by the config fingerprint, equal configs from separate requests share one"""
         llm_class = cls._llm_types.get(config.model_type)
         if not llm_class:
             raise ValueError(f"Unsupported LLM type: {config.model_type}")
-        return llm_class(config)
+        key = config.fingerprint()
+        with cls._lock:
+            instance = cls._instances.get(key)
+            if instance is not None:
+                cls._instances.move_to_end(key)
+                return instance
+        instance = llm_class(config.frozen_copy())
+        with cls._lock:
+            instance = cls._instances.setdefault(key, instance)
+            cls._instances.move_to_end(key)
+            while len(cls._instances) > settings.LLM_INSTANCE_CACHE_SIZE:
+                cls._instances.popitem(last=False)
+        return instance
 
     @classmethod
     def register_llm(cls, model_type: str, llm_class: Type[BaseLLM]):
@@ -138,33 +174,101 @@ class LLMFactory:
     return config """
 
 
-async def get_default_config() -> LLMConfig:
+DEFAULT_CONFIG_CACHE = 'default_llm_config'
+# model id (None for the default model) -> (version, config); decrypted configs only live in process memory, only
+# the version is shared (redis or the sqlbot_cache_version table) so every process drops its copies after a change
+_configs: Dict[Optional[int], Tuple[Tuple[int, int], LLMConfig]] = {}
+
+
+def invalidate_default_config():
+    """Call after ai models are added, changed, deleted or the default model is switched"""
+    _configs.clear()
+    bump_cache_version(DEFAULT_CONFIG_CACHE)
+
+
+def _load_model(model_id: Optional[int] = None) -> Optional[AiModelDetail]:
     with Session(engine) as session:
-        db_model = session.exec(
-            select(AiModelDetail).where(AiModelDetail.default_model == True)
-        ).first()
-        if not db_model:
-            raise Exception("The system default model has not been set")
-
-        additional_params = {}
-        if db_model.config:
-            try:
-                config_raw = json.loads(db_model.config)
-                additional_params = {item["key"]: prepare_model_arg(item.get('val')) for item in config_raw if "key" in item and "val" in item}
-            except Exception:
-                pass
-        if not db_model.api_domain.startswith("http"):
-            db_model.api_domain = await sqlbot_decrypt(db_model.api_domain)
-            if db_model.api_key:
-                db_model.api_key = await sqlbot_decrypt(db_model.api_key)
-            
-
-        # 构造 LLMConfig
-        return LLMConfig(
-            model_id=db_model.id,
-            model_type="openai" if db_model.protocol == 1 else "vllm",
-            model_name=db_model.base_model,
-            api_key=db_model.api_key,
-            api_base_url=db_model.api_domain,
-            additional_params=additional_params,
-        )
+        if model_id is None:
+            db_model = session.exec(
+                select(AiModelDetail).where(AiModelDetail.default_model == True)
+            ).first()
+        else:
+            db_model = session.get(AiModelDetail, model_id)
+        return AiModelDetail(**db_model.model_dump()) if db_model else None
+
+
+async def _get_config(model_id: Optional[int] = None) -> Optional[LLMConfig]:
+    # the stamp is shared with the other processes (redis or the database), so model edits, deleted models and
+    # rotated keys reach e.g. the mcp server too; it is only fetched off the event loop when it has to be read
+    version = peek_cache_version(DEFAULT_CONFIG_CACHE)
+    if version is None:
+        version = await asyncio.to_thread(get_cache_version, DEFAULT_CONFIG_CACHE)
+    cached = _configs.get(model_id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    db_model = await asyncio.to_thread(_load_model, model_id)
+    if not db_model:
+        return None
+    config = await _build_config(db_model)
+    _configs[model_id] = (version, config)
+    return config
+
+
+async def get_default_config() -> LLMConfig:
+    config = await _get_config()
+    if config is None:
+        raise Exception("The system default model has not been set")
+    return config
+
+
+async def get_operation_configs() -> Dict[str, LLMConfig]:
+    """Models routed per operation by LLM_OPERATION_MODELS, operation name -> config; unknown models are skipped"""
+    configs = {}
+    for item in (settings.LLM_OPERATION_MODELS or '').split(','):
+        name, _, model_id = item.strip().partition(':')
+        if not name or not model_id.strip():
+            continue
+        try:
+            config = await _get_config(int(model_id))
+        except ValueError:
+            config = None
+        if config is None:
+            SQLBotLogUtil.warning(f'model {model_id.strip()} of operation {name} not found, the default model is used')
+            continue
+        configs[name.strip().upper()] = config
+    return configs
+
+
+async def get_fallback_config() -> Optional[LLMConfig]:
+    if not settings.LLM_FALLBACK_MODEL_ID:
+        return None
+    config = await _get_config(settings.LLM_FALLBACK_MODEL_ID)
+    if config is None:
+        SQLBotLogUtil.warning(f'fallback model {settings.LLM_FALLBACK_MODEL_ID} not found, requests are hedged on the '
+                              f'model of each step')
+    return config
+
+
+async def _build_config(db_model: AiModelDetail) -> LLMConfig:
+    additional_params = {}
+    if db_model.config:
+        try:
+            config_raw = json.loads(db_model.config)
+            additional_params = {item["key"]: prepare_model_arg(item.get('val')) for item in config_raw if "key" in item and "val" in item}
+        except Exception:
+            pass
+    if not db_model.api_domain.startswith("http"):
+        db_model.api_domain = await sqlbot_decrypt(db_model.api_domain)
+        if db_model.api_key:
+            db_model.api_key = await sqlbot_decrypt(db_model.api_key)
+
+    # 构造 LLMConfig
+    return LLMConfig(
+        model_id=db_model.id,
+        model_type="openai" if db_model.protocol == 1 else "vllm",
+        model_name=db_model.base_model,
+        api_key=db_model.api_key,
+        api_base_url=db_model.api_domain,
+        additional_params=additional_params,
+    )
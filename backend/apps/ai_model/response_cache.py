@@ -0,0 +1,140 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from common.core.config import settings
+from common.core.sqlbot_cache import get_sync_redis
+from common.utils.utils import SQLBotLogUtil
+
+# responses kept by the in-memory backend
+MAX_CACHED_RESPONSES = 1024
+
+
+def parse_cache_operations(value: str, default_ttl: int) -> Dict[str, int]:
+    """'GENERATE_RECOMMENDED_QUESTIONS:600,CHOOSE_DATASOURCE' -> {operation name: ttl in seconds}"""
+    operations = {}
+    for item in (value or '').split(','):
+        name, _, ttl = item.strip().partition(':')
+        if not name:
+            continue
+        operations[name.strip().upper()] = int(ttl) if ttl.strip() else default_ttl
+    return operations
+
+
+class LLMResponseCache:
+    """
+    Exact-match cache of complete LLM responses.
+
+    The key is a digest of the model config and the full message list, so only byte-identical requests hit.
+    It is opt-in per operation (LLM_RESPONSE_CACHE_OPERATIONS), a hit is replayed as a short synthetic stream and
+    reports the token usage of the original call. Entries live in redis with CACHE_TYPE=redis, in process memory
+    with CACHE_TYPE=memory, and nothing is cached without a cache.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[str, Tuple[float, dict]]' = OrderedDict()
+        self._operations = parse_cache_operations(settings.LLM_RESPONSE_CACHE_OPERATIONS,
+                                                  settings.LLM_RESPONSE_CACHE_TTL)
+
+    @staticmethod
+    def _backend() -> Optional[str]:
+        cache_type = (settings.CACHE_TYPE or '').lower()
+        return cache_type if cache_type in ('memory', 'redis') else None
+
+    def ttl_of(self, operation: Any) -> int:
+        name = getattr(operation, 'name', operation)
+        return self._operations.get(str(name).upper(), 0)
+
+    @staticmethod
+    def make_key(config: Any, messages: List[Any]) -> str:
+        # the api key is left out on purpose, model id and base url already identify the endpoint
+        model = {'model_id': config.model_id, 'model_type': config.model_type, 'model_name': config.model_name,
+                 'api_base_url': config.api_base_url, 'additional_params': config.additional_params}
+        msgs = []
+        for msg in messages:
+            if isinstance(msg, dict):
+                msgs.append([msg.get('type') or msg.get('role'), msg.get('content')])
+            else:
+                msgs.append([msg.type, msg.content])
+        raw = json.dumps([model, msgs], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _get(self, key: str) -> Optional[dict]:
+        if self._backend() == 'redis':
+            value = get_sync_redis().get(f'sqlbot-llm-response:{key}')
+            return json.loads(value) if value else None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def _set(self, key: str, value: dict, ttl: int):
+        if self._backend() == 'redis':
+            get_sync_redis().setex(f'sqlbot-llm-response:{key}', ttl, json.dumps(value, ensure_ascii=False))
+            return
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > MAX_CACHED_RESPONSES:
+                self._entries.popitem(last=False)
+
+    async def _call(self, fn, *args):
+        # redis calls are blocking, keep them off the event loop
+        if self._backend() == 'redis':
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    async def stream(self, operation: Any, config: Any, messages: List[Any],
+                     produce: Callable[[], AsyncIterator[Dict[str, str]]],
+                     token_usage: Dict[str, Any]) -> AsyncIterator[Dict[str, str]]:
+        """
+        Wraps produce(), the processed stream ({"content", "reasoning_content"} chunks) of the real LLM call.
+        token_usage is filled by produce() on a miss and with the recorded usage on a hit.
+        """
+        ttl = self.ttl_of(operation)
+        if not ttl or self._backend() is None:
+            async for chunk in produce():
+                yield chunk
+            return
+
+        key = self.make_key(config, messages)
+        cached = None
+        try:
+            cached = await self._call(self._get, key)
+        except Exception as e:
+            SQLBotLogUtil.warning(f'llm response cache get failed: {e}')
+        if cached is not None:
+            SQLBotLogUtil.info(f'LLM响应缓存命中: {getattr(operation, "name", operation)}')
+            token_usage.update(cached.get('token_usage') or {})
+            if cached.get('reasoning_content'):
+                yield {'content': '', 'reasoning_content': cached.get('reasoning_content')}
+            yield {'content': cached.get('content') or '', 'reasoning_content': ''}
+            return
+
+        content = ''
+        reasoning_content = ''
+        async for chunk in produce():
+            content += chunk.get('content') or ''
+            reasoning_content += chunk.get('reasoning_content') or ''
+            yield chunk
+
+        # only complete, non-empty responses are cached
+        if content:
+            try:
+                await self._call(self._set, key, {'content': content, 'reasoning_content': reasoning_content,
+                                                  'token_usage': dict(token_usage)}, ttl)
+            except Exception as e:
+                SQLBotLogUtil.warning(f'llm response cache set failed: {e}')
+
+
+llm_response_cache = LLMResponseCache()
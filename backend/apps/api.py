@@ -5,7 +5,7 @@ from apps.dashboard.api import dashboard_api
 from apps.data_training.api import data_training
 from apps.datasource.api import datasource, table_relation
 from apps.mcp import mcp
-from apps.system.api import login, user, aimodel, workspace, assistant
+from apps.system.api import login, user, aimodel, workspace, assistant, embedding
 from apps.terminology.api import terminology
 
 api_router = APIRouter()
@@ -14,6 +14,7 @@ api_router.include_router(user.router)
 api_router.include_router(workspace.router)
 api_router.include_router(assistant.router)
 api_router.include_router(aimodel.router)
+api_router.include_router(embedding.router)
 api_router.include_router(terminology.router)
 api_router.include_router(data_training.router)
 api_router.include_router(datasource.router)
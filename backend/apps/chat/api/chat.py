@@ -1,6 +1,7 @@
 import asyncio
 import io
 import traceback
+from typing import Optional
 
 import orjson
 import pandas as pd
@@ -11,6 +12,7 @@ from sqlalchemy import and_, select
 from apps.chat.curd.chat import list_chats, get_chat_with_records, create_chat, rename_chat, \
     delete_chat, get_chat_chart_data, get_chat_predict_data, get_chat_with_records_with_data, get_chat_record_by_id, \
     format_json_data, format_json_list_data
+from apps.chat.curd.sql_cache import purge_sql_cache
 from apps.chat.models.chat_model import CreateChat, ChatRecord, RenameChat, ChatQuestion, ExcelData
 from apps.chat.task.llm import LLMService
 from common.core.deps import CurrentAssistant, SessionDep, CurrentUser, Trans
@@ -82,6 +84,14 @@ async def delete(session: SessionDep, chart_id: int):
         )
 
 
+@router.post("/sql_cache/purge")
+async def purge_sql_cache_api(session: SessionDep, current_user: CurrentUser, trans: Trans,
+                              ds_id: Optional[int] = None, oid: Optional[int] = None):
+    if not current_user.isAdmin:
+        raise Exception(trans('i18n_permission.no_permission', url=", ", msg=trans('i18n_permission.only_admin')))
+    return purge_sql_cache(session=session, oid=oid, datasource=ds_id)
+
+
 @router.post("/start")
 async def start_chat(session: SessionDep, current_user: CurrentUser, create_chat_obj: CreateChat):
     try:
@@ -1,5 +1,5 @@
 import datetime
-from typing import List
+from typing import List, Optional
 
 import orjson
 import sqlparse
@@ -453,9 +453,9 @@ def save_analysis_predict_record(session: SessionDep, base_record: ChatRecord, a
 
 
 def start_log(session: SessionDep, ai_modal_id: int, ai_modal_name: str, operate: OperationEnum, record_id: int,
-              full_message: list[dict]) -> ChatLog:
+              full_message: list[dict], prompt_tokens: Optional[dict] = None) -> ChatLog:
     log = ChatLog(type=TypeEnum.CHAT, operate=operate, pid=record_id, ai_modal_id=ai_modal_id, base_modal=ai_modal_name,
-                  messages=full_message, start_time=datetime.datetime.now())
+                  messages=full_message, start_time=datetime.datetime.now(), prompt_tokens=prompt_tokens)
 
     result = ChatLog(**log.model_dump())
 
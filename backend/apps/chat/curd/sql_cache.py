@@ -0,0 +1,126 @@
+import datetime
+import hashlib
+import re
+import traceback
+from typing import List, Optional, Tuple
+
+from sqlalchemy import and_, delete, text, update
+from sqlalchemy.dialects.postgresql import insert
+
+from apps.ai_model.embedding import EmbeddingModelCache
+from apps.chat.models.chat_model import ChatSqlCache
+from common.core.config import settings
+from common.core.deps import SessionDep
+from common.utils.utils import SQLBotLogUtil
+
+similar_sql = """
+SELECT id, question, sql_answer, chart_type, ( 1 - (embedding <=> :embedding_array) ) AS similarity
+FROM chat_sql_cache
+WHERE datasource = :datasource AND schema_key = :schema_key AND create_time > :expire_before
+AND embedding IS NOT NULL
+ORDER BY embedding <=> :embedding_array
+LIMIT 1
+"""
+
+# the SQL prompt carries the current time, so "this month" or "last 7 days" is answered with literal dates or years
+# that are wrong on another day, such answers are not cached
+_time_literal_pattern = re.compile(r"(?<!\d)(?:(?:19|20)\d{2}(?:\d{4})?|1\d{9}|1\d{12})(?!\d)")
+
+
+def is_time_dependent(sql_answer: str) -> bool:
+    return bool(_time_literal_pattern.search(sql_answer or ''))
+
+
+def normalize_question(question: str) -> str:
+    question = ' '.join((question or '').lower().split())
+    return question.rstrip('?？。.!！ ')
+
+
+def _question_hash(question: str) -> str:
+    return hashlib.sha256(question.encode('utf-8')).hexdigest()
+
+
+def _expire_before() -> datetime.datetime:
+    return datetime.datetime.now() - datetime.timedelta(seconds=settings.SQL_CACHE_TTL)
+
+
+def find_cached_sql(session: SessionDep, datasource: int, schema_key: str, question: str) \
+        -> Tuple[Optional[ChatSqlCache], Optional[List[float]]]:
+    """
+    Look up the validated SQL answer of an equal or semantically equal question.
+    Returns the hit (or None) and the question embedding, which is reused when the new answer is saved.
+    """
+    normalized = normalize_question(question)
+    if not normalized or not schema_key:
+        return None, None
+
+    expire_before = _expire_before()
+    hit = session.query(ChatSqlCache).filter(
+        and_(ChatSqlCache.datasource == datasource, ChatSqlCache.schema_key == schema_key,
+             ChatSqlCache.question_hash == _question_hash(normalized),
+             ChatSqlCache.create_time > expire_before)).first()
+
+    embedding = None
+    if hit is None and settings.EMBEDDING_ENABLED:
+        try:
+            embedding = EmbeddingModelCache.get_model().embed_query(normalized)
+            row = session.execute(text(similar_sql),
+                                  {'embedding_array': str(embedding), 'datasource': datasource,
+                                   'schema_key': schema_key, 'expire_before': expire_before}).first()
+            if row is not None and row.similarity >= settings.SQL_CACHE_SIMILARITY:
+                hit = session.get(ChatSqlCache, row.id)
+                SQLBotLogUtil.info(f'sql cache hit with similarity {row.similarity:.4f}: {row.question}')
+        except Exception:
+            traceback.print_exc()
+            session.rollback()
+
+    if hit is not None and is_time_dependent(hit.sql_answer):
+        # saved before time dependent answers were skipped
+        hit = None
+    if hit is not None:
+        hit = ChatSqlCache(**hit.model_dump())
+        session.execute(update(ChatSqlCache).where(ChatSqlCache.id == hit.id).values(
+            hit_count=ChatSqlCache.hit_count + 1, last_hit_time=datetime.datetime.now()))
+        session.commit()
+    return hit, embedding
+
+
+def save_cached_sql(session: SessionDep, oid: int, datasource: int, schema_key: str, question: str, sql_answer: str,
+                    chart_type: Optional[str] = None, embedding: Optional[List[float]] = None):
+    normalized = normalize_question(question)
+    if not normalized or not schema_key or not sql_answer:
+        return
+    if is_time_dependent(sql_answer):
+        SQLBotLogUtil.info(f'sql answer depends on the current time, not cached: {question}')
+        return
+    if embedding is None and settings.EMBEDDING_ENABLED:
+        try:
+            embedding = EmbeddingModelCache.get_model().embed_query(normalized)
+        except Exception:
+            traceback.print_exc()
+
+    now = datetime.datetime.now()
+    stmt = insert(ChatSqlCache).values(oid=oid, datasource=datasource, schema_key=schema_key, question=question,
+                                       question_hash=_question_hash(normalized), embedding=embedding,
+                                       sql_answer=sql_answer, chart_type=chart_type, hit_count=0, create_time=now)
+    # a newer validated answer of the same question replaces the old one and restarts its ttl
+    session.execute(stmt.on_conflict_do_update(
+        constraint='uq_chat_sql_cache_question',
+        set_={'question': stmt.excluded.question, 'embedding': stmt.excluded.embedding,
+              'sql_answer': stmt.excluded.sql_answer, 'chart_type': stmt.excluded.chart_type,
+              'hit_count': 0, 'create_time': now, 'last_hit_time': None}))
+    # drop expired answers of this datasource on the way
+    session.execute(delete(ChatSqlCache).where(
+        and_(ChatSqlCache.datasource == datasource, ChatSqlCache.create_time <= _expire_before())))
+    session.commit()
+
+
+def purge_sql_cache(session: SessionDep, oid: Optional[int] = None, datasource: Optional[int] = None) -> int:
+    stmt = delete(ChatSqlCache)
+    if oid is not None:
+        stmt = stmt.where(ChatSqlCache.oid == oid)
+    if datasource is not None:
+        stmt = stmt.where(ChatSqlCache.datasource == datasource)
+    result = session.execute(stmt)
+    session.commit()
+    return result.rowcount
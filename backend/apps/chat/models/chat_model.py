@@ -3,8 +3,9 @@ from enum import Enum
 from typing import List, Optional, Union, Any
 
 from fastapi import Body
+from pgvector.sqlalchemy import VECTOR
 from pydantic import BaseModel
-from sqlalchemy import Column, Integer, Text, BigInteger, DateTime, Identity, Boolean
+from sqlalchemy import Column, Integer, Text, BigInteger, DateTime, Identity, Boolean, String, UniqueConstraint
 from sqlalchemy import Enum as SQLAlchemyEnum
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlmodel import SQLModel, Field
@@ -17,8 +18,9 @@ from apps.template.generate_chart.generator import get_chart_template
 from apps.template.generate_dynamic.generator import get_dynamic_template
 from apps.template.generate_guess_question.generator import get_guess_question_template
 from apps.template.generate_predict.generator import get_predict_template
-from apps.template.generate_sql.generator import get_sql_template, get_sql_example_template
+from apps.template.generate_sql.generator import get_sql_template, get_sql_system_template
 from apps.template.select_datasource.generator import get_datasource_template
+from apps.template.template import compile_template
 
 
 def enum_values(enum_class: type[Enum]) -> list:
@@ -67,6 +69,8 @@ class ChatLog(SQLModel, table=True):
     start_time: datetime = Field(sa_column=Column(DateTime(timezone=False), nullable=True))
     finish_time: datetime = Field(sa_column=Column(DateTime(timezone=False), nullable=True))
     token_usage: Optional[dict | None | int] = Field(sa_column=Column(JSONB))
+    # estimated tokens of each prompt section, e.g. {"schema": 5210, "history": 830, "total": 7421}
+    prompt_tokens: Optional[dict] = Field(sa_column=Column(JSONB, nullable=True))
 
 
 class Chat(SQLModel, table=True):
@@ -113,6 +117,26 @@ class ChatRecord(SQLModel, table=True):
     predict_record_id: int = Field(sa_column=Column(BigInteger, nullable=True))
 
 
+class ChatSqlCache(SQLModel, table=True):
+    """Validated SQL answers of earlier questions, reused for semantically equal questions"""
+    __tablename__ = "chat_sql_cache"
+    __table_args__ = (UniqueConstraint('datasource', 'schema_key', 'question_hash',
+                                       name='uq_chat_sql_cache_question'),)
+    id: Optional[int] = Field(sa_column=Column(BigInteger, Identity(always=True), primary_key=True))
+    oid: Optional[int] = Field(sa_column=Column(BigInteger, nullable=True, default=1))
+    datasource: int = Field(sa_column=Column(BigInteger, nullable=False, index=True))
+    # digest of the schema visible to the user, changes with table/field edits and column permissions
+    schema_key: str = Field(sa_column=Column(String(64), nullable=False))
+    question: str = Field(sa_column=Column(Text, nullable=True))
+    question_hash: str = Field(sa_column=Column(String(64), nullable=False))
+    embedding: Optional[List[float]] = Field(sa_column=Column(VECTOR(), nullable=True))
+    sql_answer: str = Field(sa_column=Column(Text, nullable=True))
+    chart_type: Optional[str] = Field(sa_column=Column(String(64), nullable=True))
+    hit_count: int = Field(sa_column=Column(Integer, nullable=False, default=0))
+    create_time: datetime = Field(sa_column=Column(DateTime(timezone=False), nullable=True))
+    last_hit_time: Optional[datetime] = Field(sa_column=Column(DateTime(timezone=False), nullable=True))
+
+
 class ChatRecordResult(BaseModel):
     id: Optional[int] = None
     chat_id: Optional[int] = None
@@ -186,82 +210,72 @@ class AiModelQuestion(BaseModel):
     error_msg: str = ""
 
     def sql_sys_question(self, db_type: Union[str, DB], enable_query_limit: bool = True):
-        _sql_template = get_sql_example_template(db_type)
-        _base_sql_rules = _sql_template['quot_rule'] + _sql_template['limit_rule'] + _sql_template['other_rule']
-        _query_limit = get_sql_template()['query_limit'] if enable_query_limit else get_sql_template()['no_query_limit']
-        _sql_examples = _sql_template['basic_example']
-        _example_engine = _sql_template['example_engine']
-        _example_answer_1 = _sql_template['example_answer_1_with_limit'] if enable_query_limit else _sql_template[
-            'example_answer_1']
-        _example_answer_2 = _sql_template['example_answer_2_with_limit'] if enable_query_limit else _sql_template[
-            'example_answer_2']
-        _example_answer_3 = _sql_template['example_answer_3_with_limit'] if enable_query_limit else _sql_template[
-            'example_answer_3']
-        return get_sql_template()['system'].format(engine=self.engine, schema=self.db_schema, question=self.question,
-                                                   lang=self.lang, terminologies=self.terminologies,
-                                                   data_training=self.data_training, custom_prompt=self.custom_prompt,
-                                                   base_sql_rules=_base_sql_rules, query_limit=_query_limit,
-                                                   basic_sql_examples=_sql_examples,
-                                                   example_engine=_example_engine,
-                                                   example_answer_1=_example_answer_1,
-                                                   example_answer_2=_example_answer_2,
-                                                   example_answer_3=_example_answer_3)
+        return get_sql_system_template(db_type, enable_query_limit, self.lang).format(
+            engine=self.engine, schema=self.db_schema, question=self.question, terminologies=self.terminologies,
+            data_training=self.data_training, custom_prompt=self.custom_prompt)
 
     def sql_user_question(self, current_time: str):
-        return get_sql_template()['user'].format(engine=self.engine, schema=self.db_schema, question=self.question,
-                                                 rule=self.rule, current_time=current_time, error_msg=self.error_msg)
+        return compile_template(get_sql_template()['user']).format(engine=self.engine, schema=self.db_schema,
+                                                                   question=self.question, rule=self.rule,
+                                                                   current_time=current_time,
+                                                                   error_msg=self.error_msg)
 
     def chart_sys_question(self):
-        return get_chart_template()['system'].format(sql=self.sql, question=self.question, lang=self.lang)
+        return compile_template(get_chart_template()['system'], lang=self.lang).format(sql=self.sql,
+                                                                                       question=self.question)
 
     def chart_user_question(self, chart_type: Optional[str] = None, enhanced_question: Optional[str] = None):
-        return get_chart_template()['user'].format(sql=self.sql, question=self.question if not enhanced_question else enhanced_question, rule=self.rule,
-                                                   chart_type=chart_type)
+        return compile_template(get_chart_template()['user']).format(sql=self.sql, question=self.question if not enhanced_question else enhanced_question, rule=self.rule,
+                                                                     chart_type=chart_type)
 
     def analysis_sys_question(self):
-        return get_analysis_template()['system'].format(lang=self.lang, terminologies=self.terminologies,
-                                                        custom_prompt=self.custom_prompt)
+        return compile_template(get_analysis_template()['system'], lang=self.lang).format(
+            terminologies=self.terminologies, custom_prompt=self.custom_prompt)
 
     def analysis_user_question(self):
-        return get_analysis_template()['user'].format(fields=self.fields, data=self.data)
+        return compile_template(get_analysis_template()['user']).format(fields=self.fields, data=self.data)
 
     def predict_sys_question(self):
-        return get_predict_template()['system'].format(lang=self.lang, custom_prompt=self.custom_prompt)
+        return compile_template(get_predict_template()['system'], lang=self.lang).format(
+            custom_prompt=self.custom_prompt)
 
     def predict_user_question(self):
-        return get_predict_template()['user'].format(fields=self.fields, data=self.data)
+        return compile_template(get_predict_template()['user']).format(fields=self.fields, data=self.data)
 
     def datasource_sys_question(self):
-        return get_datasource_template()['system'].format(lang=self.lang)
+        return compile_template(get_datasource_template()['system'], lang=self.lang).format()
 
     def datasource_user_question(self, datasource_list: str = "[]"):
-        return get_datasource_template()['user'].format(question=self.question, data=datasource_list)
+        return compile_template(get_datasource_template()['user']).format(question=self.question,
+                                                                          data=datasource_list)
 
     def guess_sys_question(self):
-        return get_guess_question_template()['system'].format(lang=self.lang)
+        return compile_template(get_guess_question_template()['system'], lang=self.lang).format()
 
     def guess_user_question(self, old_questions: str = "[]"):
-        return get_guess_question_template()['user'].format(question=self.question, schema=self.db_schema,
-                                                            old_questions=old_questions)
+        return compile_template(get_guess_question_template()['user']).format(question=self.question,
+                                                                              schema=self.db_schema,
+                                                                              old_questions=old_questions)
 
     def filter_sys_question(self):
-        return get_permissions_template()['system'].format(lang=self.lang, engine=self.engine)
+        return compile_template(get_permissions_template()['system'], lang=self.lang).format(engine=self.engine)
 
     def filter_user_question(self):
-        return get_permissions_template()['user'].format(sql=self.sql, filter=self.filter)
+        return compile_template(get_permissions_template()['user']).format(sql=self.sql, filter=self.filter)
 
     def dynamic_sys_question(self):
-        return get_dynamic_template()['system'].format(lang=self.lang, engine=self.engine)
+        return compile_template(get_dynamic_template()['system'], lang=self.lang).format(engine=self.engine)
 
     def dynamic_user_question(self):
-        return get_dynamic_template()['user'].format(sql=self.sql, sub_query=self.sub_query)
+        return compile_template(get_dynamic_template()['user']).format(sql=self.sql, sub_query=self.sub_query)
 
     def data_transfer_sys_question(self):
         return get_data_transfer_template()['system']
 
     def data_transfer_user_question(self, sql_query: str, sql_result: Any, evidence: str):
-        return get_data_transfer_template()['user'].format(db_schema=self.db_schema, sql_query=sql_query,
-                                                 sql_result=sql_result, evidence=evidence)
+        return compile_template(get_data_transfer_template()['user']).format(db_schema=self.db_schema,
+                                                                             sql_query=sql_query,
+                                                                             sql_result=sql_result, evidence=evidence)
 
 
 
@@ -1,14 +1,17 @@
-import concurrent
+import asyncio
+import functools
 import json
+import logging
 import os
+import threading
 import time
 import traceback
 import urllib.parse
 import xml.etree.ElementTree as ET
 import warnings
-from concurrent.futures import ThreadPoolExecutor, Future
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Any, List, Optional, Union, Dict, Iterator
+from typing import Any, List, Optional, Union, Dict, Iterator, AsyncIterator
 
 import orjson
 import pandas as pd
@@ -18,13 +21,15 @@ from langchain.chat_models.base import BaseChatModel
 from langchain_community.utilities import SQLDatabase
 from langchain_core.messages import BaseMessage, SystemMessage, HumanMessage, AIMessage, BaseMessageChunk
 from sqlalchemy import and_, select
-from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlbot_xpack.custom_prompt.curd.custom_prompt import find_custom_prompts
 from sqlbot_xpack.custom_prompt.models.custom_prompt_model import CustomPromptTypeEnum
 from sqlbot_xpack.license.license_manage import SQLBotLicenseUtil
 from sqlmodel import Session
 
-from apps.ai_model.model_factory import LLMConfig, LLMFactory, get_default_config
+from apps.ai_model.hedging import guarded_stream
+from apps.ai_model.model_factory import LLMConfig, LLMFactory, get_default_config, get_fallback_config, \
+    get_operation_configs
+from apps.ai_model.response_cache import llm_response_cache
 from apps.chat.curd.chat import save_question, save_sql_answer, save_sql, \
     save_error_message, save_sql_exec_data, save_chart_answer, save_chart, \
     finish_record, save_analysis_answer, save_predict_answer, save_predict_data, \
@@ -32,15 +37,17 @@ from apps.chat.curd.chat import save_question, save_sql_answer, save_sql, \
     get_old_questions, save_analysis_predict_record, rename_chat, get_chart_config, \
     get_chat_chart_data, list_generate_sql_logs, list_generate_chart_logs, start_log, end_log, \
     get_last_execute_sql_error
+from apps.chat.curd.sql_cache import find_cached_sql, save_cached_sql
 from apps.chat.models.chat_model import ChatQuestion, ChatRecord, Chat, RenameChat, ChatLog, OperationEnum, \
-    ChatFinishStep
+    ChatFinishStep, ChatSqlCache
 from sqlbot_xpack.license.license_manage import SQLBotLicenseUtil
 from sqlbot_xpack.custom_prompt.curd.custom_prompt import find_custom_prompts
 from sqlbot_xpack.custom_prompt.models.custom_prompt_model import CustomPromptTypeEnum
 
 from apps.chat.task.data_transfer import DataTransfer
+from apps.chat.task.prompt_budget import section_budget, trim_error_msg, trim_history, history_budget
 from apps.data_training.curd.data_training import get_training_template
-from apps.datasource.crud.datasource import get_table_schema
+from apps.datasource.crud.datasource import get_table_schema, get_schema_key
 from apps.datasource.crud.permission import get_row_permission_filters, is_normal_user
 from apps.datasource.embedding.ds_embedding import get_ds_embedding
 from apps.datasource.models.datasource import CoreDatasource
@@ -53,18 +60,83 @@ from common.core.db import engine
 from common.core.deps import CurrentAssistant, CurrentUser
 from common.core.nl2sql_session import NL2SQLSession
 from common.error import SingleMessageError, SQLBotDBError, ParseSQLResultError, SQLBotDBConnectionError
-from common.utils.utils import SQLBotLogUtil, extract_nested_json, prepare_for_orjson
+from common.utils.json_stream import StreamingJsonObjectParser
+from common.utils.metrics import REGISTRY, SQL_EXECUTION_SECONDS, SSE_BYTES, SSE_WRITES, CallbackGauge, \
+    StageTimer, observe_llm_stream, trace_stage
+from common.utils.step_graph import StepGraph
+from common.utils.utils import SQLBotLogUtil, extract_nested_json, prepare_for_orjson, estimate_tokens, \
+    truncate_to_tokens
 
 warnings.filterwarnings("ignore")
 
+_logger = logging.getLogger(__name__)
+
 base_message_count_limit = 6
 
-executor = ThreadPoolExecutor(max_workers=200)
+EXECUTOR_MAX_WORKERS = 200
+executor = ThreadPoolExecutor(max_workers=EXECUTOR_MAX_WORKERS)
 
 dynamic_ds_types = [1, 3]
 dynamic_subsql_prefix = 'select * from sqlbot_dynamic_temp_table_'
 
-session_maker = scoped_session(sessionmaker(bind=engine, class_=Session))
+_STREAM_END = object()
+# chat tasks running on the event loop, referenced until done so they are not garbage collected
+_running_tasks: set = set()
+
+
+_executor_lock = threading.Lock()
+# blocking steps submitted to the worker pool and not started yet, and the ones running right now
+_executor_queued = [0]
+_executor_active = [0]
+
+
+def _run_tracked(fn):
+    with _executor_lock:
+        _executor_queued[0] -= 1
+        _executor_active[0] += 1
+    try:
+        return fn()
+    finally:
+        with _executor_lock:
+            _executor_active[0] -= 1
+
+
+REGISTRY.register(CallbackGauge('sqlbot_executor_queue_depth', 'Blocking steps waiting for a worker thread',
+                                lambda: _executor_queued[0]))
+REGISTRY.register(CallbackGauge('sqlbot_executor_active_threads', 'Worker threads running a step',
+                                lambda: _executor_active[0]))
+REGISTRY.register(CallbackGauge('sqlbot_executor_utilization', 'Share of the worker pool running a step',
+                                lambda: _executor_active[0] / EXECUTOR_MAX_WORKERS))
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Run a blocking step (metadata DB, datasource driver, HTTP) on the worker pool, keeping the event loop free"""
+    with _executor_lock:
+        _executor_queued[0] += 1
+    try:
+        future = asyncio.get_running_loop().run_in_executor(executor, _run_tracked,
+                                                            functools.partial(fn, *args, **kwargs))
+    except BaseException:
+        with _executor_lock:
+            _executor_queued[0] -= 1
+        raise
+    return await future
+
+
+def run_in_session(fn, *args, **kwargs):
+    """Call fn with a session of its own, concurrently running steps must not share one session"""
+    with Session(engine) as session:
+        return fn(session, *args, **kwargs)
+
+
+async def iterate_blocking(iterable):
+    """Iterate a blocking iterator (e.g. a streamed HTTP response) without blocking the event loop"""
+    iterator = await run_blocking(iter, iterable)
+    while True:
+        item = await run_blocking(next, iterator, _STREAM_END)
+        if item is _STREAM_END:
+            break
+        yield item
 
 
 class LLMService:
@@ -87,56 +159,45 @@ class LLMService:
 
     current_logs: dict[OperationEnum, ChatLog] = {}
 
-    chunk_list: List[str] = []
-    future: Future
+    task: Optional[asyncio.Task] = None
+    coalesce: bool = True
+    # chunks produced by the chat task are handed over to the response through this queue
+    chunk_queue: Optional[asyncio.Queue] = None
+    loop: Optional[asyncio.AbstractEventLoop] = None
 
     last_execute_sql_error: str = None
 
-    def __init__(self, session: Session, current_user: CurrentUser, chat_question: ChatQuestion,
+    def __init__(self, current_user: CurrentUser, chat_question: ChatQuestion,
                  current_assistant: Optional[CurrentAssistant] = None, no_reasoning: bool = False,
-                 embedding: bool = False, config: LLMConfig = None):
-        self.chunk_list = []
+                 embedding: bool = False, config: LLMConfig = None,
+                 operation_configs: Optional[Dict[str, LLMConfig]] = None, fallback_config: LLMConfig = None):
+        # keep construction cheap, the datasource, schema and chat logs are loaded by the chat task itself
+        self.chunk_queue = None
+        self.loop = None
         self.current_user = current_user
         self.current_assistant = current_assistant
-        chat_id = chat_question.chat_id
-        chat: Chat | None = session.get(Chat, chat_id)
-        if not chat:
-            raise SingleMessageError(f"Chat with id {chat_id} not found")
-        ds: CoreDatasource | AssistantOutDsSchema | None = None
-        if chat.datasource:
-            # Get available datasource
-            if current_assistant and current_assistant.type in dynamic_ds_types:
-                self.out_ds_instance = AssistantOutDsFactory.get_instance(current_assistant)
-                ds = self.out_ds_instance.get_ds(chat.datasource)
-                if not ds:
-                    raise SingleMessageError("数据源无效")
-                chat_question.engine = ds.type + get_version(ds)
-                chat_question.db_schema = self.out_ds_instance.get_db_schema(ds.id, chat_question.question)
-            else:
-                ds = session.get(CoreDatasource, chat.datasource)
-                if not ds:
-                    raise SingleMessageError("数据源无效")
-                chat_question.engine = (ds.type_name if ds.type != 'excel' else 'PostgreSQL') + get_version(ds)
-                chat_question.db_schema = get_table_schema(session=session, current_user=current_user, ds=ds,
-                                                           question=chat_question.question, embedding=embedding)
-
-        self.generate_sql_logs = list_generate_sql_logs(session=session, chart_id=chat_id)
-        self.generate_chart_logs = list_generate_chart_logs(session=session, chart_id=chat_id)
-
-        self.change_title = len(self.generate_sql_logs) == 0
+        self.embedding = embedding
+        self.chat_datasource = None
+        self.ds = None
+        self.out_ds_instance = None
+        self.generate_sql_logs = []
+        self.generate_chart_logs = []
+        # semantic sql cache: schema key of the datasource, the hit of this question and its embedding
+        self.sql_cache_key: Optional[str] = None
+        self.sql_cache_hit: Optional[ChatSqlCache] = None
+        self.sql_cache_embedding: Optional[List[float]] = None
+        # estimated tokens per section of the generate sql prompt, kept in the chat log
+        self.prompt_tokens: Dict[str, int] = {}
 
         chat_question.lang = get_lang_name(current_user.language)
 
-        self.ds = (
-            ds if isinstance(ds, AssistantOutDsSchema) else CoreDatasource(**ds.model_dump())) if ds else None
         self.chat_question = chat_question
-        self.config = config
-        if no_reasoning:
-            # only work while using qwen
-            if self.config.additional_params:
-                if self.config.additional_params.get('extra_body'):
-                    if self.config.additional_params.get('extra_body').get('enable_thinking'):
-                        del self.config.additional_params['extra_body']['enable_thinking']
+        self.config = self._reasoning_config(config, no_reasoning)
+        # steps routed to another model by LLM_OPERATION_MODELS, every other step uses the default model
+        self.operation_configs = {name: self._reasoning_config(op_config, no_reasoning)
+                                  for name, op_config in (operation_configs or {}).items()}
+        # model of hedged and failed-over requests, see guarded_stream
+        self.fallback_config = self._reasoning_config(fallback_config, no_reasoning) if fallback_config else None
 
         self.chat_question.ai_modal_id = self.config.model_id
         self.chat_question.ai_modal_name = self.config.model_name
@@ -145,30 +206,98 @@ class LLMService:
         llm_instance = LLMFactory.create_llm(self.config)
         self.llm = llm_instance.llm
 
-        # get last_execute_sql_error
+    @staticmethod
+    def _reasoning_config(config: LLMConfig, no_reasoning: bool) -> LLMConfig:
+        if no_reasoning:
+            # only work while using qwen
+            extra_body = (config.additional_params or {}).get('extra_body')
+            if extra_body and extra_body.get('enable_thinking'):
+                # the config may be shared, change a copy of it
+                config = config.frozen_copy()
+                del config.additional_params['extra_body']['enable_thinking']
+        return config
+
+    def get_config(self, operation: OperationEnum) -> LLMConfig:
+        return self.operation_configs.get(operation.name, self.config)
+
+    def get_llm(self, operation: OperationEnum) -> BaseChatModel:
+        config = self.operation_configs.get(operation.name)
+        # instances are cached by the factory, so resolving one per call is cheap
+        return LLMFactory.create_llm(config).llm if config else self.llm
+
+    def load_chat(self, session: Session):
+        chat_id = self.chat_question.chat_id
+        chat: Chat | None = session.get(Chat, chat_id)
+        if not chat:
+            raise SingleMessageError(f"Chat with id {chat_id} not found")
+        self.chat_datasource = chat.datasource
+
+    def load_datasource(self, session: Session):
+        """Resolve the datasource bound to the chat, for assistants this calls the assistant's datasource api"""
+        if not self.chat_datasource:
+            return
+        if self.current_assistant and self.current_assistant.type in dynamic_ds_types:
+            self.out_ds_instance = AssistantOutDsFactory.get_instance(self.current_assistant)
+            ds = self.out_ds_instance.get_ds(self.chat_datasource)
+            if not ds:
+                raise SingleMessageError("数据源无效")
+            self.ds = ds
+        else:
+            ds = session.get(CoreDatasource, self.chat_datasource)
+            if not ds:
+                raise SingleMessageError("数据源无效")
+            self.ds = CoreDatasource(**ds.model_dump())
+
+    def load_engine_version(self):
+        if isinstance(self.ds, AssistantOutDsSchema):
+            self.chat_question.engine = self.ds.type + get_version(self.ds)
+        else:
+            self.chat_question.engine = (self.ds.type_name if self.ds.type != 'excel' else 'PostgreSQL') + get_version(
+                self.ds)
+
+    def load_chat_logs(self, session: Session):
+        chat_id = self.chat_question.chat_id
+        self.generate_sql_logs = list_generate_sql_logs(session=session, chart_id=chat_id)
+        self.generate_chart_logs = list_generate_chart_logs(session=session, chart_id=chat_id)
+        self.change_title = len(self.generate_sql_logs) == 0
+
+    def load_last_execute_sql_error(self, session: Session):
         last_execute_sql_error = get_last_execute_sql_error(session, self.chat_question.chat_id)
         if last_execute_sql_error:
             self.chat_question.error_msg = f'''<error-msg>
-{last_execute_sql_error}
+{trim_error_msg(last_execute_sql_error)}
 </error-msg>'''
         else:
             self.chat_question.error_msg = ''
 
     @classmethod
-    async def create(cls, *args, **kwargs):
+    async def create(cls, session: Session, *args, **kwargs):
         config: LLMConfig = await get_default_config()
-        instance = cls(*args, **kwargs, config=config)
+        operation_configs = await get_operation_configs()
+        fallback_config = await get_fallback_config()
+        instance = cls(*args, **kwargs, config=config, operation_configs=operation_configs,
+                       fallback_config=fallback_config)
+        await run_blocking(instance.load_chat, session)
         return instance
 
-    def is_running(self, timeout=0.5):
-        try:
-            r = concurrent.futures.wait([self.future], timeout)
-            if len(r.not_done) > 0:
-                return True
-            else:
-                return False
-        except Exception as e:
-            return True
+    def stream_llm(self, operation: OperationEnum, messages: List[Union[BaseMessage, dict[str, Any]]],
+                   token_usage: Dict[str, Any]):
+        """
+        Processed LLM stream of one operation, replayed from the response cache when enabled for it.
+        Real calls run under the deadlines of the operation and are hedged to the fallback model when configured.
+        """
+        llm = self.get_llm(operation)
+        fallback_llm = LLMFactory.create_llm(self.fallback_config).llm if self.fallback_config else None
+        fallback = (lambda usage: aprocess_stream(fallback_llm.astream(messages), usage)) if fallback_llm else None
+        config = self.get_config(operation)
+        return llm_response_cache.stream(operation, config, messages,
+                                         lambda: observe_llm_stream(
+                                             operation, config.model_name,
+                                             guarded_stream(operation,
+                                                            lambda usage: aprocess_stream(llm.astream(messages), usage),
+                                                            token_usage, fallback),
+                                             token_usage),
+                                         token_usage)
 
     def init_messages(self):
         last_sql_messages: List[dict[str, Any]] = self.generate_sql_logs[-1].messages if len(
@@ -179,11 +308,23 @@ class LLMService:
 
         self.sql_message = []
         # add sys prompt
-        self.sql_message.append(SystemMessage(
-            content=self.chat_question.sql_sys_question(self.ds.type, settings.GENERATE_SQL_QUERY_LIMIT_ENABLED)))
+        sql_sys_question = self.chat_question.sql_sys_question(self.ds.type, settings.GENERATE_SQL_QUERY_LIMIT_ENABLED)
+        self.sql_message.append(SystemMessage(content=sql_sys_question))
+        self.prompt_tokens = {'system': estimate_tokens(sql_sys_question),
+                              'schema': estimate_tokens(self.chat_question.db_schema),
+                              'terminologies': estimate_tokens(self.chat_question.terminologies),
+                              'data_training': estimate_tokens(self.chat_question.data_training),
+                              'custom_prompt': estimate_tokens(self.chat_question.custom_prompt),
+                              'error_msg': estimate_tokens(self.chat_question.error_msg)}
         if last_sql_messages is not None and len(last_sql_messages) > 0:
-            # limit count
-            for last_sql_message in last_sql_messages[count_limit:]:
+            last_sql_messages = [msg for msg in last_sql_messages[count_limit:] if msg['type'] in ('human', 'ai')]
+            # what the system prompt and the question leave of the budget, oldest messages go first
+            max_history_tokens = history_budget(self.prompt_tokens['system'] + estimate_tokens(
+                self.chat_question.sql_user_question(current_time='')))
+            if max_history_tokens is not None:
+                last_sql_messages = trim_history(last_sql_messages, max_history_tokens)
+            self.prompt_tokens['history'] = sum(estimate_tokens(msg['content']) for msg in last_sql_messages)
+            for last_sql_message in last_sql_messages:
                 _msg: BaseMessage
                 if last_sql_message['type'] == 'human':
                     _msg = HumanMessage(content=last_sql_message['content'])
@@ -243,38 +384,40 @@ class LLMService:
                     fields.append(column_str)
         return fields
 
-    def generate_analysis(self, _session: Session):
-        fields = self.get_fields_from_chart(_session)
+    async def generate_analysis(self, _session: Session):
+        fields = await run_blocking(self.get_fields_from_chart, _session)
         self.chat_question.fields = orjson.dumps(fields).decode()
-        data = get_chat_chart_data(_session, self.record.id)
+        data = await run_blocking(get_chat_chart_data, _session, self.record.id)
         self.chat_question.data = orjson.dumps(data.get('data')).decode()
         analysis_msg: List[Union[BaseMessage, dict[str, Any]]] = []
 
         ds_id = self.ds.id if isinstance(self.ds, CoreDatasource) else None
-        self.chat_question.terminologies = get_terminology_template(_session, self.chat_question.question,
-                                                                    self.current_user.oid, ds_id)
+        self.chat_question.terminologies = await run_blocking(get_terminology_template, _session,
+                                                              self.chat_question.question, self.current_user.oid,
+                                                              ds_id)
         if SQLBotLicenseUtil.valid():
-            self.chat_question.custom_prompt = find_custom_prompts(_session, CustomPromptTypeEnum.ANALYSIS,
-                                                                   self.current_user.oid, ds_id)
+            self.chat_question.custom_prompt = await run_blocking(find_custom_prompts, _session,
+                                                                  CustomPromptTypeEnum.ANALYSIS,
+                                                                  self.current_user.oid, ds_id)
 
         analysis_msg.append(SystemMessage(content=self.chat_question.analysis_sys_question()))
         analysis_msg.append(HumanMessage(content=self.chat_question.analysis_user_question()))
 
-        self.current_logs[OperationEnum.ANALYSIS] = start_log(session=_session,
-                                                              ai_modal_id=self.chat_question.ai_modal_id,
-                                                              ai_modal_name=self.chat_question.ai_modal_name,
-                                                              operate=OperationEnum.ANALYSIS,
-                                                              record_id=self.record.id,
-                                                              full_message=[
-                                                                  {'type': msg.type,
-                                                                   'content': msg.content} for
-                                                                  msg
-                                                                  in analysis_msg])
+        self.current_logs[OperationEnum.ANALYSIS] = await run_blocking(start_log, session=_session,
+                                                                                  ai_modal_id=self.get_config(OperationEnum.ANALYSIS).model_id,
+                                                                                  ai_modal_name=self.get_config(OperationEnum.ANALYSIS).model_name,
+                                                                                  operate=OperationEnum.ANALYSIS,
+                                                                                  record_id=self.record.id,
+                                                                                  full_message=[
+                                                                                      {'type': msg.type,
+                                                                                       'content': msg.content} for
+                                                                                      msg
+                                                                                      in analysis_msg])
         full_thinking_text = ''
         full_analysis_text = ''
         token_usage = {}
-        res = process_stream(self.llm.stream(analysis_msg), token_usage)
-        for chunk in res:
+        res = self.stream_llm(OperationEnum.ANALYSIS, analysis_msg, token_usage)
+        async for chunk in res:
             if chunk.get('content'):
                 full_analysis_text += chunk.get('content')
             if chunk.get('reasoning_content'):
@@ -283,48 +426,49 @@ class LLMService:
 
         analysis_msg.append(AIMessage(full_analysis_text))
 
-        self.current_logs[OperationEnum.ANALYSIS] = end_log(session=_session,
-                                                            log=self.current_logs[
-                                                                OperationEnum.ANALYSIS],
-                                                            full_message=[
-                                                                {'type': msg.type,
-                                                                 'content': msg.content}
-                                                                for msg in analysis_msg],
-                                                            reasoning_content=full_thinking_text,
-                                                            token_usage=token_usage)
-        self.record = save_analysis_answer(session=_session, record_id=self.record.id,
-                                           answer=orjson.dumps({'content': full_analysis_text}).decode())
-
-    def generate_predict(self, _session: Session):
-        fields = self.get_fields_from_chart(_session)
+        self.current_logs[OperationEnum.ANALYSIS] = await run_blocking(end_log, session=_session,
+                                                                                log=self.current_logs[
+                                                                                    OperationEnum.ANALYSIS],
+                                                                                full_message=[
+                                                                                    {'type': msg.type,
+                                                                                     'content': msg.content}
+                                                                                    for msg in analysis_msg],
+                                                                                reasoning_content=full_thinking_text,
+                                                                                token_usage=token_usage)
+        self.record = await run_blocking(save_analysis_answer, session=_session, record_id=self.record.id,
+                                                               answer=orjson.dumps({'content': full_analysis_text}).decode())
+
+    async def generate_predict(self, _session: Session):
+        fields = await run_blocking(self.get_fields_from_chart, _session)
         self.chat_question.fields = orjson.dumps(fields).decode()
-        data = get_chat_chart_data(_session, self.record.id)
+        data = await run_blocking(get_chat_chart_data, _session, self.record.id)
         self.chat_question.data = orjson.dumps(data.get('data')).decode()
 
         if SQLBotLicenseUtil.valid():
             ds_id = self.ds.id if isinstance(self.ds, CoreDatasource) else None
-            self.chat_question.custom_prompt = find_custom_prompts(_session, CustomPromptTypeEnum.PREDICT_DATA,
-                                                                   self.current_user.oid, ds_id)
+            self.chat_question.custom_prompt = await run_blocking(find_custom_prompts, _session,
+                                                                  CustomPromptTypeEnum.PREDICT_DATA,
+                                                                  self.current_user.oid, ds_id)
 
         predict_msg: List[Union[BaseMessage, dict[str, Any]]] = []
         predict_msg.append(SystemMessage(content=self.chat_question.predict_sys_question()))
         predict_msg.append(HumanMessage(content=self.chat_question.predict_user_question()))
 
-        self.current_logs[OperationEnum.PREDICT_DATA] = start_log(session=_session,
-                                                                  ai_modal_id=self.chat_question.ai_modal_id,
-                                                                  ai_modal_name=self.chat_question.ai_modal_name,
-                                                                  operate=OperationEnum.PREDICT_DATA,
-                                                                  record_id=self.record.id,
-                                                                  full_message=[
-                                                                      {'type': msg.type,
-                                                                       'content': msg.content} for
-                                                                      msg
-                                                                      in predict_msg])
+        self.current_logs[OperationEnum.PREDICT_DATA] = await run_blocking(start_log, session=_session,
+                                                                                      ai_modal_id=self.get_config(OperationEnum.PREDICT_DATA).model_id,
+                                                                                      ai_modal_name=self.get_config(OperationEnum.PREDICT_DATA).model_name,
+                                                                                      operate=OperationEnum.PREDICT_DATA,
+                                                                                      record_id=self.record.id,
+                                                                                      full_message=[
+                                                                                          {'type': msg.type,
+                                                                                           'content': msg.content} for
+                                                                                          msg
+                                                                                          in predict_msg])
         full_thinking_text = ''
         full_predict_text = ''
         token_usage = {}
-        res = process_stream(self.llm.stream(predict_msg), token_usage)
-        for chunk in res:
+        res = self.stream_llm(OperationEnum.PREDICT_DATA, predict_msg, token_usage)
+        async for chunk in res:
             if chunk.get('content'):
                 full_predict_text += chunk.get('content')
             if chunk.get('reasoning_content'):
@@ -332,24 +476,26 @@ class LLMService:
             yield chunk
 
         predict_msg.append(AIMessage(full_predict_text))
-        self.record = save_predict_answer(session=_session, record_id=self.record.id,
-                                          answer=orjson.dumps({'content': full_predict_text}).decode())
-        self.current_logs[OperationEnum.PREDICT_DATA] = end_log(session=_session,
-                                                                log=self.current_logs[
-                                                                    OperationEnum.PREDICT_DATA],
-                                                                full_message=[
-                                                                    {'type': msg.type,
-                                                                     'content': msg.content}
-                                                                    for msg in predict_msg],
-                                                                reasoning_content=full_thinking_text,
-                                                                token_usage=token_usage)
-
-    def generate_recommend_questions_task(self, _session: Session):
+        self.record = await run_blocking(save_predict_answer, session=_session, record_id=self.record.id,
+                                                              answer=orjson.dumps({'content': full_predict_text}).decode())
+        self.current_logs[OperationEnum.PREDICT_DATA] = await run_blocking(end_log, session=_session,
+                                                                                    log=self.current_logs[
+                                                                                        OperationEnum.PREDICT_DATA],
+                                                                                    full_message=[
+                                                                                        {'type': msg.type,
+                                                                                         'content': msg.content}
+                                                                                        for msg in predict_msg],
+                                                                                    reasoning_content=full_thinking_text,
+                                                                                    token_usage=token_usage)
+
+    async def generate_recommend_questions_task(self, _session: Session):
 
         # get schema
         if self.ds and not self.chat_question.db_schema:
-            self.chat_question.db_schema = self.out_ds_instance.get_db_schema(
-                self.ds.id, self.chat_question.question) if self.out_ds_instance else get_table_schema(
+            self.chat_question.db_schema = await run_blocking(
+                self.out_ds_instance.get_db_schema, self.ds.id,
+                self.chat_question.question) if self.out_ds_instance else await run_blocking(
+                get_table_schema,
                 session=_session,
                 current_user=self.current_user, ds=self.ds,
                 question=self.chat_question.question,
@@ -358,25 +504,26 @@ class LLMService:
         guess_msg: List[Union[BaseMessage, dict[str, Any]]] = []
         guess_msg.append(SystemMessage(content=self.chat_question.guess_sys_question()))
 
-        old_questions = list(map(lambda q: q.strip(), get_old_questions(_session, self.record.datasource)))
+        old_questions = list(map(lambda q: q.strip(),
+                                 await run_blocking(get_old_questions, _session, self.record.datasource)))
         guess_msg.append(
             HumanMessage(content=self.chat_question.guess_user_question(orjson.dumps(old_questions).decode())))
 
-        self.current_logs[OperationEnum.GENERATE_RECOMMENDED_QUESTIONS] = start_log(session=_session,
-                                                                                    ai_modal_id=self.chat_question.ai_modal_id,
-                                                                                    ai_modal_name=self.chat_question.ai_modal_name,
-                                                                                    operate=OperationEnum.GENERATE_RECOMMENDED_QUESTIONS,
-                                                                                    record_id=self.record.id,
-                                                                                    full_message=[
-                                                                                        {'type': msg.type,
-                                                                                         'content': msg.content} for
-                                                                                        msg
-                                                                                        in guess_msg])
+        self.current_logs[OperationEnum.GENERATE_RECOMMENDED_QUESTIONS] = await run_blocking(start_log, session=_session,
+                                                                                                        ai_modal_id=self.get_config(OperationEnum.GENERATE_RECOMMENDED_QUESTIONS).model_id,
+                                                                                                        ai_modal_name=self.get_config(OperationEnum.GENERATE_RECOMMENDED_QUESTIONS).model_name,
+                                                                                                        operate=OperationEnum.GENERATE_RECOMMENDED_QUESTIONS,
+                                                                                                        record_id=self.record.id,
+                                                                                                        full_message=[
+                                                                                                            {'type': msg.type,
+                                                                                                             'content': msg.content} for
+                                                                                                            msg
+                                                                                                            in guess_msg])
         full_thinking_text = ''
         full_guess_text = ''
         token_usage = {}
-        res = process_stream(self.llm.stream(guess_msg), token_usage)
-        for chunk in res:
+        res = self.stream_llm(OperationEnum.GENERATE_RECOMMENDED_QUESTIONS, guess_msg, token_usage)
+        async for chunk in res:
             if chunk.get('content'):
                 full_guess_text += chunk.get('content')
             if chunk.get('reasoning_content'):
@@ -385,25 +532,25 @@ class LLMService:
 
         guess_msg.append(AIMessage(full_guess_text))
 
-        self.current_logs[OperationEnum.GENERATE_RECOMMENDED_QUESTIONS] = end_log(session=_session,
-                                                                                  log=self.current_logs[
-                                                                                      OperationEnum.GENERATE_RECOMMENDED_QUESTIONS],
-                                                                                  full_message=[
-                                                                                      {'type': msg.type,
-                                                                                       'content': msg.content}
-                                                                                      for msg in guess_msg],
-                                                                                  reasoning_content=full_thinking_text,
-                                                                                  token_usage=token_usage)
-        self.record = save_recommend_question_answer(session=_session, record_id=self.record.id,
-                                                     answer={'content': full_guess_text})
+        self.current_logs[OperationEnum.GENERATE_RECOMMENDED_QUESTIONS] = await run_blocking(end_log, session=_session,
+                                                                                                      log=self.current_logs[
+                                                                                                          OperationEnum.GENERATE_RECOMMENDED_QUESTIONS],
+                                                                                                      full_message=[
+                                                                                                          {'type': msg.type,
+                                                                                                           'content': msg.content}
+                                                                                                          for msg in guess_msg],
+                                                                                                      reasoning_content=full_thinking_text,
+                                                                                                      token_usage=token_usage)
+        self.record = await run_blocking(save_recommend_question_answer, session=_session, record_id=self.record.id,
+                                                                         answer={'content': full_guess_text})
 
         yield {'recommended_question': self.record.recommended_question}
 
-    def select_datasource(self, _session: Session):
+    async def select_datasource(self, _session: Session):
         datasource_msg: List[Union[BaseMessage, dict[str, Any]]] = []
         datasource_msg.append(SystemMessage(self.chat_question.datasource_sys_question()))
         if self.current_assistant and self.current_assistant.type != 4:
-            _ds_list = get_assistant_ds(session=_session, llm_service=self)
+            _ds_list = await run_blocking(get_assistant_ds, session=_session, llm_service=self)
         else:
             stmt = select(CoreDatasource.id, CoreDatasource.name, CoreDatasource.description).where(
                 and_(CoreDatasource.oid == self.current_user.oid))
@@ -413,7 +560,7 @@ class LLMService:
                     "name": ds.name,
                     "description": ds.description
                 }
-                for ds in _session.exec(stmt)
+                for ds in await run_blocking(lambda: _session.exec(stmt).all())
             ]
         if not _ds_list:
             raise SingleMessageError('数据源无效')
@@ -425,8 +572,9 @@ class LLMService:
         if not ignore_auto_select:
             if settings.TABLE_EMBEDDING_ENABLED and (
                     not self.current_assistant or (self.current_assistant and self.current_assistant.type != 1)):
-                _ds_list = get_ds_embedding(_session, self.current_user, _ds_list, self.out_ds_instance,
-                                      self.chat_question.question, self.current_assistant)
+                _ds_list = await run_blocking(get_ds_embedding, _session, self.current_user, _ds_list,
+                                              self.out_ds_instance, self.chat_question.question,
+                                              self.current_assistant)
                 # yield {'content': '{"id":' + str(ds.get('id')) + '}'}
 
             _ds_list_dict = []
@@ -435,19 +583,19 @@ class LLMService:
             datasource_msg.append(
                 HumanMessage(self.chat_question.datasource_user_question(orjson.dumps(_ds_list_dict).decode())))
 
-            self.current_logs[OperationEnum.CHOOSE_DATASOURCE] = start_log(session=_session,
-                                                                           ai_modal_id=self.chat_question.ai_modal_id,
-                                                                           ai_modal_name=self.chat_question.ai_modal_name,
-                                                                           operate=OperationEnum.CHOOSE_DATASOURCE,
-                                                                           record_id=self.record.id,
-                                                                           full_message=[{'type': msg.type,
-                                                                                          'content': msg.content}
-                                                                                         for
-                                                                                         msg in datasource_msg])
+            self.current_logs[OperationEnum.CHOOSE_DATASOURCE] = await run_blocking(start_log, session=_session,
+                                                                                               ai_modal_id=self.get_config(OperationEnum.CHOOSE_DATASOURCE).model_id,
+                                                                                               ai_modal_name=self.get_config(OperationEnum.CHOOSE_DATASOURCE).model_name,
+                                                                                               operate=OperationEnum.CHOOSE_DATASOURCE,
+                                                                                               record_id=self.record.id,
+                                                                                               full_message=[{'type': msg.type,
+                                                                                                              'content': msg.content}
+                                                                                                             for
+                                                                                                             msg in datasource_msg])
 
             token_usage = {}
-            res = process_stream(self.llm.stream(datasource_msg), token_usage)
-            for chunk in res:
+            res = self.stream_llm(OperationEnum.CHOOSE_DATASOURCE, datasource_msg, token_usage)
+            async for chunk in res:
                 if chunk.get('content'):
                     full_text += chunk.get('content')
                 if chunk.get('reasoning_content'):
@@ -455,27 +603,38 @@ class LLMService:
                 yield chunk
             datasource_msg.append(AIMessage(full_text))
 
-            self.current_logs[OperationEnum.CHOOSE_DATASOURCE] = end_log(session=_session,
-                                                                         log=self.current_logs[
-                                                                             OperationEnum.CHOOSE_DATASOURCE],
-                                                                         full_message=[
-                                                                             {'type': msg.type,
-                                                                              'content': msg.content}
-                                                                             for msg in datasource_msg],
-                                                                         reasoning_content=full_thinking_text,
-                                                                         token_usage=token_usage)
+            self.current_logs[OperationEnum.CHOOSE_DATASOURCE] = await run_blocking(end_log, session=_session,
+                                                                                             log=self.current_logs[
+                                                                                                 OperationEnum.CHOOSE_DATASOURCE],
+                                                                                             full_message=[
+                                                                                                 {'type': msg.type,
+                                                                                                  'content': msg.content}
+                                                                                                 for msg in datasource_msg],
+                                                                                             reasoning_content=full_thinking_text,
+                                                                                             token_usage=token_usage)
 
             json_str = extract_nested_json(full_text)
             if json_str is None:
                 raise SingleMessageError(f'Cannot parse datasource from answer: {full_text}')
             ds = orjson.loads(json_str)
 
+        data: dict = _ds_list[0] if ignore_auto_select else ds
+        _datasource, _engine_type, _error = await run_blocking(self.switch_datasource, _session, data)
+
+        if not ignore_auto_select and not settings.TABLE_EMBEDDING_ENABLED:
+            self.record = await run_blocking(save_select_datasource_answer, session=_session, record_id=self.record.id,
+                                                                            answer=orjson.dumps({'content': full_text}).decode(),
+                                                                            datasource=_datasource,
+                                                                            engine_type=_engine_type)
+        if _error:
+            raise _error
+
+    def switch_datasource(self, _session: Session, data: dict):
+        """Bind the chat to the datasource chosen by the model, returns (datasource id, engine type, error)"""
         _error: Exception | None = None
         _datasource: int | None = None
         _engine_type: str | None = None
         try:
-            data: dict = _ds_list[0] if ignore_auto_select else ds
-
             if data.get('id') and data.get('id') != 0:
                 _datasource = data['id']
                 _chat = _session.get(Chat, self.record.chat_id)
@@ -484,8 +643,6 @@ class LLMService:
                     _ds = self.out_ds_instance.get_ds(data['id'])
                     self.ds = _ds
                     self.chat_question.engine = _ds.type + get_version(self.ds)
-                    self.chat_question.db_schema = self.out_ds_instance.get_db_schema(self.ds.id,
-                                                                                      self.chat_question.question)
                     _engine_type = self.chat_question.engine
                     _chat.engine_type = _ds.type
                 else:
@@ -496,9 +653,6 @@ class LLMService:
                     self.ds = CoreDatasource(**_ds.model_dump())
                     self.chat_question.engine = (_ds.type_name if _ds.type != 'excel' else 'PostgreSQL') + get_version(
                         self.ds)
-                    self.chat_question.db_schema = get_table_schema(session=_session,
-                                                                    current_user=self.current_user, ds=self.ds,
-                                                                    question=self.chat_question.question)
                     _engine_type = self.chat_question.engine
                     _chat.engine_type = _ds.type_name
                 # save chat
@@ -521,41 +675,143 @@ class LLMService:
         except Exception as e:
             _error = e
 
-        if not ignore_auto_select and not settings.TABLE_EMBEDDING_ENABLED:
-            self.record = save_select_datasource_answer(session=_session, record_id=self.record.id,
-                                                        answer=orjson.dumps({'content': full_text}).decode(),
-                                                        datasource=_datasource,
-                                                        engine_type=_engine_type)
-        if self.ds:
+        return _datasource, _engine_type, _error
+
+    def add_sql_context_steps(self, graph: StepGraph, with_schema: bool, schema_embedding: bool = True,
+                              depends_on: List[str] = None, connection_after: List[str] = None):
+        """Steps loading the parts of the SQL prompt, they only depend on the datasource being resolved"""
+        depends_on = depends_on or []
+        question = self.chat_question.question
+
+        def _ds_ids():
             oid = self.ds.oid if isinstance(self.ds, CoreDatasource) else 1
             ds_id = self.ds.id if isinstance(self.ds, CoreDatasource) else None
+            return oid, ds_id
+
+        async def _terminologies():
+            oid, ds_id = _ds_ids()
+            return await run_blocking(run_in_session, get_terminology_template, question, oid, ds_id,
+                                      section_budget('terminologies'))
+
+        async def _data_training():
+            oid, ds_id = _ds_ids()
+            return await run_blocking(run_in_session, get_training_template, question, ds_id, oid,
+                                      section_budget('data_training'))
+
+        async def _custom_prompt():
+            oid, ds_id = _ds_ids()
+            return await run_blocking(run_in_session, find_custom_prompts, CustomPromptTypeEnum.GENERATE_SQL,
+                                      oid, ds_id)
+
+        async def _db_schema():
+            if self.out_ds_instance:
+                # the assistant returns the schema as one string, it can only be cut off
+                db_schema = await run_blocking(self.out_ds_instance.get_db_schema, self.ds.id, question)
+                return truncate_to_tokens(db_schema, section_budget('schema')) if section_budget('schema') \
+                    else db_schema
+            return await run_blocking(run_in_session, get_table_schema, current_user=self.current_user, ds=self.ds,
+                                      question=question, embedding=schema_embedding,
+                                      token_budget=section_budget('schema'))
+
+        async def _check_connection():
+            return await run_blocking(check_connection, ds=self.ds, trans=None)
+
+        async def _sql_cache():
+            if not self.sql_cache_usable():
+                return None
+            try:
+                return await run_blocking(run_in_session, self.lookup_sql_cache)
+            except Exception:
+                traceback.print_exc()
+                return None
 
-            self.chat_question.terminologies = get_terminology_template(_session, self.chat_question.question, oid,
-                                                                        ds_id)
-            self.chat_question.data_training = get_training_template(_session, self.chat_question.question, ds_id,
-                                                                     oid)
-            if SQLBotLicenseUtil.valid():
-                self.chat_question.custom_prompt = find_custom_prompts(_session, CustomPromptTypeEnum.GENERATE_SQL,
-                                                                       oid, ds_id)
-
-            self.init_messages()
+        graph.add('terminologies', _terminologies, depends_on)
+        graph.add('data_training', _data_training, depends_on)
+        if SQLBotLicenseUtil.valid():
+            graph.add('custom_prompt', _custom_prompt, depends_on)
+        if with_schema:
+            graph.add('db_schema', _db_schema, depends_on)
+        graph.add('check_connection', _check_connection, depends_on + (connection_after or []))
+        # whether the cache applies depends on the chat history and the last execution error
+        graph.add('sql_cache', _sql_cache,
+                  depends_on + [name for name in ['chat_logs', 'last_execute_sql_error'] if name in graph])
+
+    def apply_sql_context(self, results: Dict[str, Any]):
+        for name in ['terminologies', 'data_training', 'custom_prompt', 'db_schema']:
+            if name in results:
+                setattr(self.chat_question, name, results[name])
+        self.sql_cache_hit = results.get('sql_cache')
+        if not results.get('check_connection'):
+            raise SQLBotDBConnectionError('Connect DB failed')
+        self.init_messages()
+
+    def count_question_tokens(self):
+        self.prompt_tokens['question'] = estimate_tokens(self.sql_message[-1].content)
+        self.prompt_tokens['total'] = sum(estimate_tokens(msg.content) for msg in self.sql_message)
+        if settings.PROMPT_TOKEN_BUDGET > 0 and self.prompt_tokens['total'] > settings.PROMPT_TOKEN_BUDGET:
+            SQLBotLogUtil.warning(f'SQL提示词超出预算: {self.prompt_tokens}')
+
+    def sql_cache_usable(self) -> bool:
+        # only standalone questions, the SQL of a follow-up question depends on the conversation
+        return settings.SQL_CACHE_ENABLED and isinstance(self.ds, CoreDatasource) and not self.generate_sql_logs \
+            and not self.chat_question.error_msg
+
+    def lookup_sql_cache(self, session: Session) -> Optional[ChatSqlCache]:
+        self.sql_cache_key = get_schema_key(session, self.current_user, self.ds)
+        hit, self.sql_cache_embedding = find_cached_sql(session, self.ds.id, self.sql_cache_key,
+                                                        self.chat_question.question)
+        return hit
+
+    def save_sql_cache(self, session: Session, sql_answer: str, chart_type: Optional[str]):
+        try:
+            save_cached_sql(session, self.ds.oid, self.ds.id, self.sql_cache_key, self.chat_question.question,
+                            sql_answer, chart_type, self.sql_cache_embedding)
+        except Exception:
+            traceback.print_exc()
 
-        if _error:
-            raise _error
+    async def replay_cached_sql(self, _session: Session, sql_answer: str):
+        """Stands in for generate_sql on a sql cache hit, logged like a generation without reasoning and tokens"""
+        self.sql_message.append(HumanMessage(
+            self.chat_question.sql_user_question(current_time=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))))
+        self.count_question_tokens()
 
-    def generate_sql(self, _session: Session):
+        self.current_logs[OperationEnum.GENERATE_SQL] = await run_blocking(start_log, session=_session,
+                                                                           ai_modal_id=self.get_config(OperationEnum.GENERATE_SQL).model_id,
+                                                                           ai_modal_name=self.get_config(OperationEnum.GENERATE_SQL).model_name,
+                                                                           operate=OperationEnum.GENERATE_SQL,
+                                                                           record_id=self.record.id,
+                                                                           full_message=[
+                                                                               {'type': msg.type, 'content': msg.content}
+                                                                               for msg in self.sql_message],
+                                                                           prompt_tokens=self.prompt_tokens)
+        yield {'content': sql_answer, 'reasoning_content': ''}
+
+        self.sql_message.append(AIMessage(sql_answer))
+
+        self.current_logs[OperationEnum.GENERATE_SQL] = await run_blocking(end_log, session=_session,
+                                                                           log=self.current_logs[OperationEnum.GENERATE_SQL],
+                                                                           full_message=[{'type': msg.type, 'content': msg.content}
+                                                                                         for msg in self.sql_message],
+                                                                           reasoning_content='',
+                                                                           token_usage={})
+        self.record = await run_blocking(save_sql_answer, session=_session, record_id=self.record.id,
+                                         answer=orjson.dumps({'content': sql_answer}).decode())
+
+    async def generate_sql(self, _session: Session):
         # append current question
         self.sql_message.append(HumanMessage(
             self.chat_question.sql_user_question(current_time=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))))
+        self.count_question_tokens()
     
-        self.current_logs[OperationEnum.GENERATE_SQL] = start_log(session=_session,
-                                                                  ai_modal_id=self.chat_question.ai_modal_id,
-                                                                  ai_modal_name=self.chat_question.ai_modal_name,
-                                                                  operate=OperationEnum.GENERATE_SQL,
-                                                                  record_id=self.record.id,
-                                                                  full_message=[
-                                                                      {'type': msg.type, 'content': msg.content} for msg
-                                                                      in self.sql_message])
+        self.current_logs[OperationEnum.GENERATE_SQL] = await run_blocking(start_log, session=_session,
+                                                                                      ai_modal_id=self.get_config(OperationEnum.GENERATE_SQL).model_id,
+                                                                                      ai_modal_name=self.get_config(OperationEnum.GENERATE_SQL).model_name,
+                                                                                      operate=OperationEnum.GENERATE_SQL,
+                                                                                      record_id=self.record.id,
+                                                                                      full_message=[
+                                                                                          {'type': msg.type, 'content': msg.content} for msg
+                                                                                          in self.sql_message],
+                                                                                      prompt_tokens=self.prompt_tokens)
         full_thinking_text = ''
         full_sql_text = ''
         token_usage = {}
@@ -575,7 +831,7 @@ class LLMService:
                                                              self.current_user.account, self.current_user.oid, ds_id)
 
             final_result_data = None
-            for line in stream_response:
+            async for line in iterate_blocking(stream_response):
                 try:
                     data = orjson.loads(line)
                     event = data.get("event")
@@ -609,8 +865,8 @@ class LLMService:
                        'reasoning_content': '',}
         else:
             # 原始的 LLM 调用逻辑
-            res = process_stream(self.llm.stream(self.sql_message), token_usage)
-            for chunk in res:
+            res = self.stream_llm(OperationEnum.GENERATE_SQL, self.sql_message, token_usage)
+            async for chunk in res:
                 if chunk.get('content'):
                     full_sql_text += chunk.get('content')
                 if chunk.get('reasoning_content'):
@@ -619,15 +875,15 @@ class LLMService:
 
         self.sql_message.append(AIMessage(full_sql_text))
 
-        self.current_logs[OperationEnum.GENERATE_SQL] = end_log(session=_session,
-                                                                log=self.current_logs[OperationEnum.GENERATE_SQL],
-                                                                full_message=[{'type': msg.type, 'content': msg.content} for msg in self.sql_message],
-                                                                reasoning_content=full_thinking_text,
-                                                                token_usage=token_usage)
-        self.record = save_sql_answer(session=_session, record_id=self.record.id,
-                                      answer=orjson.dumps({'content': full_sql_text}).decode())
+        self.current_logs[OperationEnum.GENERATE_SQL] = await run_blocking(end_log, session=_session,
+                                                                                    log=self.current_logs[OperationEnum.GENERATE_SQL],
+                                                                                    full_message=[{'type': msg.type, 'content': msg.content} for msg in self.sql_message],
+                                                                                    reasoning_content=full_thinking_text,
+                                                                                    token_usage=token_usage)
+        self.record = await run_blocking(save_sql_answer, session=_session, record_id=self.record.id,
+                                                          answer=orjson.dumps({'content': full_sql_text}).decode())
 
-    def generate_with_sub_sql(self, session: Session, sql, sub_mappings: list):
+    async def generate_with_sub_sql(self, session: Session, sql, sub_mappings: list):
         sub_query = json.dumps(sub_mappings, ensure_ascii=False)
         self.chat_question.sql = sql
         self.chat_question.sub_query = sub_query
@@ -635,21 +891,21 @@ class LLMService:
         dynamic_sql_msg.append(SystemMessage(content=self.chat_question.dynamic_sys_question()))
         dynamic_sql_msg.append(HumanMessage(content=self.chat_question.dynamic_user_question()))
 
-        self.current_logs[OperationEnum.GENERATE_DYNAMIC_SQL] = start_log(session=session,
-                                                                          ai_modal_id=self.chat_question.ai_modal_id,
-                                                                          ai_modal_name=self.chat_question.ai_modal_name,
-                                                                          operate=OperationEnum.GENERATE_DYNAMIC_SQL,
-                                                                          record_id=self.record.id,
-                                                                          full_message=[{'type': msg.type,
-                                                                                         'content': msg.content}
-                                                                                        for
-                                                                                        msg in dynamic_sql_msg])
+        self.current_logs[OperationEnum.GENERATE_DYNAMIC_SQL] = await run_blocking(start_log, session=session,
+                                                                                              ai_modal_id=self.get_config(OperationEnum.GENERATE_DYNAMIC_SQL).model_id,
+                                                                                              ai_modal_name=self.get_config(OperationEnum.GENERATE_DYNAMIC_SQL).model_name,
+                                                                                              operate=OperationEnum.GENERATE_DYNAMIC_SQL,
+                                                                                              record_id=self.record.id,
+                                                                                              full_message=[{'type': msg.type,
+                                                                                                             'content': msg.content}
+                                                                                                            for
+                                                                                                            msg in dynamic_sql_msg])
 
         full_thinking_text = ''
         full_dynamic_text = ''
         token_usage = {}
-        res = process_stream(self.llm.stream(dynamic_sql_msg), token_usage)
-        for chunk in res:
+        res = self.stream_llm(OperationEnum.GENERATE_DYNAMIC_SQL, dynamic_sql_msg, token_usage)
+        async for chunk in res:
             if chunk.get('content'):
                 full_dynamic_text += chunk.get('content')
             if chunk.get('reasoning_content'):
@@ -657,20 +913,20 @@ class LLMService:
 
         dynamic_sql_msg.append(AIMessage(full_dynamic_text))
 
-        self.current_logs[OperationEnum.GENERATE_DYNAMIC_SQL] = end_log(session=session,
-                                                                        log=self.current_logs[
-                                                                            OperationEnum.GENERATE_DYNAMIC_SQL],
-                                                                        full_message=[
-                                                                            {'type': msg.type,
-                                                                             'content': msg.content}
-                                                                            for msg in dynamic_sql_msg],
-                                                                        reasoning_content=full_thinking_text,
-                                                                        token_usage=token_usage)
+        self.current_logs[OperationEnum.GENERATE_DYNAMIC_SQL] = await run_blocking(end_log, session=session,
+                                                                                            log=self.current_logs[
+                                                                                                OperationEnum.GENERATE_DYNAMIC_SQL],
+                                                                                            full_message=[
+                                                                                                {'type': msg.type,
+                                                                                                 'content': msg.content}
+                                                                                                for msg in dynamic_sql_msg],
+                                                                                            reasoning_content=full_thinking_text,
+                                                                                            token_usage=token_usage)
 
         SQLBotLogUtil.info(full_dynamic_text)
         return full_dynamic_text
 
-    def generate_assistant_dynamic_sql(self, _session: Session, sql, tables: List):
+    async def generate_assistant_dynamic_sql(self, _session: Session, sql, tables: List):
         ds: AssistantOutDsSchema = self.ds
         sub_query = []
         result_dict = {}
@@ -681,11 +937,11 @@ class LLMService:
                 sub_query.append({"table": table.name, "query": f'{dynamic_subsql_prefix}{table.name}'})
         if not sub_query:
             return None
-        temp_sql_text = self.generate_with_sub_sql(session=_session, sql=sql, sub_mappings=sub_query)
+        temp_sql_text = await self.generate_with_sub_sql(session=_session, sql=sql, sub_mappings=sub_query)
         result_dict['sqlbot_temp_sql_text'] = temp_sql_text
         return result_dict
 
-    def build_table_filter(self, session: Session, sql: str, filters: list):
+    async def build_table_filter(self, session: Session, sql: str, filters: list):
         filter = json.dumps(filters, ensure_ascii=False)
         self.chat_question.sql = sql
         self.chat_question.filter = filter
@@ -693,21 +949,21 @@ class LLMService:
         permission_sql_msg.append(SystemMessage(content=self.chat_question.filter_sys_question()))
         permission_sql_msg.append(HumanMessage(content=self.chat_question.filter_user_question()))
 
-        self.current_logs[OperationEnum.GENERATE_SQL_WITH_PERMISSIONS] = start_log(session=session,
-                                                                                   ai_modal_id=self.chat_question.ai_modal_id,
-                                                                                   ai_modal_name=self.chat_question.ai_modal_name,
-                                                                                   operate=OperationEnum.GENERATE_SQL_WITH_PERMISSIONS,
-                                                                                   record_id=self.record.id,
-                                                                                   full_message=[
-                                                                                       {'type': msg.type,
-                                                                                        'content': msg.content} for
-                                                                                       msg
-                                                                                       in permission_sql_msg])
+        self.current_logs[OperationEnum.GENERATE_SQL_WITH_PERMISSIONS] = await run_blocking(start_log, session=session,
+                                                                                                       ai_modal_id=self.get_config(OperationEnum.GENERATE_SQL_WITH_PERMISSIONS).model_id,
+                                                                                                       ai_modal_name=self.get_config(OperationEnum.GENERATE_SQL_WITH_PERMISSIONS).model_name,
+                                                                                                       operate=OperationEnum.GENERATE_SQL_WITH_PERMISSIONS,
+                                                                                                       record_id=self.record.id,
+                                                                                                       full_message=[
+                                                                                                           {'type': msg.type,
+                                                                                                            'content': msg.content} for
+                                                                                                           msg
+                                                                                                           in permission_sql_msg])
         full_thinking_text = ''
         full_filter_text = ''
         token_usage = {}
-        res = process_stream(self.llm.stream(permission_sql_msg), token_usage)
-        for chunk in res:
+        res = self.stream_llm(OperationEnum.GENERATE_SQL_WITH_PERMISSIONS, permission_sql_msg, token_usage)
+        async for chunk in res:
             if chunk.get('content'):
                 full_filter_text += chunk.get('content')
             if chunk.get('reasoning_content'):
@@ -715,27 +971,27 @@ class LLMService:
 
         permission_sql_msg.append(AIMessage(full_filter_text))
 
-        self.current_logs[OperationEnum.GENERATE_SQL_WITH_PERMISSIONS] = end_log(session=session,
-                                                                                 log=self.current_logs[
-                                                                                     OperationEnum.GENERATE_SQL_WITH_PERMISSIONS],
-                                                                                 full_message=[
-                                                                                     {'type': msg.type,
-                                                                                      'content': msg.content}
-                                                                                     for msg in permission_sql_msg],
-                                                                                 reasoning_content=full_thinking_text,
-                                                                                 token_usage=token_usage)
+        self.current_logs[OperationEnum.GENERATE_SQL_WITH_PERMISSIONS] = await run_blocking(end_log, session=session,
+                                                                                                     log=self.current_logs[
+                                                                                                         OperationEnum.GENERATE_SQL_WITH_PERMISSIONS],
+                                                                                                     full_message=[
+                                                                                                         {'type': msg.type,
+                                                                                                          'content': msg.content}
+                                                                                                         for msg in permission_sql_msg],
+                                                                                                     reasoning_content=full_thinking_text,
+                                                                                                     token_usage=token_usage)
 
         SQLBotLogUtil.info(full_filter_text)
         return full_filter_text
 
-    def generate_filter(self, _session: Session, sql: str, tables: List):
-        filters = get_row_permission_filters(session=_session, current_user=self.current_user, ds=self.ds,
-                                             tables=tables)
+    async def generate_filter(self, _session: Session, sql: str, tables: List):
+        filters = await run_blocking(get_row_permission_filters, session=_session, current_user=self.current_user,
+                                     ds=self.ds, tables=tables)
         if not filters:
             return None
-        return self.build_table_filter(session=_session, sql=sql, filters=filters)
+        return await self.build_table_filter(session=_session, sql=sql, filters=filters)
 
-    def generate_assistant_filter(self, _session: Session, sql, tables: List):
+    async def generate_assistant_filter(self, _session: Session, sql, tables: List):
         ds: AssistantOutDsSchema = self.ds
         filters = []
         for table in ds.tables:
@@ -743,21 +999,21 @@ class LLMService:
                 filters.append({"table": table.name, "filter": table.rule})
         if not filters:
             return None
-        return self.build_table_filter(session=_session, sql=sql, filters=filters)
+        return await self.build_table_filter(session=_session, sql=sql, filters=filters)
 
-    def generate_chart(self,_session: Session, chart_type: Optional[str] = '', enhanced_question: Optional[str] = ''):
+    async def generate_chart(self, _session: Session, chart_type: Optional[str] = '', enhanced_question: Optional[str] = ''):
         # append current question
         self.chart_message.append(HumanMessage(self.chat_question.chart_user_question(chart_type, enhanced_question)))
 
-        self.current_logs[OperationEnum.GENERATE_CHART] = start_log(session=_session,
-                                                                    ai_modal_id=self.chat_question.ai_modal_id,
-                                                                    ai_modal_name=self.chat_question.ai_modal_name,
-                                                                    operate=OperationEnum.GENERATE_CHART,
-                                                                    record_id=self.record.id,
-                                                                    full_message=[
-                                                                        {'type': msg.type, 'content': msg.content} for
-                                                                        msg
-                                                                        in self.chart_message])
+        self.current_logs[OperationEnum.GENERATE_CHART] = await run_blocking(start_log, session=_session,
+                                                                                        ai_modal_id=self.get_config(OperationEnum.GENERATE_CHART).model_id,
+                                                                                        ai_modal_name=self.get_config(OperationEnum.GENERATE_CHART).model_name,
+                                                                                        operate=OperationEnum.GENERATE_CHART,
+                                                                                        record_id=self.record.id,
+                                                                                        full_message=[
+                                                                                            {'type': msg.type, 'content': msg.content} for
+                                                                                            msg
+                                                                                            in self.chart_message])
         full_thinking_text = ''
         full_chart_text = ''
         token_usage = {}
@@ -765,8 +1021,8 @@ class LLMService:
         # 状态机: 'reasoning' -> 'content'
         parsing_state = 'reasoning'
         stop_marker = "```"
-        res = process_stream(self.llm.stream(self.chart_message), token_usage)
-        for chunk in res:
+        res = self.stream_llm(OperationEnum.GENERATE_CHART, self.chart_message, token_usage)
+        async for chunk in res:
             if chunk.get('content'):
                 full_chart_text += chunk.get('content')
             if chunk.get('reasoning_content'):
@@ -785,15 +1041,15 @@ class LLMService:
 
         self.chart_message.append(AIMessage(full_chart_text))
 
-        self.record = save_chart_answer(session=_session, record_id=self.record.id,
-                                        answer=orjson.dumps({'content': full_chart_text}).decode())
-        self.current_logs[OperationEnum.GENERATE_CHART] = end_log(session=_session,
-                                                                  log=self.current_logs[OperationEnum.GENERATE_CHART],
-                                                                  full_message=[
-                                                                      {'type': msg.type, 'content': msg.content}
-                                                                      for msg in self.chart_message],
-                                                                  reasoning_content=full_thinking_text,
-                                                                  token_usage=token_usage)
+        self.record = await run_blocking(save_chart_answer, session=_session, record_id=self.record.id,
+                                                            answer=orjson.dumps({'content': full_chart_text}).decode())
+        self.current_logs[OperationEnum.GENERATE_CHART] = await run_blocking(end_log, session=_session,
+                                                                                      log=self.current_logs[OperationEnum.GENERATE_CHART],
+                                                                                      full_message=[
+                                                                                          {'type': msg.type, 'content': msg.content}
+                                                                                          for msg in self.chart_message],
+                                                                                      reasoning_content=full_thinking_text,
+                                                                                      token_usage=token_usage)
 
     @staticmethod
     def check_sql(res: str) -> tuple[str, Optional[list]]:
@@ -947,7 +1203,7 @@ class LLMService:
     def save_error(self, session: Session, message: str):
         return save_error_message(session=session, record_id=self.record.id, message=message)
 
-    def transfer_sql_data(self,session: Session, sql_result: Dict[str, Any], sql_query: str):
+    async def transfer_sql_data(self,session: Session, sql_result: Dict[str, Any], sql_query: str):
         if not sql_result or not sql_result["data"]:
             SQLBotLogUtil.warning(
                 f"Calling transfer_sql_data without sql result")
@@ -958,8 +1214,8 @@ class LLMService:
         data_sample = sql_result["data"][0] if sql_result["data"] else {}
         for field_name in sql_result.get("fields", []):
             if isinstance(data_sample.get(field_name), (int, float)):
-                terminology_by_field_name = get_terminology_template(session, field_name,
-                                                                        self.current_user.oid, ds_id)
+                terminology_by_field_name = await run_blocking(get_terminology_template, session, field_name,
+                                                               self.current_user.oid, ds_id)
                 if terminology_by_field_name:
                     evidence_by_field_name = DataTransfer.format_terminologies_for_evidence(terminology_by_field_name)
                     if evidence_by_field_name:
@@ -970,15 +1226,15 @@ class LLMService:
                                                              sql_result=sql_result["data"],
                                                              evidence=",".join(filter(None, evidence_parts)))))
 
-        self.current_logs[OperationEnum.SQL_RESULT_TRANSFER] = start_log(session=session,
-                                                                  ai_modal_id=self.chat_question.ai_modal_id,
-                                                                  ai_modal_name=self.chat_question.ai_modal_name,
-                                                                  operate=OperationEnum.SQL_RESULT_TRANSFER,
-                                                                  record_id=self.record.id,
-                                                                  full_message=[
-                                                                      {'type': msg.type, 'content': msg.content} for msg
-                                                                      in self.data_transfer_message],
-                                                                  )
+        self.current_logs[OperationEnum.SQL_RESULT_TRANSFER] = await run_blocking(start_log, session=session,
+                                                                                      ai_modal_id=self.get_config(OperationEnum.SQL_RESULT_TRANSFER).model_id,
+                                                                                      ai_modal_name=self.get_config(OperationEnum.SQL_RESULT_TRANSFER).model_name,
+                                                                                      operate=OperationEnum.SQL_RESULT_TRANSFER,
+                                                                                      record_id=self.record.id,
+                                                                                      full_message=[
+                                                                                          {'type': msg.type, 'content': msg.content} for msg
+                                                                                          in self.data_transfer_message],
+                                                                                      )
         full_thinking_text = ''
         full_data_transfer_text = ''
         token_usage = {}
@@ -988,8 +1244,8 @@ class LLMService:
             retry_attempts -= 1
             full_data_transfer_text = ''
             full_thinking_text = ''
-            res = process_stream(self.llm.stream(self.data_transfer_message), token_usage)
-            for chunk in res:
+            res = self.stream_llm(OperationEnum.SQL_RESULT_TRANSFER, self.data_transfer_message, token_usage)
+            async for chunk in res:
                 if chunk.get('content'):
                     full_data_transfer_text += chunk.get('content')
                 if chunk.get('reasoning_content'):
@@ -1009,19 +1265,23 @@ class LLMService:
 
         self.data_transfer_message.append(AIMessage(full_data_transfer_text))
 
-        self.current_logs[OperationEnum.SQL_RESULT_TRANSFER] = end_log(session=session,
-                                                                log=self.current_logs[OperationEnum.SQL_RESULT_TRANSFER],
-                                                                full_message=[{'type': msg.type, 'content': msg.content}
-                                                                              for msg in self.data_transfer_message],
-                                                                reasoning_content=full_thinking_text,
-                                                                token_usage=token_usage)
-        self.record = save_sql_answer(session=session, record_id=self.record.id,
-                                      answer=orjson.dumps({'content': full_data_transfer_text}).decode())
+        self.current_logs[OperationEnum.SQL_RESULT_TRANSFER] = await run_blocking(end_log, session=session,
+                                                                                    log=self.current_logs[OperationEnum.SQL_RESULT_TRANSFER],
+                                                                                    full_message=[{'type': msg.type, 'content': msg.content}
+                                                                                                  for msg in self.data_transfer_message],
+                                                                                    reasoning_content=full_thinking_text,
+                                                                                    token_usage=token_usage)
+        self.record = await run_blocking(save_sql_answer, session=session, record_id=self.record.id,
+                                                          answer=orjson.dumps({'content': full_data_transfer_text}).decode())
 
         return sql_result
 
 
     def save_sql_data(self, session: Session, data_obj: Dict[str, Any]):
+        with trace_stage('save_sql_data'):
+            return self._save_sql_data(session, data_obj)
+
+    def _save_sql_data(self, session: Session, data_obj: Dict[str, Any]):
         try:
             data_result = data_obj.get('data')
             limit = 1000
@@ -1038,7 +1298,8 @@ class LLMService:
             raise e
 
     def finish(self, session: Session):
-        return finish_record(session=session, record_id=self.record.id)
+        with trace_stage('finish_record'):
+            return finish_record(session=session, record_id=self.record.id)
 
     def execute_sql(self, sql: str):
         """Execute SQL query
@@ -1051,6 +1312,7 @@ class LLMService:
             Query results
         """
         SQLBotLogUtil.info(f"Executing SQL on ds_id {self.ds.id}: {sql}")
+        start = time.perf_counter()
         try:
             return exec_sql(ds=self.ds, sql=sql, origin_column=False)
         except Exception as e:
@@ -1059,58 +1321,205 @@ class LLMService:
             else:
                 err = traceback.format_exc(limit=1, chain=True)
                 raise SQLBotDBError(err)
+        finally:
+            SQL_EXECUTION_SECONDS.observe(time.perf_counter() - start, ds_type=self.ds.type)
 
-    def pop_chunk(self):
+    def submit_task(self, fn, *args, coalesce: bool = True):
+        """
+        Run an async chunk generator as a task on the event loop, chunks are consumed by await_result.
+        Blocking steps inside the generator are offloaded with run_blocking, so the loop thread never waits on them.
+        With coalesce, text chunks produced within the SSE window are sent as one write.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.chunk_queue = asyncio.Queue()
+        self.coalesce = coalesce
+        self.task = self.loop.create_task(self._produce(fn, *args))
+        # keep a strong reference, the loop only holds weak references to its tasks
+        _running_tasks.add(self.task)
+        self.task.add_done_callback(_running_tasks.discard)
+
+    async def _produce(self, fn, *args):
         try:
-            chunk = self.chunk_list.pop(0)
-            return chunk
-        except IndexError as e:
-            return None
+            async for chunk in fn(*args):
+                self.put_chunk(chunk)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.put_chunk(_STREAM_END)
 
-    def await_result(self):
-        while self.is_running():
-            while True:
-                chunk = self.pop_chunk()
-                if chunk is not None:
-                    yield chunk
-                else:
-                    break
+    def put_chunk(self, chunk):
+        self.chunk_queue.put_nowait(chunk)
+
+    async def await_result(self):
+        window = settings.SSE_COALESCE_WINDOW_MS / 1000 if self.coalesce else 0
+        max_bytes = settings.SSE_COALESCE_MAX_BYTES
+        queue = self.chunk_queue
         while True:
-            chunk = self.pop_chunk()
-            if chunk is None:
+            chunk = await queue.get()
+            if chunk is _STREAM_END:
                 break
-            yield chunk
+            if window <= 0 or not isinstance(chunk, str):
+                self.count_sse(chunk)
+                yield chunk
+                continue
+
+            # 合并窗口内的SSE事件，一次写出
+            buffer = [chunk]
+            size = len(chunk)
+            if size < max_bytes and queue.empty():
+                await asyncio.sleep(window)
+            ended = False
+            while size < max_bytes and not queue.empty():
+                chunk = queue.get_nowait()
+                if chunk is _STREAM_END:
+                    ended = True
+                    break
+                if not isinstance(chunk, str):
+                    yield self.count_sse(''.join(buffer))
+                    buffer, size = [], 0
+                    yield chunk
+                    continue
+                buffer.append(chunk)
+                size += len(chunk)
+            if buffer:
+                yield self.count_sse(''.join(buffer))
+            if ended:
+                break
+
+    @staticmethod
+    def count_sse(chunk):
+        if isinstance(chunk, str) and chunk:
+            SSE_BYTES.inc(len(chunk.encode('utf-8')))
+            SSE_WRITES.inc()
+        return chunk
 
     def run_task_async(self, in_chat: bool = True, stream: bool = True,
                        finish_step: ChatFinishStep = ChatFinishStep.GENERATE_CHART):
         if in_chat:
             stream = True
-        self.future = executor.submit(self.run_task_cache, in_chat, stream, finish_step)
+        # the non streaming result is read as separate chunks
+        self.submit_task(self.run_task, in_chat, stream, finish_step, coalesce=stream)
+
+    def needs_sql_rewrite(self) -> bool:
+        """Whether the answered SQL goes through the row permission or dynamic datasource rewrite"""
+        use_dynamic_ds: bool = self.current_assistant and self.current_assistant.type in dynamic_ds_types
+        is_page_embedded: bool = self.current_assistant and self.current_assistant.type == 4
+        return bool(((not self.current_assistant or is_page_embedded) and is_normal_user(
+            self.current_user)) or use_dynamic_ds)
+
+    async def resolve_sql(self, _session: Session, answer: str) -> tuple[str, str]:
+        """Rewrites and saves the SQL of the answer, returns the saved SQL and the SQL to execute"""
+        use_dynamic_ds: bool = self.current_assistant and self.current_assistant.type in dynamic_ds_types
+        dynamic_sql_result = None
+        sqlbot_temp_sql_text = None
+        assistant_dynamic_sql = None
+        # row permission
+        if self.needs_sql_rewrite():
+            with trace_stage('sql_permission'):
+                sql, tables = self.check_sql(res=answer)
+                sql_result = None
 
-    def run_task_cache(self, in_chat: bool = True, stream: bool = True,
-                       finish_step: ChatFinishStep = ChatFinishStep.GENERATE_CHART):
-        for chunk in self.run_task(in_chat, stream, finish_step):
-            self.chunk_list.append(chunk)
+                if use_dynamic_ds:
+                    dynamic_sql_result = await self.generate_assistant_dynamic_sql(_session, sql, tables)
+                    sqlbot_temp_sql_text = dynamic_sql_result.get(
+                        'sqlbot_temp_sql_text') if dynamic_sql_result else None
+                    # sql_result = self.generate_assistant_filter(sql, tables)
+                else:
+                    sql_result = await self.generate_filter(_session, sql, tables)  # maybe no sql and tables
+
+                if sql_result:
+                    SQLBotLogUtil.info(sql_result)
+                    sql = await run_blocking(self.check_save_sql, session=_session, res=sql_result)
+                elif dynamic_sql_result and sqlbot_temp_sql_text:
+                    assistant_dynamic_sql = await run_blocking(self.check_save_sql, session=_session,
+                                                               res=sqlbot_temp_sql_text)
+                else:
+                    sql = await run_blocking(self.check_save_sql, session=_session, res=answer)
+        else:
+            sql = await run_blocking(self.check_save_sql, session=_session, res=answer)
+
+        # execute sql
+        real_execute_sql = sql
+        if sqlbot_temp_sql_text and assistant_dynamic_sql:
+            dynamic_sql_result.pop('sqlbot_temp_sql_text')
+            for origin_table, subsql in dynamic_sql_result.items():
+                assistant_dynamic_sql = assistant_dynamic_sql.replace(f'{dynamic_subsql_prefix}{origin_table}',
+                                                                      subsql)
+            real_execute_sql = assistant_dynamic_sql
+        return sql, real_execute_sql
+
+    async def resolve_early_sql(self, answer: str):
+        """Resolves the SQL while the rest of the answer is still streaming, with a session of its own"""
+        with Session(engine) as session:
+            return await self.resolve_sql(session, answer)
+
+    async def execute_early_sql(self, resolve_task: asyncio.Future):
+        """
+        Executes the SQL once resolve_task is done. An execution error is returned rather than raised, so it is
+        reported after the SQL like before. Cancelling it leaves the resolve step running.
+        """
+        _, real_execute_sql = await asyncio.shield(resolve_task)
+        execute_sql = time.time()
+        try:
+            result = await run_blocking(self.execute_sql, sql=real_execute_sql)
+        except Exception as e:
+            return None, e
+        SQLBotLogUtil.info(f"执行sql耗时 in {time.time() - execute_sql:.2f} seconds")
+        return result, None
+
+    @staticmethod
+    def discard_task(task: asyncio.Future):
+        # the worker thread of a running step cannot be stopped, only its result is dropped
+        task.cancel()
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    async def generate_and_check_chart(self, _session: Session, chart_type: Optional[str], enhanced_question: str,
+                                       in_chat: bool = True):
+        """Generates and validates the chart config with retries, yields the chart-result events and then the chart"""
+        max_retries = 3
+        chart = None
+        is_first_chart_attempt = True
+        chart_timer = StageTimer('generate_chart')
+        for attempt in range(max_retries):
+            try:
+                chart_res = self.generate_chart(_session, chart_type, enhanced_question)
+                full_chart_text = ''
+                async for chunk in chart_res:
+                    full_chart_text += chunk.get('content')
+                    if in_chat:
+                        reasoning_content = chunk.get('reasoning_content') if is_first_chart_attempt else ''
+                        yield 'data:' + orjson.dumps(
+                            {'content': chunk.get('content'), 'reasoning_content': reasoning_content,
+                             'type': 'chart-result'}).decode() + '\n\n'
+
+                is_first_chart_attempt = False  # 后续重试不再发送思考过程
+                if in_chat:
+                    yield 'data:' + orjson.dumps({'type': 'info', 'msg': 'chart generated'}).decode() + '\n\n'
 
-    def run_task(self, in_chat: bool = True, stream: bool = True,
-                 finish_step: ChatFinishStep = ChatFinishStep.GENERATE_CHART):
+                # filter chart
+                SQLBotLogUtil.info(full_chart_text)
+                chart = await run_blocking(self.check_save_chart, session=_session, res=full_chart_text)
+                SQLBotLogUtil.info(chart)
+                break  # 成功则跳出循环
+            except Exception as e:
+                SQLBotLogUtil.warning(f"Attempt {attempt + 1} to generate and validate chart failed: {e}")
+                if attempt + 1 >= max_retries:
+                    raise  # 最后一次尝试失败，则抛出异常
+        SQLBotLogUtil.info(f"Generating chart took {chart_timer.finish():.2f} seconds")
+        yield chart
+
+    async def run_task(self, in_chat: bool = True, stream: bool = True,
+                       finish_step: ChatFinishStep = ChatFinishStep.GENERATE_CHART):
         json_result: Dict[str, Any] = {'success': True}
         _session = None
+        early_resolve_task: Optional[asyncio.Future] = None
+        early_execute_task: Optional[asyncio.Future] = None
+        chart_task: Optional[asyncio.Future] = None
         start_time = time.time()
+        chat_timer = StageTimer('chat')
         try:
-            _session = session_maker()
-            if self.ds:
-                oid = self.ds.oid if isinstance(self.ds, CoreDatasource) else 1
-                ds_id = self.ds.id if isinstance(self.ds, CoreDatasource) else None
-                self.chat_question.terminologies = get_terminology_template(_session, self.chat_question.question,
-                                                                            oid, ds_id)
-                self.chat_question.data_training = get_training_template(_session, self.chat_question.question,
-                                                                         ds_id, oid)
-                if SQLBotLicenseUtil.valid():
-                    self.chat_question.custom_prompt = find_custom_prompts(_session,
-                                                                           CustomPromptTypeEnum.GENERATE_SQL,
-                                                                           oid, ds_id)
-                self.init_messages()
+            # a scoped session would be shared by every chat running on the event loop thread
+            _session = Session(engine)
 
             # return id
             if in_chat:
@@ -1118,23 +1527,49 @@ class LLMService:
             if not stream:
                 json_result['record_id'] = self.get_record().id
 
-            # return title
-            if self.change_title:
+            async def _rename_chat():
+                if not self.change_title:
+                    return None
                 if self.chat_question.question or self.chat_question.question.strip() != '':
-                    brief = rename_chat(session=_session,
-                                        rename_object=RenameChat(id=self.get_record().chat_id,
-                                                                 brief=self.chat_question.question.strip()[:20]))
-                    if in_chat:
-                        yield 'data:' + orjson.dumps({'type': 'brief', 'brief': brief}).decode() + '\n\n'
-                    if not stream:
-                        json_result['title'] = brief
+                    return await run_blocking(run_in_session, rename_chat,
+                                              RenameChat(id=self.get_record().chat_id,
+                                                         brief=self.chat_question.question.strip()[:20]))
+                return None
+
+            # 准备阶段：互不依赖的步骤并发执行，每个步骤使用独立的session
+            prepare = StepGraph('prepare')
+            prepare.add('chat_logs', functools.partial(run_blocking, run_in_session, self.load_chat_logs))
+            prepare.add('last_execute_sql_error',
+                        functools.partial(run_blocking, run_in_session, self.load_last_execute_sql_error))
+            prepare.add('rename_chat', _rename_chat, depends_on=['chat_logs'])
+            if self.chat_datasource:
+                prepare.add('datasource', functools.partial(run_blocking, run_in_session, self.load_datasource))
+                prepare.add('engine_version', functools.partial(run_blocking, self.load_engine_version),
+                            depends_on=['datasource'])
+                prepare.add('validate_ds', functools.partial(run_blocking, run_in_session, self.validate_history_ds),
+                            depends_on=['datasource'])
+                # an invalid datasource reports itself rather than a connection error
+                self.add_sql_context_steps(prepare, with_schema=True, schema_embedding=self.embedding,
+                                           depends_on=['datasource'], connection_after=['validate_ds'])
+            prepare_result = await prepare.run()
+            SQLBotLogUtil.info(f"准备阶段耗时 [{prepare.format_timings()}]")
+
+            # return title
+            if prepare_result.get('rename_chat') is not None:
+                brief = prepare_result['rename_chat']
+                if in_chat:
+                    yield 'data:' + orjson.dumps({'type': 'brief', 'brief': brief}).decode() + '\n\n'
+                if not stream:
+                    json_result['title'] = brief
 
+            if self.ds:
+                self.apply_sql_context(prepare_result)
+            else:
                 # select datasource if datasource is none
-            if not self.ds:
                 ds_res = self.select_datasource(_session)
 
-                for chunk in ds_res:
-                    SQLBotLogUtil.info(chunk)
+                async for chunk in ds_res:
+                    SQLBotLogUtil.debug(chunk)
                     if in_chat:
                         yield 'data:' + orjson.dumps(
                             {'content': chunk.get('content'), 'reasoning_content': chunk.get('reasoning_content'),
@@ -1144,38 +1579,50 @@ class LLMService:
                                                   'engine_type': self.ds.type_name or self.ds.type,
                                                   'type': 'datasource'}).decode() + '\n\n'
 
-                self.chat_question.db_schema = self.out_ds_instance.get_db_schema(
-                    self.ds.id, self.chat_question.question) if self.out_ds_instance else get_table_schema(
-                    session=_session,
-                    current_user=self.current_user,
-                    ds=self.ds,
-                    question=self.chat_question.question)
-            else:
-                self.validate_history_ds(_session)
-
-            # check connection
-            connected = check_connection(ds=self.ds, trans=None)
-            if not connected:
-                raise SQLBotDBConnectionError('Connect DB failed')
+                prepare = StepGraph('prepare_datasource')
+                self.add_sql_context_steps(prepare, with_schema=True)
+                prepare_result = await prepare.run()
+                SQLBotLogUtil.info(f"准备阶段耗时 [{prepare.format_timings()}]")
+                self.apply_sql_context(prepare_result)
 
             # generate sql
-            generate_sql=time.time()
-            sql_res = self.generate_sql(_session)
+            generate_sql = StageTimer('generate_sql')
+            if self.sql_cache_hit:
+                # 命中SQL缓存，跳过SQL生成
+                sql_res = self.replay_cached_sql(_session, self.sql_cache_hit.sql_answer)
+            else:
+                sql_res = self.generate_sql(_session)
             full_sql_text = ''
             enhanced_question = ''
-
-            for chunk in sql_res:
+            # 流式解析SQL答案，success为true且sql（以及改写所需的tables）完整、其后已有字段或答案结束时，
+            # 即开始改写与执行，不必等待其余字段
+            early_parser = StreamingJsonObjectParser() \
+                if finish_step.value > ChatFinishStep.GENERATE_SQL.value else None
+            needs_rewrite = self.needs_sql_rewrite()
+            early_answer = None
+
+            async for chunk in sql_res:
                 # 累加文本和增强问题
                 full_sql_text += chunk.get('content', '')
                 enhanced_question += chunk.get('enhanced_question', '')
 
+                if early_parser and early_resolve_task is None and chunk.get('content'):
+                    fields = early_parser.feed(chunk.get('content'))
+                    if fields.get('success') is True and isinstance(fields.get('sql'), str) and fields['sql'].strip() \
+                            and (not needs_rewrite or 'tables' in fields) \
+                            and (early_parser.done or list(fields).index('sql') < len(fields) - 1):
+                        early_answer = {'success': True, 'sql': fields['sql'], 'tables': fields.get('tables')}
+                        early_resolve_task = asyncio.ensure_future(
+                            self.resolve_early_sql(orjson.dumps(early_answer).decode()))
+                        early_execute_task = asyncio.ensure_future(self.execute_early_sql(early_resolve_task))
+
                 if in_chat:
                     # 对于思考过程或原始LLM的块，直接实时返回
                     yield 'data:' + orjson.dumps(
                         {'content': chunk.get('content'), 'reasoning_content': chunk.get('reasoning_content'),
                          'type': 'sql-result'}).decode() + '\n\n'
 
-            SQLBotLogUtil.info(f"生成sql耗时 in {time.time() - generate_sql:.2f} seconds")
+            SQLBotLogUtil.info(f"生成sql耗时 in {generate_sql.finish():.2f} seconds")
 
             if in_chat:
                 yield 'data:' + orjson.dumps({'type': 'info', 'msg': 'sql generated'}).decode() + '\n\n'
@@ -1191,7 +1638,7 @@ class LLMService:
                         yield 'data:' + orjson.dumps(
                             {'type': 'error', 'content': final_answer}).decode() + '\n\n'
                         yield 'data:' + orjson.dumps({'type': 'finish'}).decode() + '\n\n'
-                    self.save_error(session=_session, message=final_answer)
+                    await run_blocking(self.save_error, session=_session, message=final_answer)
                     return
 
             # filter sql
@@ -1199,34 +1646,27 @@ class LLMService:
 
             chart_type = self.get_chart_type_from_sql_answer(full_sql_text)
 
-            use_dynamic_ds: bool = self.current_assistant and self.current_assistant.type in dynamic_ds_types
-            is_page_embedded: bool = self.current_assistant and self.current_assistant.type == 4
-            dynamic_sql_result = None
-            sqlbot_temp_sql_text = None
-            assistant_dynamic_sql = None
-            # row permission
-            if ((not self.current_assistant or is_page_embedded) and is_normal_user(
-                    self.current_user)) or use_dynamic_ds:
-                sql, tables = self.check_sql(res=full_sql_text)
-                sql_result = None
-
-                if use_dynamic_ds:
-                    dynamic_sql_result = self.generate_assistant_dynamic_sql(_session, sql, tables)
-                    sqlbot_temp_sql_text = dynamic_sql_result.get(
-                        'sqlbot_temp_sql_text') if dynamic_sql_result else None
-                    # sql_result = self.generate_assistant_filter(sql, tables)
-                else:
-                    sql_result = self.generate_filter(_session, sql, tables)  # maybe no sql and tables
-
-                if sql_result:
-                    SQLBotLogUtil.info(sql_result)
-                    sql = self.check_save_sql(session=_session, res=sql_result)
-                elif dynamic_sql_result and sqlbot_temp_sql_text:
-                    assistant_dynamic_sql = self.check_save_sql(session=_session, res=sqlbot_temp_sql_text)
+            sql = None
+            early_result = None
+            if early_resolve_task is not None:
+                # 与完整答案核对，一致才采用提前执行的结果
+                try:
+                    final_sql, final_tables = self.check_sql(res=full_sql_text)
+                except SingleMessageError:
+                    final_sql, final_tables = None, None
+                if final_sql == early_answer['sql'] and (not needs_rewrite or final_tables == early_answer['tables']):
+                    sql, real_execute_sql = await early_resolve_task
+                    early_result = await early_execute_task
                 else:
-                    sql = self.check_save_sql(session=_session, res=full_sql_text)
-            else:
-                sql = self.check_save_sql(session=_session, res=full_sql_text)
+                    SQLBotLogUtil.warning('流式解析的SQL与最终答案不一致，按完整答案重新处理')
+                    # its query result is not needed, only wait until its SQL is saved so it is not saved after
+                    # the final one
+                    self.discard_task(early_execute_task)
+                    await asyncio.gather(early_resolve_task, return_exceptions=True)
+                early_resolve_task = None
+                early_execute_task = None
+            if sql is None:
+                sql, real_execute_sql = await self.resolve_sql(_session, full_sql_text)
 
             SQLBotLogUtil.info('sql: ' + sql)
 
@@ -1240,15 +1680,6 @@ class LLMService:
                 if stream:
                     yield f'```sql\n{format_sql}\n```\n\n'
 
-            # execute sql
-            real_execute_sql = sql
-            if sqlbot_temp_sql_text and assistant_dynamic_sql:
-                dynamic_sql_result.pop('sqlbot_temp_sql_text')
-                for origin_table, subsql in dynamic_sql_result.items():
-                    assistant_dynamic_sql = assistant_dynamic_sql.replace(f'{dynamic_subsql_prefix}{origin_table}',
-                                                                          subsql)
-                real_execute_sql = assistant_dynamic_sql
-
             if finish_step.value <= ChatFinishStep.GENERATE_SQL.value:
                 if in_chat:
                     yield 'data:' + orjson.dumps({'type': 'finish'}).decode() + '\n\n'
@@ -1256,13 +1687,36 @@ class LLMService:
                     yield json_result
                 return
 
-            execute_sql=time.time()
-            result = self.execute_sql(sql=real_execute_sql)
-            SQLBotLogUtil.info(f"执行sql耗时 in {time.time() - execute_sql:.2f} seconds")
+            if finish_step.value > ChatFinishStep.QUERY_DATA.value:
+                # the chart only needs the sql, question and chart type, generate it while the sql runs
+                chart_chunks = asyncio.Queue()
+
+                async def _produce_chart():
+                    try:
+                        with Session(engine) as chart_session:
+                            async for item in self.generate_and_check_chart(chart_session, chart_type,
+                                                                            enhanced_question, in_chat):
+                                chart_chunks.put_nowait(item)
+                    finally:
+                        chart_chunks.put_nowait(_STREAM_END)
+
+                chart_task = asyncio.ensure_future(_produce_chart())
+
+            if early_result is not None:
+                result, execute_error = early_result
+                if execute_error is not None:
+                    raise execute_error
+            else:
+                execute_sql=time.time()
+                result = await run_blocking(self.execute_sql, sql=real_execute_sql)
+                SQLBotLogUtil.info(f"执行sql耗时 in {time.time() - execute_sql:.2f} seconds")
             save_sql_data = time.time()
             #result = self.transfer_sql_data(session=_session, sql_result=result, sql_query=real_execute_sql)
             SQLBotLogUtil.info(f"转换sql结果耗时 in {time.time() - save_sql_data:.2f} seconds")
-            self.save_sql_data(session=_session, data_obj=result)
+            await run_blocking(self.save_sql_data, session=_session, data_obj=result)
+            if self.sql_cache_key and not self.sql_cache_hit:
+                # SQL执行成功，写入SQL缓存
+                await run_blocking(run_in_session, self.save_sql_cache, full_sql_text, chart_type)
             if in_chat:
                 yield 'data:' + orjson.dumps({'content': 'execute-success', 'type': 'sql-data'}).decode() + '\n\n'
             if not stream:
@@ -1315,36 +1769,18 @@ class LLMService:
             # chart = self.check_save_chart(session=_session, res=full_chart_text)
             # SQLBotLogUtil.info(f"保存chart结果耗时 in {time.time() - check_save_chart:.2f} seconds")
             # SQLBotLogUtil.info(chart)
-            max_retries = 3
+            # 图表配置与SQL执行并发生成，此处汇合，事件顺序与串行执行时一致
             chart = None
-            is_first_chart_attempt = True
-            generate_chart_start_time = time.time()
-            for attempt in range(max_retries):
-                try:
-                    chart_res = self.generate_chart(_session, chart_type, enhanced_question)
-                    full_chart_text = ''
-                    for chunk in chart_res:
-                        full_chart_text += chunk.get('content')
-                        if in_chat:
-                            reasoning_content = chunk.get('reasoning_content') if is_first_chart_attempt else ''
-                            yield 'data:' + orjson.dumps(
-                                {'content': chunk.get('content'), 'reasoning_content': reasoning_content,
-                                 'type': 'chart-result'}).decode() + '\n\n'
-
-                    is_first_chart_attempt = False  # 后续重试不再发送思考过程
-                    if in_chat:
-                        yield 'data:' + orjson.dumps({'type': 'info', 'msg': 'chart generated'}).decode() + '\n\n'
-
-                    # filter chart
-                    SQLBotLogUtil.info(full_chart_text)
-                    chart = self.check_save_chart(session=_session, res=full_chart_text)
-                    SQLBotLogUtil.info(chart)
-                    break  # 成功则跳出循环
-                except Exception as e:
-                    SQLBotLogUtil.warning(f"Attempt {attempt + 1} to generate and validate chart failed: {e}")
-                    if attempt + 1 >= max_retries:
-                        raise  # 最后一次尝试失败，则抛出异常
-            SQLBotLogUtil.info(f"Generating chart took {time.time() - generate_chart_start_time:.2f} seconds")
+            while True:
+                item = await chart_chunks.get()
+                if item is _STREAM_END:
+                    break
+                if isinstance(item, str):
+                    yield item
+                else:
+                    chart = item
+            await chart_task
+            chart_task = None
             if not stream:
                 json_result['chart'] = chart
 
@@ -1391,7 +1827,7 @@ class LLMService:
                 # todo generate picture
                 if chart['type'] != 'table':
                     yield '### generated chart picture\n\n'
-                    image_url = request_picture(self.record.chat_id, self.record.id, chart, result)
+                    image_url = await run_blocking(request_picture, self.record.chat_id, self.record.id, chart, result)
                     SQLBotLogUtil.info(image_url)
                     if stream:
                         yield f'![{chart["type"]}]({image_url})'
@@ -1415,7 +1851,7 @@ class LLMService:
             else:
                 error_msg = orjson.dumps({'message': str(e), 'traceback': traceback.format_exc(limit=1)}).decode()
             if _session:
-                self.save_error(session=_session, message=error_msg)
+                await run_blocking(self.save_error, session=_session, message=error_msg)
             if in_chat:
                 yield 'data:' + orjson.dumps({'content': error_msg, 'type': 'error'}).decode() + '\n\n'
                 # 流式结束后，也发送 finish 信号
@@ -1428,22 +1864,30 @@ class LLMService:
                     json_result['message'] = error_msg
                     yield orjson.dumps(json_result).decode()
         finally:
-            self.finish(_session)
-            session_maker.remove()
+            if early_execute_task is not None:
+                # the answer failed or was refused before the early execution was used
+                self.discard_task(early_execute_task)
+            if early_resolve_task is not None:
+                self.discard_task(early_resolve_task)
+            if chart_task is not None:
+                # the sql failed, its chart is not needed
+                self.discard_task(chart_task)
+            if _session:
+                await run_blocking(self.finish, _session)
+                _session.close()
+            chat_timer.finish()
 
     def run_recommend_questions_task_async(self):
-        self.future = executor.submit(self.run_recommend_questions_task_cache)
-
-    def run_recommend_questions_task_cache(self):
-        for chunk in self.run_recommend_questions_task():
-            self.chunk_list.append(chunk)
+        self.submit_task(self.run_recommend_questions_task)
 
-    def run_recommend_questions_task(self):
+    async def run_recommend_questions_task(self):
+        _session = None
         try:
-            _session = session_maker()
+            _session = Session(engine)
+            await run_blocking(self.load_datasource, _session)
             res = self.generate_recommend_questions_task(_session)
 
-            for chunk in res:
+            async for chunk in res:
                 if chunk.get('recommended_question'):
                     yield 'data:' + orjson.dumps(
                         {'content': chunk.get('recommended_question'),
@@ -1455,26 +1899,24 @@ class LLMService:
         except Exception:
             traceback.print_exc()
         finally:
-            session_maker.remove()
+            if _session:
+                _session.close()
 
     def run_analysis_or_predict_task_async(self, session: Session, action_type: str, base_record: ChatRecord):
         self.set_record(save_analysis_predict_record(session, base_record, action_type))
-        self.future = executor.submit(self.run_analysis_or_predict_task_cache, action_type)
-
-    def run_analysis_or_predict_task_cache(self, action_type: str):
-        for chunk in self.run_analysis_or_predict_task(action_type):
-            self.chunk_list.append(chunk)
+        self.submit_task(self.run_analysis_or_predict_task, action_type)
 
-    def run_analysis_or_predict_task(self, action_type: str):
+    async def run_analysis_or_predict_task(self, action_type: str):
         _session = None
         try:
-            _session = session_maker()
+            _session = Session(engine)
             yield 'data:' + orjson.dumps({'type': 'id', 'id': self.get_record().id}).decode() + '\n\n'
+            await run_blocking(self.load_datasource, _session)
 
             if action_type == 'analysis':
                 # generate analysis
                 analysis_res = self.generate_analysis(_session)
-                for chunk in analysis_res:
+                async for chunk in analysis_res:
                     yield 'data:' + orjson.dumps(
                         {'content': chunk.get('content'), 'reasoning_content': chunk.get('reasoning_content'),
                          'type': 'analysis-result'}).decode() + '\n\n'
@@ -1486,14 +1928,14 @@ class LLMService:
                 # generate predict
                 analysis_res = self.generate_predict(_session)
                 full_text = ''
-                for chunk in analysis_res:
+                async for chunk in analysis_res:
                     yield 'data:' + orjson.dumps(
                         {'content': chunk.get('content'), 'reasoning_content': chunk.get('reasoning_content'),
                          'type': 'predict-result'}).decode() + '\n\n'
                     full_text += chunk.get('content')
                 yield 'data:' + orjson.dumps({'type': 'info', 'msg': 'predict generated'}).decode() + '\n\n'
 
-                _data = self.check_save_predict_data(session=_session, res=full_text)
+                _data = await run_blocking(self.check_save_predict_data, session=_session, res=full_text)
                 if _data:
                     yield 'data:' + orjson.dumps({'type': 'predict-success'}).decode() + '\n\n'
                 else:
@@ -1501,7 +1943,7 @@ class LLMService:
 
                 yield 'data:' + orjson.dumps({'type': 'predict_finish'}).decode() + '\n\n'
 
-            self.finish(_session)
+            await run_blocking(self.finish, _session)
         except Exception as e:
             error_msg: str
             if isinstance(e, SingleMessageError):
@@ -1509,11 +1951,12 @@ class LLMService:
             else:
                 error_msg = orjson.dumps({'message': str(e), 'traceback': traceback.format_exc(limit=1)}).decode()
             if _session:
-                self.save_error(session=_session, message=error_msg)
+                await run_blocking(self.save_error, session=_session, message=error_msg)
             yield 'data:' + orjson.dumps({'content': error_msg, 'type': 'error'}).decode() + '\n\n'
         finally:
             # end
-            session_maker.remove()
+            if _session:
+                _session.close()
 
     def validate_history_ds(self, session: Session):
         _ds = self.ds
@@ -1610,63 +2053,64 @@ def get_token_usage(chunk: BaseMessageChunk, token_usage: dict = None):
         pass
 
 
-def process_stream(res: Iterator[BaseMessageChunk],
-                   token_usage: Dict[str, Any] = None,
-                   enable_tag_parsing: bool = settings.PARSE_REASONING_BLOCK_ENABLED,
-                   start_tag: str = settings.DEFAULT_REASONING_CONTENT_START,
-                   end_tag: str = settings.DEFAULT_REASONING_CONTENT_END
-                   ):
-    if token_usage is None:
-        token_usage = {}
-    in_thinking_block = False  # 标记是否在思考过程块中
-    current_thinking = ''  # 当前收集的思考过程内容
-    pending_start_tag = ''  # 用于缓存可能被截断的开始标签部分
+class ReasoningStreamParser:
+    """
+    Splits LLM chunks into content and reasoning content, shared by the sync and async stream processing.
 
-    for chunk in res:
-        SQLBotLogUtil.info(chunk)
-        reasoning_content_chunk = ''
+    A single pass state machine: reasoning either arrives in additional_kwargs (then tags are not parsed) or
+    inside start/end tags at the beginning of the answer. Every chunk is scanned once, nothing is re-scanned.
+    """
+
+    def __init__(self, token_usage: Dict[str, Any],
+                 enable_tag_parsing: bool = settings.PARSE_REASONING_BLOCK_ENABLED,
+                 start_tag: str = settings.DEFAULT_REASONING_CONTENT_START,
+                 end_tag: str = settings.DEFAULT_REASONING_CONTENT_END):
+        self.token_usage = token_usage
+        self.enable_tag_parsing = enable_tag_parsing
+        self.start_tag = start_tag
+        self.end_tag = end_tag
+        self.in_thinking_block = False  # 标记是否在思考过程块中
+        self.has_reasoning = False  # additional_kwargs中是否已收到非空的思考内容
+        self.pending_start_tag = ''  # 用于缓存可能被截断的开始标签部分
+        self.pending_end_tag = ''  # 用于缓存可能被截断的结束标签部分
+        self.debug = _logger.isEnabledFor(logging.DEBUG)
+
+    def feed(self, chunk: BaseMessageChunk) -> Dict[str, str]:
+        if self.debug:
+            SQLBotLogUtil.debug(chunk)
+        start_tag, end_tag = self.start_tag, self.end_tag
+        reasoning_parts = []
         content = chunk.content
-        output_content = ''  # 实际要输出的内容
 
         # 检查additional_kwargs中的reasoning_content
         if 'reasoning_content' in chunk.additional_kwargs:
-            reasoning_content = chunk.additional_kwargs.get('reasoning_content', '')
-            if reasoning_content is None:
-                reasoning_content = ''
-
-            # 累积additional_kwargs中的思考内容到current_thinking
-            current_thinking += reasoning_content
-            reasoning_content_chunk = reasoning_content
-
-        # 只有当current_thinking不是空字符串时才跳过标签解析
-        if not in_thinking_block and current_thinking.strip() != '':
-            output_content = content  # 正常输出content
-            yield {
-                'content': output_content,
-                'reasoning_content': reasoning_content_chunk
-            }
-            get_token_usage(chunk, token_usage)
-            continue  # 跳过后续的标签解析逻辑
-
-        # 如果没有有效的思考内容，并且启用了标签解析，才执行标签解析逻辑
+            reasoning_content = chunk.additional_kwargs.get('reasoning_content') or ''
+            if not self.has_reasoning and reasoning_content.strip():
+                self.has_reasoning = True
+            reasoning_parts.append(reasoning_content)
+
+        # 已有思考内容时跳过标签解析，正常输出content
+        if not self.in_thinking_block and self.has_reasoning:
+            get_token_usage(chunk, self.token_usage)
+            return {'content': content, 'reasoning_content': ''.join(reasoning_parts)}
+
+        output_parts = []  # 实际要输出的内容
         # 如果有缓存的开始标签部分，先拼接当前内容
-        if pending_start_tag:
-            content = pending_start_tag + content
-            pending_start_tag = ''
+        if self.pending_start_tag:
+            content = self.pending_start_tag + content
+            self.pending_start_tag = ''
 
         # 检查是否开始思考过程块（处理可能被截断的开始标签）
-        if enable_tag_parsing and not in_thinking_block and start_tag:
-            if start_tag in content:
-                start_idx = content.index(start_tag)
+        if self.enable_tag_parsing and not self.in_thinking_block and start_tag:
+            start_idx = content.find(start_tag)
+            if start_idx >= 0:
                 # 只有当开始标签前面没有其他文本时才认为是真正的思考块开始
                 if start_idx == 0 or content[:start_idx].strip() == '':
-                    # 完整标签存在且前面没有其他文本
-                    output_content += content[:start_idx]  # 输出开始标签之前的内容
-                    content = content[start_idx + len(start_tag):]  # 移除开始标签
-                    in_thinking_block = True
+                    output_parts.append(content[:start_idx])
+                    content = content[start_idx + len(start_tag):]
+                    self.in_thinking_block = True
                 else:
-                    # 开始标签前面有其他文本，不认为是思考块开始
-                    output_content += content
+                    output_parts.append(content)
                     content = ''
             else:
                 # 检查是否可能有部分开始标签
@@ -1674,38 +2118,78 @@ def process_stream(res: Iterator[BaseMessageChunk],
                     if content.endswith(start_tag[:i]):
                         # 只有当当前内容全是空白时才缓存部分标签
                         if content[:-i].strip() == '':
-                            pending_start_tag = start_tag[:i]
-                            content = content[:-i]  # 移除可能的部分标签
-                            output_content += content
+                            self.pending_start_tag = start_tag[:i]
+                            output_parts.append(content[:-i])
                             content = ''
                         break
 
         # 处理思考块内容
-        if enable_tag_parsing and in_thinking_block and end_tag:
-            if end_tag in content:
-                # 找到结束标签
-                end_idx = content.index(end_tag)
-                current_thinking += content[:end_idx]  # 收集思考内容
-                reasoning_content_chunk += current_thinking  # 添加到当前块的思考内容
-                content = content[end_idx + len(end_tag):]  # 移除结束标签后的内容
-                current_thinking = ''  # 重置当前思考内容
-                in_thinking_block = False
-                output_content += content  # 输出结束标签之后的内容
+        if self.enable_tag_parsing and self.in_thinking_block and end_tag:
+            if self.pending_end_tag:
+                content = self.pending_end_tag + content
+                self.pending_end_tag = ''
+            end_idx = content.find(end_tag)
+            if end_idx >= 0:
+                # 找到结束标签，之后的内容正常输出
+                reasoning_parts.append(content[:end_idx])
+                output_parts.append(content[end_idx + len(end_tag):])
+                self.in_thinking_block = False
             else:
-                # 在遇到结束标签前，持续收集思考内容
-                current_thinking += content
-                reasoning_content_chunk += content
-                content = ''
-
+                # 在遇到结束标签前，持续输出思考内容，可能被截断的结束标签留到下一块
+                for i in range(len(end_tag) - 1, 0, -1):
+                    if content.endswith(end_tag[:i]):
+                        self.pending_end_tag = end_tag[:i]
+                        content = content[:-i]
+                        break
+                reasoning_parts.append(content)
         else:
             # 不在思考块中或标签解析未启用，正常输出
-            output_content += content
+            output_parts.append(content)
 
-        yield {
-            'content': output_content,
-            'reasoning_content': reasoning_content_chunk
+        get_token_usage(chunk, self.token_usage)
+        return {
+            'content': ''.join(output_parts),
+            'reasoning_content': ''.join(reasoning_parts)
         }
-        get_token_usage(chunk, token_usage)
+
+    def flush(self) -> Optional[Dict[str, str]]:
+        """Emits the partial tag still buffered when the stream ends, it turned out not to be a tag"""
+        content, reasoning_content = self.pending_start_tag, self.pending_end_tag
+        self.pending_start_tag = ''
+        self.pending_end_tag = ''
+        if not content and not reasoning_content:
+            return None
+        return {'content': content, 'reasoning_content': reasoning_content}
+
+
+def process_stream(res: Iterator[BaseMessageChunk],
+                   token_usage: Dict[str, Any] = None,
+                   enable_tag_parsing: bool = settings.PARSE_REASONING_BLOCK_ENABLED,
+                   start_tag: str = settings.DEFAULT_REASONING_CONTENT_START,
+                   end_tag: str = settings.DEFAULT_REASONING_CONTENT_END
+                   ):
+    parser = ReasoningStreamParser({} if token_usage is None else token_usage, enable_tag_parsing, start_tag,
+                                   end_tag)
+    for chunk in res:
+        yield parser.feed(chunk)
+    rest = parser.flush()
+    if rest is not None:
+        yield rest
+
+
+async def aprocess_stream(res: AsyncIterator[BaseMessageChunk],
+                          token_usage: Dict[str, Any] = None,
+                          enable_tag_parsing: bool = settings.PARSE_REASONING_BLOCK_ENABLED,
+                          start_tag: str = settings.DEFAULT_REASONING_CONTENT_START,
+                          end_tag: str = settings.DEFAULT_REASONING_CONTENT_END
+                          ):
+    parser = ReasoningStreamParser({} if token_usage is None else token_usage, enable_tag_parsing, start_tag,
+                                   end_tag)
+    async for chunk in res:
+        yield parser.feed(chunk)
+    rest = parser.flush()
+    if rest is not None:
+        yield rest
 
 
 def get_lang_name(lang: str):
@@ -0,0 +1,45 @@
+from typing import Any, Dict, List, Optional
+
+from common.core.config import settings
+from common.utils.utils import estimate_tokens, truncate_to_tokens
+
+# sections trimmed where they are loaded, so every one of them is cut by its own relevance order
+SECTION_BUDGETS = {
+    'schema': 'PROMPT_SCHEMA_TOKEN_BUDGET',
+    'terminologies': 'PROMPT_TERMINOLOGY_TOKEN_BUDGET',
+    'data_training': 'PROMPT_DATA_TRAINING_TOKEN_BUDGET',
+    'error_msg': 'PROMPT_ERROR_MSG_TOKEN_BUDGET',
+    'history': 'PROMPT_HISTORY_TOKEN_BUDGET',
+}
+
+
+def section_budget(section: str) -> int:
+    """Token budget of one prompt section, 0 (no limit) while prompt budgets are disabled"""
+    if settings.PROMPT_TOKEN_BUDGET <= 0:
+        return 0
+    return max(getattr(settings, SECTION_BUDGETS[section]), 0)
+
+
+def trim_error_msg(error_msg: str) -> str:
+    budget = section_budget('error_msg')
+    # the head of a database error carries the message, the tail is mostly the statement and stack
+    return truncate_to_tokens(error_msg, budget) if budget else error_msg
+
+
+def trim_history(messages: List[Dict[str, Any]], max_tokens: int) -> List[Dict[str, Any]]:
+    """Drops the oldest history messages until the rest fits max_tokens, a trimmed history starts with a question"""
+    kept = list(messages)
+    total = sum(estimate_tokens(msg.get('content')) for msg in kept)
+    if total <= max_tokens:
+        return kept
+    while kept and (total > max_tokens or kept[0].get('type') != 'human'):
+        total -= estimate_tokens(kept.pop(0).get('content'))
+    return kept
+
+
+def history_budget(fixed_tokens: int) -> Optional[int]:
+    """What is left for the history next to the other sections within its own budget, None without a limit"""
+    budget = section_budget('history')
+    if not budget:
+        return None
+    return max(min(budget, settings.PROMPT_TOKEN_BUDGET - fixed_tokens), 0)
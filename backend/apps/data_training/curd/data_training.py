@@ -1,20 +1,24 @@
 import datetime
 import logging
+import time
 import traceback
 from typing import List, Optional
 from xml.dom.minidom import parseString
 
 import dicttoxml
-from sqlalchemy import and_, select, func, delete, update, or_
+from sqlalchemy import and_, select, func, delete, update
 from sqlalchemy import text
 
 from apps.ai_model.embedding import EmbeddingModelCache
+from apps.data_training.curd.retriever import data_training_retriever
 from apps.data_training.models.data_training_model import DataTrainingInfo, DataTraining
 from apps.datasource.models.datasource import CoreDatasource
 from apps.template.generate_chart.generator import get_base_data_training_template
 from common.core.config import settings
 from common.core.deps import SessionDep, Trans
-from common.utils.embedding_threads import run_save_data_training_embeddings
+from common.utils.embedding_threads import run_save_data_training_embeddings, scan_id_pages
+from common.utils.ngram_index import reciprocal_rank_fusion
+from common.utils.utils import SQLBotLogUtil, batched, estimate_tokens
 
 
 def page_data_training(session: SessionDep, current_page: int = 1, page_size: int = 10, name: Optional[str] = None,
@@ -106,6 +110,7 @@ def create_training(session: SessionDep, info: DataTrainingInfo, oid: int, trans
 
     result.id = parent.id
     session.commit()
+    data_training_retriever.invalidate(oid)
 
     # embedding
     run_save_data_training_embeddings([result.id])
@@ -138,6 +143,7 @@ def update_training(session: SessionDep, info: DataTrainingInfo, oid: int, trans
     )
     session.execute(stmt)
     session.commit()
+    data_training_retriever.invalidate(oid)
 
     # embedding
     run_save_data_training_embeddings([info.id])
@@ -146,9 +152,12 @@ def update_training(session: SessionDep, info: DataTrainingInfo, oid: int, trans
 
 
 def delete_training(session: SessionDep, ids: list[int]):
+    oids = session.execute(select(DataTraining.oid).where(DataTraining.id.in_(ids)).distinct()).scalars().all()
     stmt = delete(DataTraining).where(and_(DataTraining.id.in_(ids)))
     session.execute(stmt)
     session.commit()
+    for oid in oids:
+        data_training_retriever.invalidate(oid)
 
 
 # def run_save_embeddings(ids: List[int]):
@@ -165,10 +174,12 @@ def run_fill_empty_embeddings(session_maker):
             return
 
         session = session_maker()
-        stmt = select(DataTraining.id).where(and_(DataTraining.embedding.is_(None)))
-        results = session.execute(stmt).scalars().all()
-
-        save_embeddings(session_maker, results)
+        total = 0
+        for ids in scan_id_pages(session, DataTraining.id, DataTraining.embedding.is_(None)):
+            # the scan itself is repeated on startup, no need to persist the ids as jobs
+            run_save_data_training_embeddings(ids, persist=False)
+            total += len(ids)
+        SQLBotLogUtil.info(f'data training embedding backfill queued: {total}')
     except Exception:
         traceback.print_exc()
     finally:
@@ -182,23 +193,32 @@ def save_embeddings(session_maker, ids: List[int]):
     if not ids or len(ids) == 0:
         return
     try:
+        start_time = time.time()
+        total = 0
         session = session_maker()
-        _list = session.query(DataTraining).filter(and_(DataTraining.id.in_(ids))).all()
-
-        _question_list = [item.question for item in _list]
-
         model = EmbeddingModelCache.get_model()
 
-        results = model.embed_documents(_question_list)
+        for batch_ids in batched(list(ids), settings.EMBEDDING_BATCH_SIZE):
+            _list = session.query(DataTraining.id, DataTraining.question).filter(
+                and_(DataTraining.id.in_(batch_ids))).all()
+            if not _list:
+                continue
 
-        for index in range(len(results)):
-            item = results[index]
-            stmt = update(DataTraining).where(and_(DataTraining.id == _list[index].id)).values(embedding=item)
-            session.execute(stmt)
+            results = model.embed_documents([item.question for item in _list])
+
+            # bulk UPDATE by primary key, executed as one executemany per batch
+            session.execute(update(DataTraining),
+                            [{'id': _list[index].id, 'embedding': results[index]} for index in range(len(results))])
             session.commit()
+            total += len(results)
 
-    except Exception:
+        cost = time.time() - start_time
+        SQLBotLogUtil.info(f'data training embedding: {total} rows in {cost:.2f} seconds '
+                           f'({total / cost if cost > 0 else 0:.1f} rows/s)')
+
+    except Exception as e:
         traceback.print_exc()
+        raise e
     finally:
         session_maker.remove()
 
@@ -220,25 +240,9 @@ def select_training_by_question(session: SessionDep, question: str, oid: int, da
     if question.strip() == "":
         return []
 
-    _list: List[DataTraining] = []
-
-    # maybe use label later?
-    stmt = (
-        select(
-            DataTraining.id,
-            DataTraining.question,
-        )
-        .where(
-            and_(or_(text(":sentence ILIKE '%' || question || '%'"), text("question ILIKE '%' || :sentence || '%'")),
-                 DataTraining.oid == oid,
-                 DataTraining.datasource == datasource)
-        )
-    )
-
-    results = session.execute(stmt, {'sentence': question}).fetchall()
-
-    for row in results:
-        _list.append(DataTraining(id=row.id, question=row.question))
+    # lexical (pg_trgm or n-gram) and vector rankings, fused into one list
+    lexical_ids: list[int] = [_id for _id, _ in data_training_retriever.search(session, question, oid, datasource)]
+    vector_ids: list[int] = []
 
     if settings.EMBEDDING_ENABLED:
         try:
@@ -250,18 +254,12 @@ def select_training_by_question(session: SessionDep, question: str, oid: int, da
                                       {'embedding_array': str(embedding), 'oid': oid, 'datasource': datasource})
 
             for row in results:
-                _list.append(DataTraining(id=row.id, question=row.question))
+                vector_ids.append(row.id)
 
         except Exception:
             traceback.print_exc()
 
-    _map: dict = {}
-    _ids: list[int] = []
-    for row in _list:
-        if row.id in _ids:
-            continue
-        else:
-            _ids.append(row.id)
+    _ids: list[int] = reciprocal_rank_fusion(lexical_ids, vector_ids)
 
     if len(_ids) == 0:
         return []
@@ -270,12 +268,14 @@ def select_training_by_question(session: SessionDep, question: str, oid: int, da
                            DataTraining.description).filter(
         and_(DataTraining.id.in_(_ids))).all()
 
+    _map: dict = {}
     for row in t_list:
         _map[row.id] = {'question': row.question, 'suggestion-answer': row.description}
 
     _results: list[dict] = []
-    for key in _map.keys():
-        _results.append(_map.get(key))
+    for _id in _ids:
+        if _id in _map:
+            _results.append(_map.get(_id))
 
     return _results
 
@@ -310,7 +310,8 @@ def to_xml_string(_dict: list[dict] | dict, root: str = 'sql-examples') -> str:
     return pretty_xml
 
 
-def get_training_template(session: SessionDep, question: str, datasource: int, oid: Optional[int] = 1) -> str:
+def get_training_template(session: SessionDep, question: str, datasource: int, oid: Optional[int] = 1,
+                          token_budget: int = 0) -> str:
     if not oid:
         oid = 1
     if not datasource:
@@ -319,6 +320,10 @@ def get_training_template(session: SessionDep, question: str, datasource: int, o
     if _results and len(_results) > 0:
         data_training = to_xml_string(_results)
         template = get_base_data_training_template().format(data_training=data_training)
+        # results are in fused rank order, drop the least relevant examples until the section fits
+        while token_budget and len(_results) > 1 and estimate_tokens(template) > token_budget:
+            _results = _results[:-1]
+            template = get_base_data_training_template().format(data_training=to_xml_string(_results))
         return template
     else:
         return ''
@@ -0,0 +1,155 @@
+import re
+import threading
+import traceback
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select, text
+
+from apps.data_training.models.data_training_model import DataTraining
+from common.core.config import settings
+from common.core.sqlbot_cache import bump_cache_version, get_cache_version
+from common.utils.ngram_index import NGramIndex
+from common.utils.utils import SQLBotLogUtil
+
+trgm_sql = """
+SELECT id, question,
+CASE WHEN word_similarity(question, :sentence) = 1 OR word_similarity(:sentence, question) = 1 THEN 1.0
+ELSE GREATEST(similarity(question, :sentence), word_similarity(:sentence, question),
+              word_similarity(question, :sentence)) END AS score
+FROM data_training
+WHERE oid = :oid AND datasource = :datasource
+AND (question % :sentence OR :sentence <% question OR question <% :sentence)
+ORDER BY score DESC
+LIMIT :limit
+"""
+
+# undefined_function / undefined_object: pg_trgm was dropped after it was detected
+_TRGM_MISSING_SQLSTATES = ('42883', '42704')
+
+# pg_trgm only builds trigrams from alphanumeric characters of the locale, CJK text gets none under the C locale
+# and whole runs of it become single "words" otherwise, the character n-gram index handles it either way
+_cjk_pattern = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]')
+
+
+@dataclass
+class WorkspaceTrainingIndex:
+    version: Tuple[int, int]
+    # datasource id -> n-gram index over the questions of that datasource
+    indexes: Dict[int, NGramIndex] = field(default_factory=dict)
+    questions: Dict[int, str] = field(default_factory=dict)
+
+
+class DataTrainingRetriever:
+    """
+    Lexical retrieval of data training examples.
+
+    Uses the pg_trgm GIN index on data_training.question when the extension is installed, otherwise an in-process
+    character n-gram index per workspace, rebuilt lazily after the workspace's examples change in any process (the
+    version stamp is shared through redis or the database). With the auto backend
+    CJK questions and databases in the C locale also use the n-gram index.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._workspaces: Dict[int, WorkspaceTrainingIndex] = {}
+        self._trgm_available: Optional[bool] = None
+        self._c_locale = False
+
+    @staticmethod
+    def _version_key(oid: int) -> str:
+        return f'data_training:{oid}'
+
+    def invalidate(self, oid: int):
+        bump_cache_version(self._version_key(oid))
+
+    def search(self, session, question: str, oid: int, datasource: int) -> List[Tuple[int, str]]:
+        limit = settings.DATA_TRAINING_LEXICAL_TOP_COUNT
+        min_score = settings.DATA_TRAINING_LEXICAL_SIMILARITY
+        if self._use_trgm(session, question):
+            try:
+                with session.begin_nested():
+                    rows = session.execute(text(trgm_sql), {'sentence': question, 'oid': oid,
+                                                            'datasource': datasource, 'limit': limit}).fetchall()
+                return [(row.id, row.question) for row in rows if row.score >= min_score]
+            except Exception as e:
+                traceback.print_exc()
+                if getattr(getattr(e, 'orig', None), 'sqlstate', None) in _TRGM_MISSING_SQLSTATES:
+                    self._trgm_available = False
+                # otherwise (timeouts, dropped connections) only this lookup falls back to the n-gram index
+
+        workspace = self._get_workspace(session, oid)
+        index = workspace.indexes.get(datasource)
+        if index is None:
+            return []
+        return [(_id, workspace.questions[_id]) for _id, _ in index.search(question, limit, min_score)]
+
+    def _use_trgm(self, session, question: str) -> bool:
+        backend = settings.DATA_TRAINING_LEXICAL_BACKEND
+        if backend == 'memory':
+            return False
+        if self._trgm_available is None:
+            self._trgm_available, self._c_locale = self._check_trgm(session)
+        if not self._trgm_available:
+            return False
+        if backend == 'auto' and (self._c_locale or _cjk_pattern.search(question or '')):
+            return False
+        return True
+
+    @staticmethod
+    def _check_trgm(session) -> Tuple[bool, bool]:
+        """Whether pg_trgm is installed, and whether the database uses the C locale"""
+        try:
+            installed = session.execute(
+                text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first() is not None
+        except Exception:
+            traceback.print_exc()
+            installed = False
+        if not installed:
+            SQLBotLogUtil.info('pg_trgm is not installed, use in-process n-gram index for data training')
+            return False, False
+        c_locale = False
+        try:
+            row = session.execute(text("SELECT datcollate, datctype FROM pg_database "
+                                       "WHERE datname = current_database()")).first()
+            c_locale = row is not None and (row.datcollate in ('C', 'POSIX') or row.datctype in ('C', 'POSIX'))
+        except Exception:
+            traceback.print_exc()
+        if c_locale:
+            SQLBotLogUtil.info('database uses the C locale, auto lexical backend uses the in-process n-gram index')
+        return True, c_locale
+
+    def _get_workspace(self, session, oid: int) -> WorkspaceTrainingIndex:
+        version = get_cache_version(self._version_key(oid))
+        workspace = self._workspaces.get(oid)
+        if workspace is not None and workspace.version == version:
+            return workspace
+        with self._lock:
+            workspace = self._workspaces.get(oid)
+            if workspace is None or workspace.version != version:
+                workspace = self._build(session, oid, version)
+                self._workspaces[oid] = workspace
+        return workspace
+
+    @staticmethod
+    def _build(session, oid: int, version: Tuple[int, int]) -> WorkspaceTrainingIndex:
+        rows = session.execute(
+            select(DataTraining.id, DataTraining.datasource, DataTraining.question)
+            .where(DataTraining.oid == oid)
+        ).fetchall()
+
+        workspace = WorkspaceTrainingIndex(version=version)
+        for row in rows:
+            if not row.question or row.datasource is None:
+                continue
+            index = workspace.indexes.get(row.datasource)
+            if index is None:
+                index = NGramIndex()
+                workspace.indexes[row.datasource] = index
+            index.add(row.id, row.question)
+            workspace.questions[row.id] = row.question
+        SQLBotLogUtil.info(f'data training n-gram index of workspace {oid} rebuilt: {len(workspace.questions)} examples')
+        return workspace
+
+
+data_training_retriever = DataTrainingRetriever()
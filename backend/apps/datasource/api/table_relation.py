@@ -4,6 +4,7 @@ from typing import List
 
 from fastapi import APIRouter
 
+from apps.datasource.crud.schema_cache import invalidate_ds_schema
 from apps.datasource.models.datasource import CoreDatasource
 from common.core.deps import SessionDep
 
@@ -16,6 +17,7 @@ async def save_relation(session: SessionDep, ds_id: int, relation: List[dict]):
     if ds:
         ds.table_relation = relation
         session.commit()
+        invalidate_ds_schema(ds_id)
     else:
         raise Exception("no datasource")
     return True
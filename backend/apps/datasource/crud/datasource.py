@@ -2,6 +2,7 @@ import asyncio
 import datetime
 import json
 import logging
+import traceback
 from typing import List, Optional
 from warnings import catch_warnings
 
@@ -11,7 +12,9 @@ from sqlbot_xpack.permissions.models.ds_rules import DsRules
 from sqlmodel import select
 
 from apps.datasource.crud.permission import get_column_permission_fields, get_row_permission_filters, is_normal_user
-from apps.datasource.embedding.table_embedding import calc_table_embedding
+from apps.datasource.crud.schema_cache import ds_schema_cache, invalidate_ds_schema
+from apps.ai_model.embedding import EmbeddingModelCache
+from apps.datasource.embedding.table_embedding import calc_table_embedding, prune_table_fields
 from apps.datasource.utils.utils import aes_decrypt
 from apps.db.constant import DB
 from apps.db.db import get_tables, get_fields, exec_sql, check_connection
@@ -20,12 +23,12 @@ from common.core.config import settings
 from common.core.deps import SessionDep, CurrentUser, Trans
 from common.core.nl2sql_session import NL2SQLSession
 from common.utils.embedding_threads import run_save_table_embeddings, run_save_ds_embeddings
-from common.utils.utils import deepcopy_ignore_extra
+from common.utils.utils import SQLBotLogUtil, deepcopy_ignore_extra, estimate_tokens
 from .table import get_tables_by_ds_id
 from ..crud.field import delete_field_by_ds_id, update_field
 from ..crud.table import delete_table_by_ds_id, update_table
 from ..models.datasource import CoreDatasource, CreateDatasource, CoreTable, CoreField, ColumnSchema, TableObj, \
-    DatasourceConf, TableAndFields
+    DatasourceConf, TableAndFields, CoreFieldEmbedding
 
 
 def get_datasource_list(session: SessionDep, user: CurrentUser, oid: Optional[int] = None) -> List[CoreDatasource]:
@@ -115,6 +118,7 @@ def chooseTables(session: SessionDep, trans: Trans, id: int, tables: List[CoreTa
         # call external api to init datasource
         _init_excel_datasource(session, ds.type.lower(), ds.id, background_tasks)
         session.commit()
+        invalidate_ds_schema(ds.id)
     except Exception as e:
         session.rollback()
         raise
@@ -137,6 +141,7 @@ def update_ds(session: SessionDep, trans: Trans, user: CurrentUser, ds: CoreData
         # call external api to init datasource
         _init_excel_datasource(session, ds.type.lower(), ds.id, background_tasks)
         session.commit()
+        invalidate_ds_schema(ds.id)
         return ds
     except Exception as e:
         session.rollback()
@@ -182,6 +187,7 @@ def delete_ds(session: SessionDep, id: int):
         delete_table_by_ds_id(session, id)
         delete_field_by_ds_id(session, id)
         session.commit()
+        invalidate_ds_schema(id)
         return {
             "message": f"Datasource with ID {id} deleted successfully."
         }
@@ -249,9 +255,13 @@ def _sync_table(session: SessionDep, ds: CoreDatasource, tables: List[CoreTable]
             synchronize_session=False)
         session.query(CoreField).filter(and_(CoreField.ds_id == ds.id, CoreField.table_id.not_in(id_list))).delete(
             synchronize_session=False)
+        session.query(CoreFieldEmbedding).filter(
+            and_(CoreFieldEmbedding.ds_id == ds.id, CoreFieldEmbedding.table_id.not_in(id_list))).delete(
+            synchronize_session=False)
     else:  # delete all tables and fields in this ds
         session.query(CoreTable).filter(CoreTable.ds_id == ds.id).delete(synchronize_session=False)
         session.query(CoreField).filter(CoreField.ds_id == ds.id).delete(synchronize_session=False)
+        session.query(CoreFieldEmbedding).filter(CoreFieldEmbedding.ds_id == ds.id).delete(synchronize_session=False)
 
     # do table embedding
     run_save_table_embeddings(id_list)
@@ -285,12 +295,16 @@ def _sync_fields(session: SessionDep, ds: CoreDatasource, table: CoreTable, fiel
     if len(id_list) > 0:
         session.query(CoreField).filter(and_(CoreField.table_id == table.id, CoreField.id.not_in(id_list))).delete(
             synchronize_session=False)
+        session.query(CoreFieldEmbedding).filter(
+            and_(CoreFieldEmbedding.table_id == table.id, CoreFieldEmbedding.field_id.not_in(id_list))).delete(
+            synchronize_session=False)
 
 
 def update_table_and_fields(session: SessionDep, data: TableObj):
     update_table(session, data.table)
     for field in data.fields:
         update_field(session, field)
+    invalidate_ds_schema(data.table.ds_id)
 
     # do table embedding
     run_save_table_embeddings([data.table.id])
@@ -309,6 +323,7 @@ def updateTable(session: SessionDep, table: CoreTable):
         ds = session.query(CoreDatasource).filter(CoreDatasource.id == table.ds_id).first()
         _init_excel_datasource(session, ds.type.lower(), ds.id, None)
         session.commit()
+        invalidate_ds_schema(ds.id)
     except Exception as e:
         session.rollback()
         raise
@@ -326,6 +341,7 @@ def updateField(session: SessionDep, field: CoreField, background_tasks: Backgro
         ds = session.query(CoreDatasource).filter(CoreDatasource.id == field.ds_id).first()
         _init_excel_datasource(session, ds.type.lower(), ds.id, background_tasks)
         session.commit()
+        invalidate_ds_schema(ds.id)
     except Exception as e:
         session.rollback()
         raise
@@ -453,97 +469,138 @@ def get_table_obj_by_ds(session: SessionDep, current_user: CurrentUser, ds: Core
     return _list
 
 
+def _build_schema_table(ds: CoreDatasource, db_name: str, obj: TableAndFields, fields: List[CoreField]) -> str:
+    schema_table = ''
+    schema_table += f"# Table: {db_name}.{obj.table.table_name}" if ds.type != "mysql" and ds.type != "es" else f"# Table: {obj.table.table_name}"
+    table_comment = ''
+    if obj.table.custom_comment:
+        table_comment = obj.table.custom_comment.strip()
+    if table_comment == '':
+        schema_table += '\n[\n'
+    else:
+        schema_table += f", {table_comment}\n[\n"
+
+    if fields:
+        field_list = []
+        for field in fields:
+            field_comment = ''
+            if field.custom_comment:
+                field_comment = field.custom_comment.strip()
+            if field_comment == '':
+                field_list.append(f"({field.field_name}:{field.field_type})")
+            else:
+                field_list.append(f"({field.field_name}:{field.field_type}, {field_comment})")
+        schema_table += ",\n".join(field_list)
+    schema_table += '\n]\n'
+    return schema_table
+
+
+def get_schema_key(session: SessionDep, current_user: CurrentUser, ds: CoreDatasource) -> str:
+    return ds_schema_cache.get_schema_key(session, current_user, ds, _build_schema_table)
+
+
 def get_table_schema(session: SessionDep, current_user: CurrentUser, ds: CoreDatasource, question: str,
-                     embedding: bool = True) -> str:
+                     embedding: bool = True, token_budget: int = 0) -> str:
     schema_str = ""
-    table_objs = get_table_obj_by_ds(session=session, current_user=current_user, ds=ds)
-    if len(table_objs) == 0:
+    # cached per datasource version and column permission fingerprint
+    db_name, all_tables, relation_lines = ds_schema_cache.get_fragments(session, current_user, ds,
+                                                                        _build_schema_table)
+    if len(all_tables) == 0:
         return schema_str
-    db_name = table_objs[0].schema
     schema_str += f"【DB_ID】 {db_name}\n【Schema】\n"
-    tables = []
-    all_tables = []  # temp save all tables
-    for obj in table_objs:
-        schema_table = ''
-        schema_table += f"# Table: {db_name}.{obj.table.table_name}" if ds.type != "mysql" and ds.type != "es" else f"# Table: {obj.table.table_name}"
-        table_comment = ''
-        if obj.table.custom_comment:
-            table_comment = obj.table.custom_comment.strip()
-        if table_comment == '':
-            schema_table += '\n[\n'
-        else:
-            schema_table += f", {table_comment}\n[\n"
-
-        if obj.fields:
-            field_list = []
-            for field in obj.fields:
-                field_comment = ''
-                if field.custom_comment:
-                    field_comment = field.custom_comment.strip()
-                if field_comment == '':
-                    field_list.append(f"({field.field_name}:{field.field_type})")
-                else:
-                    field_list.append(f"({field.field_name}:{field.field_type}, {field_comment})")
-            schema_table += ",\n".join(field_list)
-        schema_table += '\n]\n'
-
-        t_obj = {"id": obj.table.id, "schema_table": schema_table, "embedding": obj.table.embedding}
-        tables.append(t_obj)
-        all_tables.append(t_obj)
+    tables = list(all_tables)
 
     # do table embedding
+    q_embedding = None
     if embedding and tables and settings.TABLE_EMBEDDING_ENABLED:
-        tables = calc_table_embedding(tables, question)
+        try:
+            q_embedding = EmbeddingModelCache.get_model().embed_query(question)
+        except Exception:
+            traceback.print_exc()
+        tables = calc_table_embedding(tables, question, q_embedding)
+
+    # prune the columns of wide tables, keeping keys and columns used by relations
+    if q_embedding is not None and settings.FIELD_PRUNING_ENABLED:
+        # selected tables and the tables joined to them are spliced below
+        selected_table_ids = set([int(s.get('id')) for s in tables])
+        spliced_table_ids = set(selected_table_ids)
+        relation_port_ids = set()
+        for r in (ds.table_relation or []):
+            if r.get('shape') != 'edge':
+                continue
+            relation_port_ids.add(int(r.get('source').get('port')))
+            relation_port_ids.add(int(r.get('target').get('port')))
+            cells = (int(r.get('source').get('cell')), int(r.get('target').get('cell')))
+            if cells[0] in selected_table_ids or cells[1] in selected_table_ids:
+                spliced_table_ids.update(cells)
+        for t_obj in all_tables:
+            obj = t_obj.get('obj')
+            if obj.fields and len(obj.fields) > settings.FIELD_PRUNING_MIN_COLUMNS and int(
+                    t_obj.get('id')) in spliced_table_ids:
+                fields = prune_table_fields(session, obj.fields, q_embedding, relation_port_ids)
+                t_obj['schema_table'] = _build_schema_table(ds, db_name, obj, fields)
+                t_obj['tokens'] = estimate_tokens(t_obj['schema_table'])
+        pruned = {t_obj.get('id'): t_obj for t_obj in all_tables}
+        for s in tables:
+            if s.get('id') in pruned:
+                s['schema_table'] = pruned[s.get('id')].get('schema_table')
+                s['tokens'] = pruned[s.get('id')].get('tokens')
+
+    # keep the most relevant tables within the token budget, tables are in similarity order
+    budget_left = None
+    if token_budget and tables:
+        budget_left = token_budget - estimate_tokens(schema_str)
+        kept = []
+        for s in tables:
+            if kept and s.get('tokens') > budget_left:
+                break
+            kept.append(s)
+            budget_left -= s.get('tokens')
+        if len(kept) < len(tables):
+            SQLBotLogUtil.info(f'schema over token budget, {len(tables) - len(kept)} tables left out')
+        tables = kept
+
     # splice schema
     if tables:
         for s in tables:
             schema_str += s.get('schema_table')
 
     # field relation
-    if tables and ds.table_relation:
-        relations = list(filter(lambda x: x.get('shape') == 'edge', ds.table_relation))
-        if relations:
-            # Complete the missing table
-            # get tables in relation, remove irrelevant relation
-            embedding_table_ids = [s.get('id') for s in tables]
-            all_relations = list(
-                filter(lambda x: x.get('source').get('cell') in embedding_table_ids or x.get('target').get(
-                    'cell') in embedding_table_ids, relations))
-
-            # get relation table ids, sub embedding table ids
-            relation_table_ids = []
-            for r in all_relations:
-                relation_table_ids.append(r.get('source').get('cell'))
-                relation_table_ids.append(r.get('target').get('cell'))
-            relation_table_ids = list(set(relation_table_ids))
-            # get table dict
-            table_records = session.query(CoreTable).filter(CoreTable.id.in_(list(map(int, relation_table_ids)))).all()
-            table_dict = {}
-            for ele in table_records:
-                table_dict[ele.id] = ele.table_name
-
-            # get lost table ids
-            lost_table_ids = list(set(relation_table_ids) - set(embedding_table_ids))
-            # get lost table schema and splice it
-            lost_tables = list(filter(lambda x: x.get('id') in lost_table_ids, all_tables))
-            if lost_tables:
-                for s in lost_tables:
-                    schema_str += s.get('schema_table')
-
-            # get field dict
-            relation_field_ids = []
-            for relation in all_relations:
-                relation_field_ids.append(relation.get('source').get('port'))
-                relation_field_ids.append(relation.get('target').get('port'))
-            relation_field_ids = list(set(relation_field_ids))
-            field_records = session.query(CoreField).filter(CoreField.id.in_(list(map(int, relation_field_ids)))).all()
-            field_dict = {}
-            for ele in field_records:
-                field_dict[ele.id] = ele.field_name
-
-            if all_relations:
-                schema_str += '【Foreign keys】\n'
-                for ele in all_relations:
-                    schema_str += f"{table_dict.get(int(ele.get('source').get('cell')))}.{field_dict.get(int(ele.get('source').get('port')))}={table_dict.get(int(ele.get('target').get('cell')))}.{field_dict.get(int(ele.get('target').get('port')))}\n"
+    if tables and relation_lines:
+        # Complete the missing table
+        # get tables in relation, remove irrelevant relation
+        embedding_table_ids = [s.get('id') for s in tables]
+        all_relations = list(
+            filter(lambda x: x.source_cell in embedding_table_ids or x.target_cell in embedding_table_ids,
+                   relation_lines))
+
+        # get relation table ids, sub embedding table ids
+        relation_table_ids = []
+        for r in all_relations:
+            relation_table_ids.append(r.source_cell)
+            relation_table_ids.append(r.target_cell)
+
+        # get lost table ids
+        lost_table_ids = list(set(relation_table_ids) - set(embedding_table_ids))
+        # get lost table schema and splice it
+        lost_tables = list(filter(lambda x: x.get('id') in lost_table_ids, all_tables))
+        if budget_left is not None:
+            # joined tables only while the budget lasts, relations to tables left out are dropped too
+            fitting_tables = []
+            for s in lost_tables:
+                if s.get('tokens') <= budget_left:
+                    fitting_tables.append(s)
+                    budget_left -= s.get('tokens')
+            lost_tables = fitting_tables
+            spliced_ids = set(embedding_table_ids) | set(s.get('id') for s in lost_tables)
+            all_relations = [r for r in all_relations if r.source_cell in spliced_ids and r.target_cell in spliced_ids]
+        if lost_tables:
+            for s in lost_tables:
+                schema_str += s.get('schema_table')
+
+        if all_relations:
+            schema_str += '【Foreign keys】\n'
+            for ele in all_relations:
+                schema_str += ele.line
 
     return schema_str
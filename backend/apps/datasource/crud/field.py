@@ -1,9 +1,10 @@
 from common.core.deps import SessionDep
-from ..models.datasource import CoreField
+from ..models.datasource import CoreField, CoreFieldEmbedding
 
 
 def delete_field_by_ds_id(session: SessionDep, id: int):
     session.query(CoreField).filter(CoreField.ds_id == id).delete(synchronize_session=False)
+    session.query(CoreFieldEmbedding).filter(CoreFieldEmbedding.ds_id == id).delete(synchronize_session=False)
     session.commit()
 
 
@@ -1,5 +1,5 @@
 import json
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 from sqlalchemy import and_
 from sqlbot_xpack.permissions.api.permission import transRecord2DTO
@@ -72,6 +72,29 @@ def get_column_permission_fields(session: SessionDep, current_user: CurrentUser,
     return fields
 
 
+def get_column_permissions(session: SessionDep, current_user: CurrentUser,
+                           table_ids: list[int]) -> Dict[int, List[DsPermission]]:
+    """Column permissions of the tables which apply to the user, grouped by table id"""
+    result: Dict[int, List[DsPermission]] = {}
+    if not is_normal_user(current_user) or not table_ids:
+        return result
+    column_permissions = session.query(DsPermission).filter(
+        and_(DsPermission.table_id.in_(table_ids), DsPermission.type == 'column')).all()
+    if not column_permissions:
+        return result
+    contain_rules = session.query(DsRules).all()
+    for permission in column_permissions:
+        # check permission and user in same rules
+        for r in contain_rules:
+            p_list = json.loads(r.permission_list)
+            u_list = json.loads(r.user_list)
+            if p_list is not None and u_list is not None and permission.id in p_list and (
+                    current_user.id in u_list or f'{current_user.id}' in u_list):
+                result.setdefault(permission.table_id, []).append(permission)
+                break
+    return result
+
+
 def is_normal_user(current_user: CurrentUser):
     return current_user.id != 1
 
@@ -0,0 +1,176 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import and_
+
+from apps.datasource.crud.permission import filter_list, get_column_permissions
+from apps.datasource.models.datasource import CoreDatasource, CoreField, CoreTable, DatasourceConf, TableAndFields
+from apps.datasource.utils.utils import aes_decrypt
+from apps.db.engine import get_engine_config
+from common.core.deps import CurrentUser, SessionDep
+from common.core.sqlbot_cache import bump_cache_version, get_cache_version
+from common.utils.utils import estimate_tokens
+
+# datasources kept in memory, and column permission variants kept per datasource
+MAX_CACHED_DATASOURCES = 128
+MAX_PERMISSION_VARIANTS = 32
+
+
+@dataclass
+class RelationLine:
+    # raw cell values of ds.table_relation, compared the same way as before caching
+    source_cell: Any
+    target_cell: Any
+    source_port: Any
+    target_port: Any
+    line: str
+
+
+@dataclass
+class DatasourceSchema:
+    version: Tuple[int, int]
+    db_name: str = ''
+    tables: List[TableAndFields] = field(default_factory=list)
+    relations: List[RelationLine] = field(default_factory=list)
+    # column permission fingerprint -> (schema fragment of every table, digest of the whole visible schema)
+    fragments: 'OrderedDict[str, Tuple[List[dict], str]]' = field(default_factory=OrderedDict)
+
+
+class DatasourceSchemaCache:
+    """
+    Schema prompt fragments per datasource.
+
+    Tables, checked fields and relation lines are loaded once per datasource version, the version is bumped by
+    table/field/relation edits, table sync and embedding refresh. The fragment of each table is rendered once per
+    column permission fingerprint, so a question only has to rank the cached fragments. Permissions themselves are
+    read on every call. The version stamp is shared through redis or the database, so schema edits made through the
+    web app also reach the fragments cached by the mcp server.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._datasources: 'OrderedDict[int, DatasourceSchema]' = OrderedDict()
+
+    @staticmethod
+    def _version_key(ds_id: int) -> str:
+        return f'ds_schema:{ds_id}'
+
+    def invalidate(self, ds_id: int):
+        bump_cache_version(self._version_key(ds_id))
+
+    def get_fragments(self, session: SessionDep, current_user: CurrentUser, ds: CoreDatasource, build_fragment) \
+            -> Tuple[str, List[dict], List[RelationLine]]:
+        """
+        Returns the db name, a fresh list of {"id", "schema_table", "tokens", "embedding", "obj"} for every table of the
+        datasource filtered by the user's column permissions, and the relation lines.
+        build_fragment(ds, db_name, obj, fields) renders one table, the returned dicts can be changed by the caller.
+        """
+        entry, fragments, _ = self._get_variant(session, current_user, ds, build_fragment)
+        return entry.db_name, [dict(t_obj) for t_obj in fragments], entry.relations
+
+    def get_schema_key(self, session: SessionDep, current_user: CurrentUser, ds: CoreDatasource,
+                       build_fragment) -> str:
+        """Digest of the complete schema visible to the user, stable across processes and restarts"""
+        return self._get_variant(session, current_user, ds, build_fragment)[2]
+
+    def _get_variant(self, session: SessionDep, current_user: CurrentUser, ds: CoreDatasource, build_fragment) \
+            -> Tuple[DatasourceSchema, List[dict], str]:
+        entry = self._get_entry(session, ds)
+        if not entry.tables:
+            return entry, [], ''
+
+        permissions = get_column_permissions(session=session, current_user=current_user,
+                                             table_ids=[obj.table.id for obj in entry.tables])
+        fingerprint = self._fingerprint(permissions)
+        variant = entry.fragments.get(fingerprint)
+        if variant is None:
+            fragments = []
+            digest = hashlib.sha256(entry.db_name.encode('utf-8'))
+            for obj in entry.tables:
+                fields = obj.fields
+                for permission in permissions.get(obj.table.id, []):
+                    fields = filter_list(fields, json.loads(permission.permissions))
+                t_obj = TableAndFields(schema=obj.schema, table=obj.table, fields=fields)
+                schema_table = build_fragment(ds, entry.db_name, t_obj, fields)
+                digest.update(schema_table.encode('utf-8'))
+                fragments.append({"id": obj.table.id, "schema_table": schema_table,
+                                  "tokens": estimate_tokens(schema_table), "embedding": obj.table.embedding,
+                                  "obj": t_obj})
+            for relation in entry.relations:
+                digest.update(relation.line.encode('utf-8'))
+            variant = (fragments, digest.hexdigest())
+            with self._lock:
+                entry.fragments[fingerprint] = variant
+                while len(entry.fragments) > MAX_PERMISSION_VARIANTS:
+                    entry.fragments.popitem(last=False)
+        return entry, variant[0], variant[1]
+
+    @staticmethod
+    def _fingerprint(permissions: Dict[int, list]) -> str:
+        if not permissions:
+            return ''
+        rules = sorted((p.table_id, p.id, p.permissions) for items in permissions.values() for p in items)
+        return hashlib.sha256(json.dumps(rules, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def _get_entry(self, session: SessionDep, ds: CoreDatasource) -> DatasourceSchema:
+        version = get_cache_version(self._version_key(ds.id))
+        entry = self._datasources.get(ds.id)
+        if entry is not None and entry.version == version:
+            return entry
+        with self._lock:
+            entry = self._datasources.get(ds.id)
+            if entry is None or entry.version != version:
+                entry = self._build(session, ds, version)
+                self._datasources[ds.id] = entry
+                self._datasources.move_to_end(ds.id)
+                while len(self._datasources) > MAX_CACHED_DATASOURCES:
+                    self._datasources.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def _build(session: SessionDep, ds: CoreDatasource, version: Tuple[int, int]) -> DatasourceSchema:
+        entry = DatasourceSchema(version=version)
+        tables = session.query(CoreTable).filter(CoreTable.ds_id == ds.id).all()
+        if not tables:
+            return entry
+        conf = DatasourceConf(**json.loads(aes_decrypt(ds.configuration))) if ds.type != "excel" else get_engine_config()
+        entry.db_name = conf.dbSchema if conf.dbSchema is not None and conf.dbSchema != "" else conf.database
+
+        table_ids = [table.id for table in tables]
+        fields_dict: Dict[int, List[CoreField]] = {}
+        for _field in session.query(CoreField).filter(
+                and_(CoreField.table_id.in_(table_ids), CoreField.checked == True)).all():
+            fields_dict.setdefault(_field.table_id, []).append(CoreField(**_field.model_dump()))
+        # detached copies, the cached objects outlive the session
+        entry.tables = [TableAndFields(schema=entry.db_name, table=CoreTable(**table.model_dump()),
+                                       fields=fields_dict.get(table.id)) for table in tables]
+
+        relations = list(filter(lambda x: x.get('shape') == 'edge', ds.table_relation or []))
+        if relations:
+            table_dict = {table.id: table.table_name for table in tables}
+            port_ids = set()
+            for r in relations:
+                port_ids.add(int(r.get('source').get('port')))
+                port_ids.add(int(r.get('target').get('port')))
+            field_dict = {row.id: row.field_name for row in
+                          session.query(CoreField.id, CoreField.field_name).filter(CoreField.id.in_(port_ids)).all()}
+            for r in relations:
+                source, target = r.get('source'), r.get('target')
+                line = (f"{table_dict.get(int(source.get('cell')))}.{field_dict.get(int(source.get('port')))}="
+                        f"{table_dict.get(int(target.get('cell')))}.{field_dict.get(int(target.get('port')))}\n")
+                entry.relations.append(RelationLine(source_cell=source.get('cell'), target_cell=target.get('cell'),
+                                                    source_port=source.get('port'), target_port=target.get('port'),
+                                                    line=line))
+        return entry
+
+
+ds_schema_cache = DatasourceSchemaCache()
+
+
+def invalidate_ds_schema(ds_id: Optional[int]):
+    if ds_id is not None:
+        ds_schema_cache.invalidate(int(ds_id))
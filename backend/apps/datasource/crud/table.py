@@ -3,13 +3,16 @@ import time
 import traceback
 from typing import List
 
-from sqlalchemy import and_, select, update
+from sqlalchemy import exists, select, update
+from sqlalchemy.dialects.postgresql import insert
 
 from apps.ai_model.embedding import EmbeddingModelCache
 from common.core.config import settings
 from common.core.deps import SessionDep
-from common.utils.utils import SQLBotLogUtil
-from ..models.datasource import CoreTable, CoreField, CoreDatasource
+from common.utils.embedding_threads import run_save_table_embeddings, run_save_ds_embeddings, scan_id_pages
+from common.utils.utils import SQLBotLogUtil, batched
+from .schema_cache import invalidate_ds_schema
+from ..models.datasource import CoreTable, CoreField, CoreDatasource, CoreFieldEmbedding
 
 
 def delete_table_by_ds_id(session: SessionDep, id: int):
@@ -39,22 +42,74 @@ def run_fill_empty_table_and_ds_embedding(session_maker):
         session = session_maker()
 
         SQLBotLogUtil.info('get tables')
-        stmt = select(CoreTable.id).where(and_(CoreTable.embedding.is_(None)))
-        results = session.execute(stmt).scalars().all()
-        SQLBotLogUtil.info('table result: ' + str(len(results)))
-        save_table_embedding(session_maker, results)
+        total = 0
+        for ids in scan_id_pages(session, CoreTable.id, CoreTable.embedding.is_(None)):
+            # the scan itself is repeated on startup, no need to persist the ids as jobs
+            run_save_table_embeddings(ids, persist=False)
+            total += len(ids)
+        SQLBotLogUtil.info('table result: ' + str(total))
+
+        SQLBotLogUtil.info('get tables with fields missing embedding')
+        total = 0
+        missing_field_embedding = ~exists(select(CoreFieldEmbedding.field_id).where(
+            CoreFieldEmbedding.field_id == CoreField.id))
+        for ids in scan_id_pages(session, CoreField.table_id, missing_field_embedding):
+            run_save_table_embeddings(ids, persist=False)
+            total += len(ids)
+        SQLBotLogUtil.info('field table result: ' + str(total))
 
         SQLBotLogUtil.info('get datasource')
-        ds_stmt = select(CoreDatasource.id).where(and_(CoreDatasource.embedding.is_(None)))
-        ds_results = session.execute(ds_stmt).scalars().all()
-        SQLBotLogUtil.info('datasource result: ' + str(len(ds_results)))
-        save_ds_embedding(session_maker, ds_results)
+        total = 0
+        for ids in scan_id_pages(session, CoreDatasource.id, CoreDatasource.embedding.is_(None)):
+            run_save_ds_embeddings(ids, persist=False)
+            total += len(ids)
+        SQLBotLogUtil.info('datasource result: ' + str(total))
     except Exception:
         traceback.print_exc()
     finally:
         session_maker.remove()
 
 
+def build_table_schema_text(table: CoreTable, fields: List[CoreField]) -> str:
+    schema_table = ''
+    schema_table += f"# Table: {table.table_name}"
+    table_comment = ''
+    if table.custom_comment:
+        table_comment = table.custom_comment.strip()
+    if table_comment == '':
+        schema_table += '\n[\n'
+    else:
+        schema_table += f", {table_comment}\n[\n"
+
+    if fields:
+        field_list = []
+        for field in fields:
+            field_comment = ''
+            if field.custom_comment:
+                field_comment = field.custom_comment.strip()
+            if field_comment == '':
+                field_list.append(f"({field.field_name}:{field.field_type})")
+            else:
+                field_list.append(f"({field.field_name}:{field.field_type}, {field_comment})")
+        schema_table += ",\n".join(field_list)
+    schema_table += '\n]\n'
+    return schema_table
+
+
+def build_field_schema_text(field: CoreField) -> str:
+    field_comment = field.custom_comment.strip() if field.custom_comment else ''
+    if field_comment == '':
+        return f"{field.field_name}:{field.field_type}"
+    return f"{field.field_name}:{field.field_type}, {field_comment}"
+
+
+def _group_fields_by_table(fields: List[CoreField]) -> dict[int, List[CoreField]]:
+    fields_dict: dict[int, List[CoreField]] = {}
+    for field in fields:
+        fields_dict.setdefault(field.table_id, []).append(field)
+    return fields_dict
+
+
 def save_table_embedding(session_maker, ids: List[int]):
     if not settings.TABLE_EMBEDDING_ENABLED:
         return
@@ -64,45 +119,48 @@ def save_table_embedding(session_maker, ids: List[int]):
     try:
         SQLBotLogUtil.info('start table embedding')
         start_time = time.time()
+        total = 0
         model = EmbeddingModelCache.get_model()
         session = session_maker()
-        for _id in ids:
-            table = session.query(CoreTable).filter(CoreTable.id == _id).first()
-            fields = session.query(CoreField).filter(CoreField.table_id == table.id).all()
-
-            schema_table = ''
-            schema_table += f"# Table: {table.table_name}"
-            table_comment = ''
-            if table.custom_comment:
-                table_comment = table.custom_comment.strip()
-            if table_comment == '':
-                schema_table += '\n[\n'
-            else:
-                schema_table += f", {table_comment}\n[\n"
-
-            if fields:
-                field_list = []
-                for field in fields:
-                    field_comment = ''
-                    if field.custom_comment:
-                        field_comment = field.custom_comment.strip()
-                    if field_comment == '':
-                        field_list.append(f"({field.field_name}:{field.field_type})")
-                    else:
-                        field_list.append(f"({field.field_name}:{field.field_type}, {field_comment})")
-                schema_table += ",\n".join(field_list)
-            schema_table += '\n]\n'
-            # table_schema.append(schema_table)
-            emb = json.dumps(model.embed_query(schema_table))
-
-            stmt = update(CoreTable).where(and_(CoreTable.id == _id)).values(embedding=emb)
-            session.execute(stmt)
+        for batch_ids in batched(list(ids), settings.EMBEDDING_BATCH_SIZE):
+            tables = session.query(CoreTable).filter(CoreTable.id.in_(batch_ids)).all()
+            if not tables:
+                continue
+            fields_dict = _group_fields_by_table(
+                session.query(CoreField).filter(CoreField.table_id.in_(batch_ids)).all())
+
+            schema_list = [build_table_schema_text(table, fields_dict.get(table.id)) for table in tables]
+            results = model.embed_documents(schema_list)
+
+            # bulk UPDATE by primary key, executed as one executemany per batch
+            session.execute(update(CoreTable),
+                            [{'id': tables[index].id, 'embedding': json.dumps(results[index])}
+                             for index in range(len(results))])
+
+            # per-field embeddings, used to prune the columns of wide tables in the schema prompt
+            fields = [field for table in tables for field in fields_dict.get(table.id, [])]
+            for batch_fields in batched(fields, settings.EMBEDDING_BATCH_SIZE):
+                field_results = model.embed_documents([build_field_schema_text(field) for field in batch_fields])
+                stmt = insert(CoreFieldEmbedding).values(
+                    [{'field_id': batch_fields[index].id, 'ds_id': batch_fields[index].ds_id,
+                      'table_id': batch_fields[index].table_id, 'embedding': json.dumps(field_results[index])}
+                     for index in range(len(field_results))])
+                session.execute(stmt.on_conflict_do_update(index_elements=[CoreFieldEmbedding.field_id],
+                                                           set_={'embedding': stmt.excluded.embedding}))
+            ds_ids = set(table.ds_id for table in tables)
             session.commit()
+            # the cached schema prompt carries the table embeddings
+            for ds_id in ds_ids:
+                invalidate_ds_schema(ds_id)
+            total += len(results)
 
         end_time = time.time()
-        SQLBotLogUtil.info('table embedding finished in: ' + str(end_time - start_time) + ' seconds')
-    except Exception:
+        cost = end_time - start_time
+        SQLBotLogUtil.info(f'table embedding finished: {total} rows in {cost:.2f} seconds '
+                           f'({total / cost if cost > 0 else 0:.1f} rows/s)')
+    except Exception as e:
         traceback.print_exc()
+        raise e
     finally:
         session_maker.remove()
 
@@ -116,47 +174,41 @@ def save_ds_embedding(session_maker, ids: List[int]):
     try:
         SQLBotLogUtil.info('start datasource embedding')
         start_time = time.time()
+        total = 0
         model = EmbeddingModelCache.get_model()
         session = session_maker()
-        for _id in ids:
-            schema_table = ''
-            ds = session.query(CoreDatasource).filter(CoreDatasource.id == _id).first()
-            schema_table += f"{ds.name}, {ds.description}\n"
-            tables = session.query(CoreTable).filter(CoreTable.ds_id == ds.id).all()
+        for batch_ids in batched(list(ids), settings.EMBEDDING_BATCH_SIZE):
+            ds_list = session.query(CoreDatasource).filter(CoreDatasource.id.in_(batch_ids)).all()
+            if not ds_list:
+                continue
+            tables = session.query(CoreTable).filter(CoreTable.ds_id.in_(batch_ids)).all()
+            fields_dict = _group_fields_by_table(
+                session.query(CoreField).filter(CoreField.ds_id.in_(batch_ids)).all())
+            tables_dict: dict[int, List[CoreTable]] = {}
             for table in tables:
-                fields = session.query(CoreField).filter(CoreField.table_id == table.id).all()
-
-                schema_table += f"# Table: {table.table_name}"
-                table_comment = ''
-                if table.custom_comment:
-                    table_comment = table.custom_comment.strip()
-                if table_comment == '':
-                    schema_table += '\n[\n'
-                else:
-                    schema_table += f", {table_comment}\n[\n"
-
-                if fields:
-                    field_list = []
-                    for field in fields:
-                        field_comment = ''
-                        if field.custom_comment:
-                            field_comment = field.custom_comment.strip()
-                        if field_comment == '':
-                            field_list.append(f"({field.field_name}:{field.field_type})")
-                        else:
-                            field_list.append(f"({field.field_name}:{field.field_type}, {field_comment})")
-                    schema_table += ",\n".join(field_list)
-                schema_table += '\n]\n'
-            # table_schema.append(schema_table)
-            emb = json.dumps(model.embed_query(schema_table))
-
-            stmt = update(CoreDatasource).where(and_(CoreDatasource.id == _id)).values(embedding=emb)
-            session.execute(stmt)
+                tables_dict.setdefault(table.ds_id, []).append(table)
+
+            schema_list = []
+            for ds in ds_list:
+                schema_table = f"{ds.name}, {ds.description}\n"
+                for table in tables_dict.get(ds.id, []):
+                    schema_table += build_table_schema_text(table, fields_dict.get(table.id))
+                schema_list.append(schema_table)
+            results = model.embed_documents(schema_list)
+
+            # bulk UPDATE by primary key, executed as one executemany per batch
+            session.execute(update(CoreDatasource),
+                            [{'id': ds_list[index].id, 'embedding': json.dumps(results[index])}
+                             for index in range(len(results))])
             session.commit()
+            total += len(results)
 
         end_time = time.time()
-        SQLBotLogUtil.info('datasource embedding finished in: ' + str(end_time - start_time) + ' seconds')
-    except Exception:
+        cost = end_time - start_time
+        SQLBotLogUtil.info(f'datasource embedding finished: {total} rows in {cost:.2f} seconds '
+                           f'({total / cost if cost > 0 else 0:.1f} rows/s)')
+    except Exception as e:
         traceback.print_exc()
+        raise e
     finally:
         session_maker.remove()
@@ -1,19 +1,62 @@
 # Author: Junjun
 # Date: 2025/9/18
+import hashlib
 import json
+import threading
 import time
 import traceback
+from collections import OrderedDict
 from typing import Optional
 
 from apps.ai_model.embedding import EmbeddingModelCache
 from apps.datasource.embedding.utils import cosine_similarity
 from apps.datasource.models.datasource import CoreDatasource
 from apps.system.crud.assistant import AssistantOutDs
+from apps.system.schemas.system_schema import AssistantOutDsSchema
 from common.core.config import settings
 from common.core.deps import CurrentAssistant
 from common.core.deps import SessionDep, CurrentUser
 from common.utils.utils import SQLBotLogUtil
 
+# schema hash -> embedding of an assistant (type 1) datasource, external datasources have no embedding column
+_out_ds_embedding_cache: OrderedDict = OrderedDict()
+_out_ds_embedding_lock = threading.Lock()
+OUT_DS_EMBEDDING_CACHE_SIZE = 1024
+
+
+def out_ds_schema_hash(ds: AssistantOutDsSchema) -> str:
+    """Hash of everything that goes into the schema text: name, description, tables, fields and comments"""
+    content = ds.model_dump(include={'name', 'description', 'type', 'dataBase', 'db_schema', 'tables'})
+    content['model'] = settings.DEFAULT_EMBEDDING_MODEL
+    return hashlib.sha256(json.dumps(content, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def get_out_ds_embeddings(out_ds: AssistantOutDs, ds_list: list[AssistantOutDsSchema], question: str, model):
+    keys = [out_ds_schema_hash(ds) for ds in ds_list]
+    with _out_ds_embedding_lock:
+        results = [_out_ds_embedding_cache.get(key) for key in keys]
+        for key, item in zip(keys, results, strict=True):
+            if item is not None:
+                _out_ds_embedding_cache.move_to_end(key)
+
+    # only datasources whose schema changed (or never seen) are rebuilt and embedded
+    missing = [index for index, item in enumerate(results) if item is None]
+    if missing:
+        text = []
+        for index in missing:
+            ds = ds_list[index]
+            table_schema = out_ds.get_db_schema(ds.id, question, embedding=False)
+            text.append(f"{ds.name}, {ds.description}\n" + table_schema)
+        embeddings = model.embed_documents(text)
+        with _out_ds_embedding_lock:
+            for index, embedding in zip(missing, embeddings, strict=True):
+                results[index] = embedding
+                _out_ds_embedding_cache[keys[index]] = embedding
+            while len(_out_ds_embedding_cache) > OUT_DS_EMBEDDING_CACHE_SIZE:
+                _out_ds_embedding_cache.popitem(last=False)
+    SQLBotLogUtil.info(f"assistant datasource embeddings: {len(ds_list) - len(missing)} cached, {len(missing)} embedded")
+    return results
+
 
 def get_ds_embedding(session: SessionDep, current_user: CurrentUser, _ds_list, out_ds: AssistantOutDs,
                      question: str,
@@ -23,17 +66,12 @@ def get_ds_embedding(session: SessionDep, current_user: CurrentUser, _ds_list, o
         if out_ds.ds_list:
             for _ds in out_ds.ds_list:
                 ds = out_ds.get_ds(_ds.id)
-                table_schema = out_ds.get_db_schema(_ds.id, question, embedding=False)
-                ds_info = f"{ds.name}, {ds.description}\n"
-                ds_schema = ds_info + table_schema
-                _list.append({"id": ds.id, "ds_schema": ds_schema, "cosine_similarity": 0.0, "ds": ds})
+                _list.append({"id": ds.id, "cosine_similarity": 0.0, "ds": ds})
 
         if _list:
             try:
-                text = [s.get('ds_schema') for s in _list]
-
                 model = EmbeddingModelCache.get_model()
-                results = model.embed_documents(text)
+                results = get_out_ds_embeddings(out_ds, [s.get('ds') for s in _list], question, model)
 
                 q_embedding = model.embed_query(question)
                 for index in range(len(results)):
@@ -5,9 +5,11 @@ import time
 import traceback
 
 from apps.ai_model.embedding import EmbeddingModelCache
+from apps.datasource.crud.table import build_field_schema_text
 from apps.datasource.embedding.utils import cosine_similarity
+from apps.datasource.models.datasource import CoreFieldEmbedding
 from common.core.config import settings
-from common.utils.utils import SQLBotLogUtil
+from common.utils.utils import SQLBotLogUtil, estimate_tokens
 
 
 def get_table_embedding(tables: list[dict], question: str):
@@ -40,12 +42,12 @@ def get_table_embedding(tables: list[dict], question: str):
     return _list
 
 
-def calc_table_embedding(tables: list[dict], question: str):
+def calc_table_embedding(tables: list[dict], question: str, q_embedding=None):
     _list = []
     for table in tables:
         _list.append(
-            {"id": table.get('id'), "schema_table": table.get('schema_table'), "embedding": table.get('embedding'),
-             "cosine_similarity": 0.0})
+            {"id": table.get('id'), "schema_table": table.get('schema_table'), "tokens": table.get('tokens'),
+             "embedding": table.get('embedding'), "cosine_similarity": 0.0})
 
     if _list:
         try:
@@ -58,7 +60,8 @@ def calc_table_embedding(tables: list[dict], question: str):
             # SQLBotLogUtil.info(str(end_time - start_time))
             results = [item.get('embedding') for item in _list]
 
-            q_embedding = model.embed_query(question)
+            if q_embedding is None:
+                q_embedding = model.embed_query(question)
             for index in range(len(results)):
                 item = results[index]
                 if item:
@@ -76,3 +79,49 @@ def calc_table_embedding(tables: list[dict], question: str):
         except Exception:
             traceback.print_exc()
     return _list
+
+
+def is_key_field(field) -> bool:
+    # no key metadata is synced, go by naming: id, xxx_id, xxxId
+    name = (field.field_name or '').strip()
+    return name.lower() == 'id' or name.lower().endswith('_id') or (len(name) > 2 and name.endswith('Id'))
+
+
+def prune_table_fields(session, fields: list, q_embedding, keep_field_ids: set) -> list:
+    """
+    Keep the columns of a wide table that matter for the question: keys, columns used by table relations and the
+    top relevant columns by field embedding, within FIELD_PRUNING_TOKEN_BUDGET. Original column order is kept.
+    """
+    if not fields or q_embedding is None:
+        return fields
+    rows = session.query(CoreFieldEmbedding.field_id, CoreFieldEmbedding.embedding).filter(
+        CoreFieldEmbedding.field_id.in_([field.id for field in fields])).all()
+    field_embeddings = {row.field_id: row.embedding for row in rows if row.embedding}
+    if not field_embeddings:
+        # not embedded yet, better a long prompt than a wrong one
+        return fields
+
+    mandatory = [field for field in fields if field.id in keep_field_ids or is_key_field(field)]
+    mandatory_ids = {field.id for field in mandatory}
+    scored = []
+    for field in fields:
+        if field.id in mandatory_ids:
+            continue
+        embedding = field_embeddings.get(field.id)
+        score = cosine_similarity(q_embedding, json.loads(embedding)) if embedding else 0.0
+        scored.append((score, field))
+    scored.sort(key=lambda x: x[0], reverse=True)
+    ranked = [field for _, field in scored[:settings.FIELD_PRUNING_TOP_COUNT]]
+
+    budget = settings.FIELD_PRUNING_TOKEN_BUDGET
+    selected_ids = set()
+    for field in mandatory + ranked:
+        tokens = estimate_tokens(build_field_schema_text(field)) + 2
+        if field.id not in mandatory_ids and tokens > budget:
+            break
+        budget -= tokens
+        selected_ids.add(field.id)
+
+    result = [field for field in fields if field.id in selected_ids]
+    SQLBotLogUtil.info(f'pruned table {fields[0].table_id} columns: {len(fields)} -> {len(result)}')
+    return result
@@ -48,6 +48,15 @@ class CoreField(SQLModel, table=True):
     field_index: int = Field(sa_column=Column(BigInteger()))
 
 
+class CoreFieldEmbedding(SQLModel, table=True):
+    # kept apart from core_field, so field lists loaded for the UI and the schema prompt stay small
+    __tablename__ = "core_field_embedding"
+    field_id: int = Field(sa_column=Column(BigInteger, nullable=False, primary_key=True))
+    ds_id: int = Field(sa_column=Column(BigInteger(), index=True))
+    table_id: int = Field(sa_column=Column(BigInteger(), index=True))
+    embedding: str = Field(sa_column=Column(Text, nullable=True))
+
+
 # datasource create obj
 class CreateDatasource(BaseModel):
     id: int = None
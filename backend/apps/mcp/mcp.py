@@ -132,7 +132,7 @@ async def mcp_question(session: SessionDep, chat: McpQuestion):
     else:
         res = llm_service.await_result()
         raw_data = {}
-        for chunk in res:
+        async for chunk in res:
             if chunk:
                 raw_data = chunk
         status_code = 200
@@ -188,7 +188,7 @@ async def mcp_assistant(session: SessionDep, chat: McpAssistant):
     else:
         res = llm_service.await_result()
         raw_data = {}
-        for chunk in res:
+        async for chunk in res:
             if chunk:
                 raw_data = chunk
         status_code = 200
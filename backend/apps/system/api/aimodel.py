@@ -2,7 +2,7 @@ import json
 from typing import List, Union
 
 from fastapi.responses import StreamingResponse
-from apps.ai_model.model_factory import LLMConfig, LLMFactory
+from apps.ai_model.model_factory import LLMConfig, LLMFactory, invalidate_default_config
 from apps.system.schemas.ai_model_schema import AiModelConfigItem, AiModelCreator, AiModelEditor, AiModelGridItem
 from fastapi import APIRouter, Query
 from sqlmodel import func, select, update
@@ -65,6 +65,7 @@ async def set_default(session: SessionDep, id: int):
         db_model.default_model = True
         session.add(db_model)
         session.commit()
+        invalidate_default_config()
     except Exception as e:
         session.rollback()
         raise e
@@ -127,6 +128,7 @@ async def add_model(
         detail.default_model = True
     session.add(detail)
     session.commit()
+    invalidate_default_config()
 
 @router.put("")
 async def update_model(
@@ -142,6 +144,7 @@ async def update_model(
     db_model.sqlmodel_update(data)
     session.add(db_model)
     session.commit()
+    invalidate_default_config()
 
 @router.delete("/{id}")
 async def delete_model(
@@ -154,6 +157,7 @@ async def delete_model(
         raise Exception(trans('i18n_llm.delete_default_error', key = item.name))
     session.delete(item)
     session.commit()
+    invalidate_default_config()
     
 
     
\ No newline at end of file
@@ -0,0 +1,15 @@
+import asyncio
+
+from fastapi import APIRouter
+
+from common.core.deps import CurrentUser, Trans
+from common.utils.embedding_threads import embedding_job_queue
+
+router = APIRouter(tags=["system/embedding"], prefix="/system/embedding")
+
+
+@router.get("/status")
+async def embedding_status(current_user: CurrentUser, trans: Trans):
+    if not current_user.isAdmin:
+        raise Exception(trans('i18n_permission.no_permission', url=", ", msg=trans('i18n_permission.only_admin')))
+    return await asyncio.to_thread(embedding_job_queue.status)
@@ -0,0 +1,36 @@
+import asyncio
+
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from sqlalchemy import text
+
+from apps.ai_model.embedding import EmbeddingModelCache
+from common.core.config import settings
+from common.core.db import engine
+
+router = APIRouter(tags=["health"], prefix="/health")
+
+
+def _check_db() -> dict:
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        pool = engine.pool
+        return {'ready': True, 'size': pool.size(), 'checked_out': pool.checkedout(), 'overflow': pool.overflow()}
+    except Exception as e:
+        return {'ready': False, 'error': str(e)}
+
+
+@router.get("/live", include_in_schema=False)
+async def live():
+    return JSONResponse({'status': 'ok'})
+
+
+@router.get("/ready", include_in_schema=False)
+async def ready():
+    db = await asyncio.to_thread(_check_db)
+    model_required = settings.EMBEDDING_ENABLED or settings.TABLE_EMBEDDING_ENABLED
+    model = {'required': model_required, 'ready': EmbeddingModelCache.is_loaded()}
+    is_ready = db.get('ready') and (model['ready'] or not model_required)
+    return JSONResponse({'status': 'ok' if is_ready else 'starting', 'db': db, 'embedding_model': model},
+                        status_code=200 if is_ready else 503)
@@ -0,0 +1,20 @@
+import hmac
+
+from fastapi import APIRouter, Request
+from fastapi.responses import PlainTextResponse, Response
+
+from common.core.config import settings
+from common.utils.metrics import REGISTRY
+
+router = APIRouter(tags=["metrics"])
+
+
+@router.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    if not settings.METRICS_ENABLED:
+        return Response(status_code=404)
+    if settings.METRICS_TOKEN:
+        expected = f'Bearer {settings.METRICS_TOKEN}'
+        if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), expected.encode()):
+            return Response(status_code=401)
+    return PlainTextResponse(REGISTRY.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
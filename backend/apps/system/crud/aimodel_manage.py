@@ -1,4 +1,5 @@
 
+from apps.ai_model.model_factory import invalidate_default_config
 from apps.system.models.system_model import AiModelDetail
 from common.core.db import engine
 from sqlmodel import Session, select
@@ -27,6 +28,7 @@ async def async_model_info():
                     session.add(model)
         if any_model_change:
             session.commit()
+            invalidate_default_config()
             SQLBotLogUtil.info("✅ 异步加密已有模型的密钥和地址完成")           
             
             
@@ -55,4 +55,12 @@ class AssistantBaseModel(SQLModel):
 
 class AssistantModel(SnowflakeBase, AssistantBaseModel, table=True):
     __tablename__ = "sys_assistant"
-    
\ No newline at end of file
+    
+
+class EmbeddingJobModel(SQLModel, table=True):
+    __tablename__ = "sys_embedding_job"
+    kind: str = Field(max_length=32, primary_key=True)
+    target_id: int = Field(sa_type=BigInteger(), primary_key=True)
+    attempts: int = Field(default=0, nullable=False)
+    last_error: Optional[str] = Field(sa_type=Text(), nullable=True)
+    create_time: int = Field(default=0, sa_type=BigInteger())
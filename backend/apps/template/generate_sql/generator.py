@@ -1,7 +1,8 @@
 from typing import Union
 
 from apps.db.constant import DB
-from apps.template.template import get_base_template, get_sql_template as get_base_sql_template
+from apps.template.template import get_base_template, get_sql_template as get_base_sql_template, \
+    CompiledTemplate, compiled_cache
 
 
 def get_sql_template():
@@ -12,3 +13,24 @@ def get_sql_template():
 def get_sql_example_template(db_type: Union[str, DB]):
     template = get_base_sql_template(db_type)
     return template['template']
+
+
+@compiled_cache
+def get_sql_system_template(db_type: Union[str, DB], enable_query_limit: bool, lang: str) -> CompiledTemplate:
+    """SQL 生成的系统提示词，规则、示例和 limit 说明按 (数据库类型, 是否限制条数, 语言) 预编译"""
+    _sql_template = get_sql_example_template(db_type)
+    _base_sql_rules = _sql_template['quot_rule'] + _sql_template['limit_rule'] + _sql_template['other_rule']
+    _query_limit = get_sql_template()['query_limit'] if enable_query_limit else get_sql_template()['no_query_limit']
+    _example_answer_1 = _sql_template['example_answer_1_with_limit'] if enable_query_limit else _sql_template[
+        'example_answer_1']
+    _example_answer_2 = _sql_template['example_answer_2_with_limit'] if enable_query_limit else _sql_template[
+        'example_answer_2']
+    _example_answer_3 = _sql_template['example_answer_3_with_limit'] if enable_query_limit else _sql_template[
+        'example_answer_3']
+    return CompiledTemplate(get_sql_template()['system'],
+                            dict(lang=lang, base_sql_rules=_base_sql_rules, query_limit=_query_limit,
+                                 basic_sql_examples=_sql_template['basic_example'],
+                                 example_engine=_sql_template['example_engine'],
+                                 example_answer_1=_example_answer_1,
+                                 example_answer_2=_example_answer_2,
+                                 example_answer_3=_example_answer_3))
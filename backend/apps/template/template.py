@@ -1,6 +1,7 @@
 import yaml
 from pathlib import Path
 from functools import cache
+from string import Formatter
 from typing import Union
 
 from apps.db.constant import DB
@@ -24,6 +25,73 @@ def _load_template_file(file_path: Path):
         raise ValueError(f"Error parsing YAML file {file_path}: {e}")
 
 
+# 编译后模板的缓存，reload_all_templates 时一并清空
+_compiled_caches = []
+
+
+def compiled_cache(fn):
+    """缓存编译后的模板（参数需可哈希）"""
+    cached = cache(fn)
+    _compiled_caches.append(cached)
+    return cached
+
+
+class CompiledTemplate:
+    """
+    A prompt template parsed once, with its static slots already rendered.
+
+    `format` only fills the remaining dynamic slots and joins the parts, the result is the same as str.format on the
+    original template (values are never parsed again, so braces inside a value stay literal).
+    """
+    __slots__ = ('_parts', 'fields')
+
+    _formatter = Formatter()
+
+    def __init__(self, template: str, static: dict = None):
+        static = static or {}
+        parts = []
+        fields = []
+        literal = ''
+        for text, field_name, format_spec, conversion in self._formatter.parse(template):
+            literal += text
+            if field_name is None:
+                continue
+            if field_name.split('.', 1)[0].split('[', 1)[0] in static:
+                literal += self._render_field(field_name, format_spec, conversion, static)
+                continue
+            if literal:
+                parts.append(literal)
+                literal = ''
+            parts.append((field_name, format_spec, conversion))
+            fields.append(field_name)
+        if literal:
+            parts.append(literal)
+        self._parts = tuple(parts)
+        self.fields = tuple(fields)
+
+    @classmethod
+    def _render_field(cls, field_name: str, format_spec: str, conversion: str, values: dict) -> str:
+        if not format_spec and not conversion and field_name in values:
+            value = values[field_name]
+            return value if isinstance(value, str) else format(value)
+        obj, _ = cls._formatter.get_field(field_name, (), values)
+        obj = cls._formatter.convert_field(obj, conversion)
+        return cls._formatter.format_field(obj, format_spec or '')
+
+    def format(self, **kwargs) -> str:
+        return ''.join(part if isinstance(part, str) else self._render_field(*part, kwargs) for part in self._parts)
+
+
+@compiled_cache
+def _compile_template(template: str, static: tuple) -> CompiledTemplate:
+    return CompiledTemplate(template, dict(static))
+
+
+def compile_template(template: str, **static) -> CompiledTemplate:
+    """编译模板（自动缓存），static 中的值在编译时直接渲染"""
+    return _compile_template(template, tuple(sorted(static.items())))
+
+
 def get_base_template():
     """获取基础模板（自动缓存）"""
     return _load_template_file(BASE_TEMPLATE_PATH)
@@ -60,5 +128,7 @@ def get_all_sql_templates():
 def reload_all_templates():
     """清空所有模板缓存"""
     _load_template_file.cache_clear()
+    for cached in _compiled_caches:
+        cached.cache_clear()
 
 
@@ -0,0 +1,114 @@
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+
+from apps.terminology.models.terminology_model import Terminology
+from common.core.sqlbot_cache import bump_cache_version, get_cache_version
+from common.utils.aho_corasick import AhoCorasick
+from common.utils.utils import SQLBotLogUtil
+
+
+@dataclass
+class TermEntry:
+    id: int
+    pid: Optional[int]
+    word: str
+    specific_ds: bool
+    datasource_ids: frozenset
+
+    @property
+    def root_id(self) -> int:
+        return self.pid if self.pid is not None else self.id
+
+    def visible(self, datasource: Optional[int]) -> bool:
+        if not self.specific_ds:
+            return True
+        return datasource is not None and datasource in self.datasource_ids
+
+
+@dataclass
+class WorkspaceTerminology:
+    version: Tuple[int, int]
+    entries: Dict[int, TermEntry] = field(default_factory=dict)
+    # root id -> {'words': [parent word, synonyms...], 'description': parent description}
+    groups: Dict[int, dict] = field(default_factory=dict)
+    automaton: Optional[AhoCorasick] = None
+
+    def match(self, sentence: str, datasource: Optional[int] = None) -> List[TermEntry]:
+        if self.automaton is None:
+            return []
+        hits = [self.entries[_id] for _id in self.automaton.search(sentence)]
+        return sorted([entry for entry in hits if entry.visible(datasource)], key=lambda entry: entry.id)
+
+    def get_groups(self, root_ids: List[int]) -> List[dict]:
+        return [{'words': list(self.groups[_id]['words']), 'description': self.groups[_id]['description']}
+                for _id in root_ids if _id in self.groups]
+
+
+class TerminologyMatcher:
+    """
+    In-memory Aho-Corasick index of every terminology word (including synonyms) per workspace.
+
+    A workspace index is rebuilt lazily on the first lookup after a create/update/delete in that workspace, other
+    workspaces are untouched. The version stamp is shared through redis or the database, so edits made through one
+    process (e.g. the web app) also invalidate the index held by the others (e.g. the mcp server).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._workspaces: Dict[int, WorkspaceTerminology] = {}
+
+    @staticmethod
+    def _version_key(oid: int) -> str:
+        return f'terminology:{oid}'
+
+    def invalidate(self, oid: int):
+        bump_cache_version(self._version_key(oid))
+
+    def get(self, session, oid: int) -> WorkspaceTerminology:
+        version = get_cache_version(self._version_key(oid))
+        workspace = self._workspaces.get(oid)
+        if workspace is not None and workspace.version == version:
+            return workspace
+        with self._lock:
+            workspace = self._workspaces.get(oid)
+            if workspace is None or workspace.version != version:
+                workspace = self._build(session, oid, version)
+                self._workspaces[oid] = workspace
+        return workspace
+
+    @staticmethod
+    def _build(session, oid: int, version: Tuple[int, int]) -> WorkspaceTerminology:
+        rows = session.execute(
+            select(Terminology.id, Terminology.pid, Terminology.word, Terminology.description,
+                   Terminology.specific_ds, Terminology.datasource_ids)
+            .where(Terminology.oid == oid)
+            # parents first, so every group starts with the parent word and carries its description
+            .order_by(Terminology.pid.is_(None).desc(), Terminology.id)
+        ).fetchall()
+
+        workspace = WorkspaceTerminology(version=version)
+        for row in rows:
+            if not row.word:
+                continue
+            datasource_ids = frozenset(int(_id) for _id in (row.datasource_ids or []))
+            entry = TermEntry(id=row.id, pid=row.pid, word=row.word, specific_ds=bool(row.specific_ds),
+                              datasource_ids=datasource_ids)
+            workspace.entries[entry.id] = entry
+
+            group = workspace.groups.get(entry.root_id)
+            if group is None:
+                group = {'words': [], 'description': row.description}
+                workspace.groups[entry.root_id] = group
+            elif group['description'] is None and row.description is not None:
+                group['description'] = row.description
+            group['words'].append(row.word)
+
+        workspace.automaton = AhoCorasick((entry.word, entry.id) for entry in workspace.entries.values())
+        SQLBotLogUtil.info(f'terminology matcher of workspace {oid} rebuilt: {len(workspace.entries)} words')
+        return workspace
+
+
+terminology_matcher = TerminologyMatcher()
@@ -1,20 +1,23 @@
 import datetime
 import logging
+import time
 import traceback
-from typing import List, Optional, Any
+from typing import List, Optional
 from xml.dom.minidom import parseString
 
 import dicttoxml
-from sqlalchemy import and_, or_, select, func, delete, update, union, text, BigInteger
+from sqlalchemy import and_, or_, select, func, delete, update, text, BigInteger
 from sqlalchemy.orm import aliased
 
 from apps.ai_model.embedding import EmbeddingModelCache
 from apps.datasource.models.datasource import CoreDatasource
 from apps.template.generate_chart.generator import get_base_terminology_template
+from apps.terminology.curd.matcher import terminology_matcher
 from apps.terminology.models.terminology_model import Terminology, TerminologyInfo
 from common.core.config import settings
 from common.core.deps import SessionDep, Trans
-from common.utils.embedding_threads import run_save_terminology_embeddings
+from common.utils.embedding_threads import run_save_terminology_embeddings, scan_id_pages
+from common.utils.utils import SQLBotLogUtil, batched, estimate_tokens
 
 
 def page_terminology(session: SessionDep, current_page: int = 1, page_size: int = 10, name: Optional[str] = None,
@@ -294,6 +297,7 @@ def create_terminology(session: SessionDep, info: TerminologyInfo, oid: int, tra
     session.bulk_save_objects(_list)
     session.flush()
     session.commit()
+    terminology_matcher.invalidate(oid)
 
     # embedding
     run_save_terminology_embeddings([result.id])
@@ -387,6 +391,7 @@ def update_terminology(session: SessionDep, info: TerminologyInfo, oid: int, tra
     session.bulk_save_objects(_list)
     session.flush()
     session.commit()
+    terminology_matcher.invalidate(oid)
 
     # embedding
     run_save_terminology_embeddings([info.id])
@@ -395,9 +400,12 @@ def update_terminology(session: SessionDep, info: TerminologyInfo, oid: int, tra
 
 
 def delete_terminology(session: SessionDep, ids: list[int]):
+    oids = session.execute(select(Terminology.oid).where(Terminology.id.in_(ids)).distinct()).scalars().all()
     stmt = delete(Terminology).where(or_(Terminology.id.in_(ids), Terminology.pid.in_(ids)))
     session.execute(stmt)
     session.commit()
+    for oid in oids:
+        terminology_matcher.invalidate(oid)
 
 
 # def run_save_embeddings(ids: List[int]):
@@ -416,12 +424,14 @@ def run_fill_empty_embeddings(session_maker):
         if not settings.EMBEDDING_ENABLED:
             return
         session = session_maker()
-        stmt1 = select(Terminology.id).where(and_(Terminology.embedding.is_(None), Terminology.pid.is_(None)))
-        stmt2 = select(Terminology.pid).where(
-            and_(Terminology.embedding.is_(None), Terminology.pid.isnot(None))).distinct()
-        combined_stmt = union(stmt1, stmt2)
-        results = session.execute(combined_stmt).scalars().all()
-        save_embeddings(session_maker, results)
+        total = 0
+        # parent id of every row without embedding; rows embedded meanwhile drop out, so a restart resumes
+        for ids in scan_id_pages(session, func.coalesce(Terminology.pid, Terminology.id),
+                                 Terminology.embedding.is_(None)):
+            # the scan itself is repeated on startup, no need to persist the ids as jobs
+            run_save_terminology_embeddings(ids, persist=False)
+            total += len(ids)
+        SQLBotLogUtil.info(f'terminology embedding backfill queued: {total}')
     except Exception:
         traceback.print_exc()
     finally:
@@ -435,23 +445,28 @@ def save_embeddings(session_maker, ids: List[int]):
     if not ids or len(ids) == 0:
         return
     try:
+        start_time = time.time()
+        total = 0
         session = session_maker()
-        _list = session.query(Terminology).filter(or_(Terminology.id.in_(ids), Terminology.pid.in_(ids))).all()
-
-        if not _list:
-            return
-
-        _words_list = [item.word for item in _list]
-
         model = EmbeddingModelCache.get_model()
 
-        results = model.embed_documents(_words_list)
+        for batch_ids in batched(list(ids), settings.EMBEDDING_BATCH_SIZE):
+            _list = session.query(Terminology.id, Terminology.word).filter(
+                or_(Terminology.id.in_(batch_ids), Terminology.pid.in_(batch_ids))).all()
+            if not _list:
+                continue
+
+            results = model.embed_documents([item.word for item in _list])
 
-        for index in range(len(results)):
-            item = results[index]
-            stmt = update(Terminology).where(and_(Terminology.id == _list[index].id)).values(embedding=item)
-            session.execute(stmt)
+            # bulk UPDATE by primary key, executed as one executemany per batch
+            session.execute(update(Terminology),
+                            [{'id': _list[index].id, 'embedding': results[index]} for index in range(len(results))])
             session.commit()
+            total += len(results)
+
+        cost = time.time() - start_time
+        SQLBotLogUtil.info(f'terminology embedding: {total} rows in {cost:.2f} seconds '
+                           f'({total / cost if cost > 0 else 0:.1f} rows/s)')
 
     except Exception as e:
         traceback.print_exc()
@@ -497,40 +512,10 @@ def select_terminology_by_word(session: SessionDep, word: str, oid: int, datasou
 
     _list: List[Terminology] = []
 
-    stmt = (
-        select(
-            Terminology.id,
-            Terminology.pid,
-            Terminology.word,
-        )
-        .where(
-            and_(text(":sentence ILIKE '%' || word || '%'"), Terminology.oid == oid)
-        )
-    )
-
-    if datasource is not None:
-        stmt = stmt.where(
-            or_(
-                or_(Terminology.specific_ds == False, Terminology.specific_ds.is_(None)),
-                and_(
-                    Terminology.specific_ds == True,
-                    Terminology.datasource_ids.isnot(None),
-                    text("datasource_ids @> jsonb_build_array(:datasource)")
-                )
-            )
-        )
-    else:
-        stmt = stmt.where(or_(Terminology.specific_ds == False, Terminology.specific_ds.is_(None)))
-
-    # 执行查询
-    params: dict[str, Any] = {'sentence': word}
-    if datasource is not None:
-        params['datasource'] = datasource
-
-    results = session.execute(stmt, params).fetchall()
-
-    for row in results:
-        _list.append(Terminology(id=row.id, word=row.word, pid=row.pid))
+    # all words (and synonyms) contained in the question, found in one pass over it
+    workspace = terminology_matcher.get(session, oid)
+    for entry in workspace.match(word, datasource):
+        _list.append(Terminology(id=entry.id, word=entry.word, pid=entry.pid))
 
     if settings.EMBEDDING_ENABLED:
         with session.begin_nested():
@@ -554,7 +539,6 @@ def select_terminology_by_word(session: SessionDep, word: str, oid: int, datasou
                 traceback.print_exc()
                 session.rollback()
 
-    _map: dict = {}
     _ids: list[int] = []
     for row in _list:
         if row.id in _ids or row.pid in _ids:
@@ -567,22 +551,22 @@ def select_terminology_by_word(session: SessionDep, word: str, oid: int, datasou
     if len(_ids) == 0:
         return []
 
-    # 按 pid 是否为 NULL 排序，确保父节点在前，这样可以优先获取 description
-    t_list = session.query(Terminology.id, Terminology.pid, Terminology.word, Terminology.description) \
-        .filter(or_(Terminology.id.in_(_ids), Terminology.pid.in_(_ids))) \
-        .order_by(Terminology.pid.is_(None).desc()).all()
-    for row in t_list:
-        pid = str(row.pid) if row.pid is not None else str(row.id)
-        if _map.get(pid) is None:
-            _map[pid] = {'words': [], 'description': row.description}
-        elif row.description is not None:
-            # 如果后续行（通常是父行）有描述，则更新它
-            _map[pid]['description'] = row.description
-        _map[pid]['words'].append(row.word)
-
-    _results: list[dict] = []
-    for key in _map.keys():
-        _results.append(_map.get(key))
+    # 父节点在前，description 取自父节点；向量结果可能比内存索引新，缺失的分组回落到数据库查询
+    _results: list[dict] = workspace.get_groups(_ids)
+    missing_ids = [_id for _id in _ids if _id not in workspace.groups]
+    if missing_ids:
+        _map: dict = {}
+        t_list = session.query(Terminology.id, Terminology.pid, Terminology.word, Terminology.description) \
+            .filter(or_(Terminology.id.in_(missing_ids), Terminology.pid.in_(missing_ids))) \
+            .order_by(Terminology.pid.is_(None).desc()).all()
+        for row in t_list:
+            pid = str(row.pid) if row.pid is not None else str(row.id)
+            if _map.get(pid) is None:
+                _map[pid] = {'words': [], 'description': row.description}
+            elif row.description is not None:
+                _map[pid]['description'] = row.description
+            _map[pid]['words'].append(row.word)
+        _results.extend(_map.values())
 
     return _results
 
@@ -628,13 +612,17 @@ def to_xml_string(_dict: list[dict] | dict, root: str = 'terminologies') -> str:
 
 
 def get_terminology_template(session: SessionDep, question: str, oid: Optional[int] = 1,
-                             datasource: Optional[int] = None) -> str:
+                             datasource: Optional[int] = None, token_budget: int = 0) -> str:
     if not oid:
         oid = 1
     _results = select_terminology_by_word(session, question, oid, datasource)
     if _results and len(_results) > 0:
         terminology = to_xml_string(_results)
         template = get_base_terminology_template().format(terminologies=terminology)
+        # matched words come before vector hits, drop from the end until the section fits
+        while token_budget and len(_results) > 1 and estimate_tokens(template) > token_budget:
+            _results = _results[:-1]
+            template = get_base_terminology_template().format(terminologies=to_xml_string(_results))
         return template
     else:
         return ''
@@ -1,5 +1,5 @@
 from pydantic import field_validator
-from sqlmodel import BigInteger, SQLModel, Field
+from sqlmodel import BigInteger, SQLModel, Field, String
 from typing import Optional
 
 from common.utils.snowflake import snowflake
@@ -16,4 +16,11 @@ class SnowflakeBase(SQLModel):
     class Config:
         json_encoders = {
             int: lambda v: str(v) if isinstance(v, int) and v > (2**53 - 1) else v
-        }
\ No newline at end of file
+        }
+
+
+class CacheVersion(SQLModel, table=True):
+    """Version stamps of in-process caches, shared by the processes of a deployment running without redis"""
+    __tablename__ = "sqlbot_cache_version"
+    name: str = Field(sa_type=String(255), primary_key=True)
+    version: int = Field(sa_type=BigInteger(), default=0, nullable=False)
@@ -1,4 +1,6 @@
 from fastapi_cache import FastAPICache
+import threading
+import time
 from functools import partial, wraps
 from typing import Optional, Any, Dict, Tuple
 from inspect import signature
@@ -7,6 +9,7 @@ from common.utils.utils import SQLBotLogUtil
 from fastapi_cache.backends.inmemory import InMemoryBackend
 
 from fastapi_cache.decorator import cache as original_cache
+from sqlalchemy import text
 
 def custom_key_builder(
     func: Any,
@@ -155,4 +158,92 @@ def is_cache_initialized() -> bool:
         return backend is not None
     except (AssertionError, AttributeError, Exception) as e:
         SQLBotLogUtil.debug(f"缓存初始化检查失败: {str(e)}")
-        return False
\ No newline at end of file
+        return False
+
+_sync_redis_client = None
+_sync_redis_lock = threading.Lock()
+_local_versions: Dict[str, int] = {}
+
+
+def get_sync_redis():
+    """Blocking redis client for code running in worker threads, None unless CACHE_TYPE is redis"""
+    global _sync_redis_client
+    if not settings.CACHE_TYPE or settings.CACHE_TYPE.lower() != "redis":
+        return None
+    if _sync_redis_client is None:
+        with _sync_redis_lock:
+            if _sync_redis_client is None:
+                import redis
+                _sync_redis_client = redis.Redis.from_url(settings.CACHE_REDIS_URL or "redis://localhost:6379/0")
+    return _sync_redis_client
+
+
+# name -> (monotonic time of the read, version) of the stamps kept in the database when redis is not used
+_shared_versions: Dict[str, Tuple[float, int]] = {}
+
+_bump_version_sql = text("""
+INSERT INTO sqlbot_cache_version (name, version) VALUES (:name, 1)
+ON CONFLICT (name) DO UPDATE SET version = sqlbot_cache_version.version + 1
+""")
+_get_version_sql = text("SELECT version FROM sqlbot_cache_version WHERE name = :name")
+
+
+def _uses_redis() -> bool:
+    return bool(settings.CACHE_TYPE) and settings.CACHE_TYPE.lower() == "redis"
+
+
+def bump_cache_version(name: str) -> None:
+    """
+    Mark in-process data derived from `name` as stale, in this process and in every other process of the deployment:
+    through redis when it is the cache, otherwise through the sqlbot_cache_version table
+    """
+    with _sync_redis_lock:
+        _local_versions[name] = _local_versions.get(name, 0) + 1
+        _shared_versions.pop(name, None)
+    try:
+        if _uses_redis():
+            get_sync_redis().incr(f"sqlbot-version:{name}")
+        else:
+            from common.core.db import engine
+            with engine.begin() as conn:
+                conn.execute(_bump_version_sql, {"name": name})
+    except Exception as e:
+        SQLBotLogUtil.warning(f"bump cache version {name} failed: {e}")
+
+
+def peek_cache_version(name: str) -> Optional[Tuple[int, int]]:
+    """The version when it is known without any I/O, None when get_cache_version has to ask redis or the database"""
+    if _uses_redis():
+        return None
+    shared = _shared_versions.get(name)
+    if shared is None or time.monotonic() - shared[0] >= settings.CACHE_VERSION_CHECK_INTERVAL:
+        return None
+    return _local_versions.get(name, 0), shared[1]
+
+
+def get_cache_version(name: str) -> Tuple[int, int]:
+    local_version = _local_versions.get(name, 0)
+    if _uses_redis():
+        remote_version = 0
+        try:
+            remote_version = int(get_sync_redis().get(f"sqlbot-version:{name}") or 0)
+        except Exception as e:
+            SQLBotLogUtil.warning(f"get cache version {name} failed: {e}")
+        return local_version, remote_version
+
+    # the database stamp is read at most once per CACHE_VERSION_CHECK_INTERVAL, which bounds how long another
+    # process (e.g. the mcp server next to the web app) can serve data changed elsewhere
+    now = time.monotonic()
+    shared = _shared_versions.get(name)
+    if shared is not None and now - shared[0] < settings.CACHE_VERSION_CHECK_INTERVAL:
+        return local_version, shared[1]
+    try:
+        from common.core.db import engine
+        with engine.connect() as conn:
+            remote_version = int(conn.execute(_get_version_sql, {"name": name}).scalar() or 0)
+    except Exception as e:
+        SQLBotLogUtil.warning(f"get cache version {name} failed: {e}")
+        # keep the last known stamp rather than invalidating on every failed read
+        remote_version = shared[1] if shared is not None else 0
+    _shared_versions[name] = (now, remote_version)
+    return local_version, remote_version
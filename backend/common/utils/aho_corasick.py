@@ -0,0 +1,63 @@
+from collections import deque
+from typing import Generic, Iterable, List, Set, Tuple, TypeVar
+
+T = TypeVar('T')
+
+
+class AhoCorasick(Generic[T]):
+    """
+    Multi-pattern substring matcher, finds every pattern contained in a text in a single pass over the text.
+    Matching is case-insensitive (str.lower on both sides, like ILIKE), each pattern carries an arbitrary value.
+    """
+
+    def __init__(self, patterns: Iterable[Tuple[str, T]]):
+        self._goto: List[dict] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[T]] = [[]]
+        for word, value in patterns:
+            self._add(word, value)
+        self._build()
+
+    def __len__(self):
+        return len(self._goto)
+
+    def _add(self, word: str, value: T):
+        if not word:
+            return
+        state = 0
+        for ch in word.lower():
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._goto[state][ch] = nxt
+            state = nxt
+        self._out[state].append(value)
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0) if self._goto[fail].get(ch) != nxt else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def search(self, text: str) -> Set[T]:
+        found: Set[T] = set()
+        if not text:
+            return found
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for ch in text.lower():
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
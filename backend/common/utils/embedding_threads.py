@@ -1,48 +1,343 @@
+import threading
+import time
+import traceback
 from concurrent.futures import ThreadPoolExecutor
-from typing import List
+from typing import Callable, Dict, List, Optional, Set
 
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlmodel import Session
 
-executor = ThreadPoolExecutor(max_workers=200)
-
+from common.core.config import settings
 from common.core.db import engine
+from common.utils.time import get_timestamp
+from common.utils.utils import SQLBotLogUtil, batched
 
 session_maker = scoped_session(sessionmaker(bind=engine))
 
-
-# session = session_maker()
+KIND_TERMINOLOGY = 'terminology'
+KIND_DATA_TRAINING = 'data_training'
+KIND_TABLE = 'table'
+KIND_DATASOURCE = 'datasource'
 
 
-def run_save_terminology_embeddings(ids: List[int]):
+def _terminology_handler(_session_maker, ids: List[int]):
     from apps.terminology.curd.terminology import save_embeddings
-    executor.submit(save_embeddings, session_maker, ids)
+    save_embeddings(_session_maker, ids)
+
+
+def _data_training_handler(_session_maker, ids: List[int]):
+    from apps.data_training.curd.data_training import save_embeddings
+    save_embeddings(_session_maker, ids)
+
+
+def _table_handler(_session_maker, ids: List[int]):
+    from apps.datasource.crud.table import save_table_embedding
+    save_table_embedding(_session_maker, ids)
+
+
+def _datasource_handler(_session_maker, ids: List[int]):
+    from apps.datasource.crud.table import save_ds_embedding
+    save_ds_embedding(_session_maker, ids)
+
+
+def scan_id_pages(session, id_expr, condition, page_size: int = settings.EMBEDDING_BACKFILL_PAGE_SIZE):
+    """Keyset scan over ids matching condition, so a backfill never loads the whole table at once"""
+    cursor = None
+    while True:
+        stmt = select(id_expr).where(condition)
+        if cursor is not None:
+            stmt = stmt.where(id_expr > cursor)
+        ids = session.execute(stmt.distinct().order_by(id_expr).limit(page_size)).scalars().all()
+        if not ids:
+            return
+        yield ids
+        cursor = ids[-1]
+
+
+class EmbeddingJobQueue:
+    """
+    Coalescing embedding job queue.
+
+    Pending ids are kept as one set per kind, so repeated submissions of the same id collapse into a single job.
+    At most one batch per kind runs at a time on a bounded pool, and pending ids are persisted in sys_embedding_job
+    so they survive a restart. A failed batch is retried with exponential backoff, if it still fails it is split in
+    halves that are retried on a delayed timer, so one bad id does not hold back the rest of its batch. A single id
+    is given up after EMBEDDING_JOB_MAX_RETRIES failed rounds, also across restarts, until it is submitted again.
+    """
+
+    def __init__(self, handlers: Dict[str, Callable[[scoped_session, List[int]], None]], max_workers: int,
+                 max_retries: int, retry_backoff: float):
+        self._handlers = handlers
+        self._max_retries = max(0, max_retries)
+        self._retry_backoff = retry_backoff
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='embedding-job')
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Set[int]] = {kind: set() for kind in handlers}
+        self._running: Dict[str, int] = {}
+        # split or single id batches whose retry delay has passed, they run before new pending ids
+        self._retry_batches: Dict[str, List[List[int]]] = {kind: [] for kind in handlers}
+        # failed rounds of single ids, mirrors sys_embedding_job.attempts
+        self._attempts: Dict[str, Dict[int, int]] = {kind: {} for kind in handlers}
+        self._stats: Dict[str, dict] = {kind: {'completed': 0, 'failed': 0, 'retries': 0, 'last_error': None,
+                                               'last_finish_time': None} for kind in handlers}
+
+    def submit(self, kind: str, ids: List[int], persist: bool = True):
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown embedding job kind: {kind}")
+        ids = [_id for _id in ids if _id is not None] if ids else []
+        if not ids:
+            return
+        if persist:
+            self._persist(kind, ids)
+        with self._lock:
+            # a new submission (the row was edited) gets a fresh set of attempts
+            for _id in ids:
+                self._attempts[kind].pop(_id, None)
+            self._pending[kind].update(ids)
+            self._dispatch()
+
+    def run_in_background(self, fn: Callable, *args):
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._log_background_error)
+        return future
+
+    def start(self):
+        """Load jobs persisted by a previous process and schedule them"""
+        try:
+            with Session(engine) as session:
+                from apps.system.models.system_model import EmbeddingJobModel
+                rows = session.execute(select(EmbeddingJobModel.kind, EmbeddingJobModel.target_id,
+                                              EmbeddingJobModel.attempts)).all()
+            restored = 0
+            skipped = 0
+            with self._lock:
+                for row in rows:
+                    if row.kind not in self._pending:
+                        continue
+                    if row.attempts >= self._give_up_attempts:
+                        skipped += 1
+                        continue
+                    if row.attempts:
+                        self._attempts[row.kind][row.target_id] = row.attempts
+                    self._pending[row.kind].add(row.target_id)
+                    restored += 1
+                self._dispatch()
+            if restored:
+                SQLBotLogUtil.info(f'restored {restored} pending embedding jobs')
+            if skipped:
+                SQLBotLogUtil.warning(f'skipped {skipped} embedding jobs that already failed '
+                                      f'{self._give_up_attempts} times')
+        except Exception:
+            traceback.print_exc()
+
+    def status(self) -> dict:
+        backlog: Dict[str, int] = {}
+        try:
+            with Session(engine) as session:
+                from apps.system.models.system_model import EmbeddingJobModel
+                rows = session.execute(
+                    select(EmbeddingJobModel.kind, func.count()).where(
+                        EmbeddingJobModel.attempts < self._give_up_attempts).group_by(EmbeddingJobModel.kind)).all()
+                backlog = {row[0]: row[1] for row in rows}
+        except Exception:
+            traceback.print_exc()
+
+        with self._lock:
+            kinds = {}
+            for kind in self._handlers:
+                kinds[kind] = {
+                    'pending': len(self._pending[kind]),
+                    'running': self._running.get(kind, 0),
+                    'backlog': backlog.get(kind, 0),
+                    **self._stats[kind],
+                }
+        current = all(item['pending'] == 0 and item['running'] == 0 and item['backlog'] == 0
+                      for item in kinds.values())
+        return {'current': current, 'kinds': kinds}
+
+    @property
+    def _give_up_attempts(self) -> int:
+        return max(1, self._max_retries)
+
+    def _dispatch(self):
+        # must be called with self._lock held
+        for kind, ids in self._pending.items():
+            if kind in self._running:
+                continue
+            if self._retry_batches[kind]:
+                job_ids = self._retry_batches[kind].pop(0)
+                self._running[kind] = len(job_ids)
+                self._executor.submit(self._run, kind, job_ids, True)
+            elif ids:
+                job_ids = list(ids)
+                ids.clear()
+                self._running[kind] = len(job_ids)
+                self._executor.submit(self._run, kind, job_ids)
+
+    def _schedule_retry(self, kind: str, ids: List[int], delay: float):
+        def _ready():
+            with self._lock:
+                self._retry_batches[kind].append(ids)
+                self._dispatch()
+
+        timer = threading.Timer(delay, _ready)
+        timer.daemon = True
+        timer.start()
+
+    def _run(self, kind: str, ids: List[int], is_retry: bool = False):
+        handler = self._handlers[kind]
+        error: Optional[Exception] = None
+        # a delayed retry runs once, its backoff already passed on the timer
+        rounds = 1 if is_retry else self._max_retries + 1
+        try:
+            for attempt in range(rounds):
+                try:
+                    handler(session_maker, ids)
+                    error = None
+                    break
+                except Exception as e:
+                    error = e
+                    with self._lock:
+                        self._stats[kind]['last_error'] = str(e)
+                        if attempt < rounds - 1:
+                            self._stats[kind]['retries'] += 1
+                    if attempt < rounds - 1:
+                        delay = self._retry_backoff * (2 ** attempt)
+                        SQLBotLogUtil.warning(
+                            f'{kind} embedding job for {len(ids)} ids failed (attempt {attempt + 1}), '
+                            f'retry in {delay:.1f} seconds: {e}')
+                        time.sleep(delay)
+
+            if error is None:
+                self._forget(kind, ids)
+                with self._lock:
+                    for _id in ids:
+                        self._attempts[kind].pop(_id, None)
+                    self._stats[kind]['completed'] += len(ids)
+                    self._stats[kind]['last_finish_time'] = get_timestamp()
+            else:
+                self._handle_failure(kind, ids, error)
+        finally:
+            with self._lock:
+                self._running.pop(kind, None)
+                self._dispatch()
+
+    def _handle_failure(self, kind: str, ids: List[int], error: Exception):
+        if len(ids) > 1:
+            # split to isolate the failing ids, the other half goes through on its next round
+            middle = len(ids) // 2
+            SQLBotLogUtil.warning(f'{kind} embedding job for {len(ids)} ids failed, retry in two halves: {error}')
+            self._schedule_retry(kind, ids[:middle], self._retry_backoff)
+            self._schedule_retry(kind, ids[middle:], self._retry_backoff)
+            return
+
+        _id = ids[0]
+        self._record_failure(kind, ids, str(error))
+        with self._lock:
+            attempts = self._attempts[kind].get(_id, 0) + 1
+            self._attempts[kind][_id] = attempts
+            if attempts >= self._give_up_attempts:
+                self._attempts[kind].pop(_id, None)
+                self._stats[kind]['failed'] += 1
+        if attempts >= self._give_up_attempts:
+            SQLBotLogUtil.error(f'{kind} embedding job for id {_id} failed {attempts} times, given up: {error}',
+                                exc_info=False)
+        else:
+            delay = self._retry_backoff * (2 ** attempts)
+            SQLBotLogUtil.warning(f'{kind} embedding job for id {_id} failed (round {attempts}), '
+                                  f'retry in {delay:.1f} seconds: {error}')
+            self._schedule_retry(kind, ids, delay)
+
+    def _persist(self, kind: str, ids: List[int]):
+        try:
+            from apps.system.models.system_model import EmbeddingJobModel
+            with Session(engine) as session:
+                now = get_timestamp()
+                for batch_ids in batched(list(set(ids)), settings.EMBEDDING_BATCH_SIZE):
+                    stmt = insert(EmbeddingJobModel).values(
+                        [{'kind': kind, 'target_id': _id, 'attempts': 0, 'create_time': now} for _id in batch_ids]
+                    )
+                    # a resubmitted id starts over, also when it had been given up
+                    stmt = stmt.on_conflict_do_update(index_elements=['kind', 'target_id'],
+                                                      set_={'attempts': 0, 'last_error': None})
+                    session.execute(stmt)
+                session.commit()
+        except Exception:
+            traceback.print_exc()
+
+    def _forget(self, kind: str, ids: List[int]):
+        with self._lock:
+            # ids re-submitted while this job was running must stay persisted
+            done_ids = [_id for _id in ids if _id not in self._pending[kind]]
+        try:
+            from apps.system.models.system_model import EmbeddingJobModel
+            with Session(engine) as session:
+                for batch_ids in batched(done_ids, settings.EMBEDDING_BATCH_SIZE):
+                    session.execute(delete(EmbeddingJobModel).where(EmbeddingJobModel.kind == kind,
+                                                                 EmbeddingJobModel.target_id.in_(batch_ids)))
+                session.commit()
+        except Exception:
+            traceback.print_exc()
+
+    def _record_failure(self, kind: str, ids: List[int], message: str):
+        try:
+            from apps.system.models.system_model import EmbeddingJobModel
+            with Session(engine) as session:
+                for batch_ids in batched(ids, settings.EMBEDDING_BATCH_SIZE):
+                    session.execute(update(EmbeddingJobModel).where(
+                        EmbeddingJobModel.kind == kind, EmbeddingJobModel.target_id.in_(batch_ids)).values(
+                        attempts=EmbeddingJobModel.attempts + 1, last_error=message))
+                session.commit()
+        except Exception:
+            traceback.print_exc()
+
+    @staticmethod
+    def _log_background_error(future):
+        if future.exception() is not None:
+            SQLBotLogUtil.error(f'embedding background task failed: {future.exception()}', exc_info=False)
+
+
+embedding_job_queue = EmbeddingJobQueue(handlers={
+    KIND_TERMINOLOGY: _terminology_handler,
+    KIND_DATA_TRAINING: _data_training_handler,
+    KIND_TABLE: _table_handler,
+    KIND_DATASOURCE: _datasource_handler,
+}, max_workers=settings.EMBEDDING_JOB_WORKERS, max_retries=settings.EMBEDDING_JOB_MAX_RETRIES,
+    retry_backoff=settings.EMBEDDING_JOB_RETRY_BACKOFF)
+
+
+def start_embedding_job_queue():
+    embedding_job_queue.start()
+
+
+def run_save_terminology_embeddings(ids: List[int], persist: bool = True):
+    embedding_job_queue.submit(KIND_TERMINOLOGY, ids, persist)
 
 
 def fill_empty_terminology_embeddings():
     from apps.terminology.curd.terminology import run_fill_empty_embeddings
-    executor.submit(run_fill_empty_embeddings, session_maker)
+    embedding_job_queue.run_in_background(run_fill_empty_embeddings, session_maker)
 
 
-def run_save_data_training_embeddings(ids: List[int]):
-    from apps.data_training.curd.data_training import save_embeddings
-    executor.submit(save_embeddings, session_maker, ids)
+def run_save_data_training_embeddings(ids: List[int], persist: bool = True):
+    embedding_job_queue.submit(KIND_DATA_TRAINING, ids, persist)
 
 
 def fill_empty_data_training_embeddings():
     from apps.data_training.curd.data_training import run_fill_empty_embeddings
-    executor.submit(run_fill_empty_embeddings, session_maker)
+    embedding_job_queue.run_in_background(run_fill_empty_embeddings, session_maker)
 
 
-def run_save_table_embeddings(ids: List[int]):
-    from apps.datasource.crud.table import save_table_embedding
-    executor.submit(save_table_embedding, session_maker, ids)
+def run_save_table_embeddings(ids: List[int], persist: bool = True):
+    embedding_job_queue.submit(KIND_TABLE, ids, persist)
 
 
-def run_save_ds_embeddings(ids: List[int]):
-    from apps.datasource.crud.table import save_ds_embedding
-    executor.submit(save_ds_embedding, session_maker, ids)
+def run_save_ds_embeddings(ids: List[int], persist: bool = True):
+    embedding_job_queue.submit(KIND_DATASOURCE, ids, persist)
 
 
 def fill_empty_table_and_ds_embeddings():
     from apps.datasource.crud.table import run_fill_empty_table_and_ds_embedding
-    executor.submit(run_fill_empty_table_and_ds_embedding, session_maker)
+    embedding_job_queue.run_in_background(run_fill_empty_table_and_ds_embedding, session_maker)
@@ -0,0 +1,67 @@
+from typing import Any, Dict
+
+import orjson
+
+
+class StreamingJsonObjectParser:
+    """
+    Incremental parser for the first top-level JSON object in streamed text.
+
+    Text before the object (e.g. a ```json fence) is skipped. Each top-level member is decoded as soon as the
+    ',' or '}' after it arrives and is put in `fields`, so the first members of a long answer can be used while the
+    rest is still streaming. Every character is scanned once.
+    """
+
+    def __init__(self):
+        self.fields: Dict[str, Any] = {}
+        self.done = False
+        self._text = ''
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._member_start = -1
+
+    def feed(self, chunk: str) -> Dict[str, Any]:
+        if self.done or not chunk:
+            return self.fields
+        self._text += chunk
+        text = self._text
+        for i in range(self._pos, len(text)):
+            char = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif self._depth == 0:
+                if char == '{':
+                    self._depth = 1
+                    self._member_start = i + 1
+            elif char == '"':
+                self._in_string = True
+            elif char in '{[':
+                self._depth += 1
+            elif char in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    self._add_member(text[self._member_start:i])
+                    self.done = True
+                    self._pos = i + 1
+                    return self.fields
+            elif char == ',' and self._depth == 1:
+                self._add_member(text[self._member_start:i])
+                self._member_start = i + 1
+        self._pos = len(text)
+        return self.fields
+
+    def _add_member(self, member: str):
+        if not member.strip():
+            return
+        try:
+            self.fields.update(orjson.loads('{' + member + '}'))
+        except orjson.JSONDecodeError:
+            # malformed member, the complete answer is still parsed as a whole when the stream ends
+            pass
@@ -0,0 +1,269 @@
+import bisect
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple
+
+from common.core.config import settings
+from common.utils.utils import SQLBotLogUtil
+
+try:
+    from opentelemetry import trace as _otel_trace
+except ImportError:
+    _otel_trace = None
+
+# seconds, from a cached lookup to a slow LLM answer
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[Any], extra: Tuple[str, str] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values, strict=True)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric(ABC):
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], Any] = {}
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def collect(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    @abstractmethod
+    def _samples(self, key: Tuple[str, ...], value: Any) -> List[str]:
+        pass
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self, key, value):
+        return [f'{self.name}_total{_format_labels(self.labelnames, key)} {_format_value(value)}']
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per bucket counts (not cumulative), count of values above the last bucket, sum
+                state = [[0] * len(self.buckets), 0, 0.0]
+                self._values[key] = state
+            if index < len(self.buckets):
+                state[0][index] += 1
+            else:
+                state[1] += 1
+            state[2] += value
+
+    def _samples(self, key, value):
+        counts, overflow, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts, strict=True):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        cumulative += overflow
+        lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, ("le", "+Inf"))} {cumulative}')
+        lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}')
+        lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}')
+        return lines
+
+
+class CallbackGauge(_Metric):
+    """Gauge read when metrics are collected, fn returns the value or a {label values: value} dict"""
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, fn: Callable[[], Any], labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.fn = fn
+
+    def collect(self) -> List[str]:
+        try:
+            value = self.fn()
+        except Exception as e:
+            SQLBotLogUtil.warning(f'collect gauge {self.name} failed: {e}')
+            return []
+        values = value if isinstance(value, dict) else {(): value}
+        with self._lock:
+            self._values = dict(values)
+        return super().collect()
+
+    def _samples(self, key, value):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}']
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric {metric.name} already registered')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """All metrics in the prometheus text exposition format (version 0.0.4)"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram('sqlbot_chat_stage_seconds', 'Wall time of one chat pipeline stage',
+                                            ['stage']))
+EMBEDDING_SECONDS = REGISTRY.register(Histogram('sqlbot_embedding_seconds', 'Time to embed a query or documents',
+                                                ['kind']))
+LLM_TTFT_SECONDS = REGISTRY.register(Histogram('sqlbot_llm_ttft_seconds', 'Time to the first streamed LLM token',
+                                               ['operation', 'model']))
+LLM_SECONDS = REGISTRY.register(Histogram('sqlbot_llm_seconds', 'Total time of one LLM call',
+                                          ['operation', 'model']))
+LLM_TOKENS_PER_SECOND = REGISTRY.register(Histogram('sqlbot_llm_tokens_per_second',
+                                                    'Output tokens per second after the first token',
+                                                    ['operation', 'model'],
+                                                    buckets=(1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)))
+LLM_TOKENS = REGISTRY.register(Counter('sqlbot_llm_tokens', 'LLM tokens used', ['operation', 'model', 'kind']))
+LLM_HEDGES = REGISTRY.register(Counter('sqlbot_llm_hedges', 'Hedged or failed-over LLM requests by winner',
+                                       ['operation', 'reason', 'winner']))
+SQL_EXECUTION_SECONDS = REGISTRY.register(Histogram('sqlbot_sql_execution_seconds',
+                                                    'Time to execute the generated SQL by datasource type',
+                                                    ['ds_type']))
+SSE_BYTES = REGISTRY.register(Counter('sqlbot_sse_bytes', 'Bytes written to chat event streams'))
+SSE_WRITES = REGISTRY.register(Counter('sqlbot_sse_writes', 'Writes to chat event streams'))
+
+
+_tracer = None
+
+
+def init_tracing():
+    """OpenTelemetry spans of the chat stages, exported over OTLP when OTEL_ENABLED and the sdk is installed"""
+    global _tracer
+    if not settings.OTEL_ENABLED or _tracer is not None:
+        return
+    if _otel_trace is None:
+        SQLBotLogUtil.warning('OTEL_ENABLED is set but opentelemetry is not installed, tracing disabled')
+        return
+    try:
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+        # the exporter endpoint and headers come from the standard OTEL_EXPORTER_OTLP_* variables
+        provider = TracerProvider(resource=Resource.create({'service.name': settings.OTEL_SERVICE_NAME}))
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        _otel_trace.set_tracer_provider(provider)
+    except ImportError:
+        SQLBotLogUtil.warning('opentelemetry sdk or otlp exporter not installed, spans go to the global provider')
+    _tracer = _otel_trace.get_tracer('sqlbot')
+
+
+@contextmanager
+def trace_stage(stage: str, **attributes):
+    """Times one stage of the chat pipeline into sqlbot_chat_stage_seconds and an OpenTelemetry span if enabled"""
+    start = time.perf_counter()
+    if _tracer is None:
+        try:
+            yield
+        finally:
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+        return
+    with _tracer.start_as_current_span(f'sqlbot.{stage}', attributes=attributes):
+        try:
+            yield
+        finally:
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+class StageTimer:
+    """
+    Explicitly finished variant of trace_stage, for stages spanning yields of a generator where a current span
+    can not be kept
+    """
+
+    def __init__(self, stage: str, **attributes):
+        self.stage = stage
+        self.start = time.perf_counter()
+        self.span = _tracer.start_span(f'sqlbot.{stage}', attributes=attributes) if _tracer is not None else None
+
+    def finish(self) -> float:
+        cost = time.perf_counter() - self.start
+        STAGE_SECONDS.observe(cost, stage=self.stage)
+        if self.span is not None:
+            self.span.end()
+            self.span = None
+        return cost
+
+
+async def observe_llm_stream(operation: Any, model: str, stream: AsyncIterator[Dict[str, str]],
+                             token_usage: Dict[str, Any]) -> AsyncIterator[Dict[str, str]]:
+    """Records the first token time, total time and output rate of one processed LLM stream"""
+    name = str(getattr(operation, 'name', operation))
+    start = time.perf_counter()
+    first_at: Optional[float] = None
+    span = _tracer.start_span(f'sqlbot.llm.{name}', attributes={'model': model}) if _tracer is not None else None
+    try:
+        async for chunk in stream:
+            if first_at is None and (chunk.get('content') or chunk.get('reasoning_content')):
+                first_at = time.perf_counter()
+                LLM_TTFT_SECONDS.observe(first_at - start, operation=name, model=model)
+            yield chunk
+    finally:
+        if span is not None:
+            span.end()
+    end = time.perf_counter()
+    LLM_SECONDS.observe(end - start, operation=name, model=model)
+    output_tokens = token_usage.get('output_tokens') or 0
+    if output_tokens:
+        LLM_TOKENS.inc(output_tokens, operation=name, model=model, kind='output')
+        if first_at is not None and end > first_at:
+            LLM_TOKENS_PER_SECOND.observe(output_tokens / (end - first_at), operation=name, model=model)
+    if token_usage.get('input_tokens'):
+        LLM_TOKENS.inc(token_usage.get('input_tokens'), operation=name, model=model, kind='input')
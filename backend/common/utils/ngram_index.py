@@ -0,0 +1,75 @@
+from collections import Counter
+from typing import Dict, List, Set, Tuple
+
+
+def normalize_text(text: str) -> str:
+    return ''.join(text.lower().split()) if text else ''
+
+
+def char_ngrams(text: str, n: int = 2) -> Set[str]:
+    """Character n-grams of the normalized text, bigrams work for CJK text where word-based trigrams do not"""
+    text = normalize_text(text)
+    if len(text) < n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class NGramIndex:
+    """
+    In-process character n-gram inverted index.
+
+    Documents are scored by the Dice coefficient of their n-gram sets, a document containing the query or contained
+    in it scores 1.0, which keeps the hits of a bidirectional substring match on top.
+    """
+
+    def __init__(self, n: int = 2):
+        self.n = n
+        self._postings: Dict[str, List[int]] = {}
+        self._sizes: Dict[int, int] = {}
+        self._texts: Dict[int, str] = {}
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def add(self, doc_id: int, text: str):
+        grams = char_ngrams(text, self.n)
+        if not grams:
+            return
+        for gram in grams:
+            self._postings.setdefault(gram, []).append(doc_id)
+        self._sizes[doc_id] = len(grams)
+        self._texts[doc_id] = normalize_text(text)
+
+    def search(self, query: str, limit: int = 10, min_score: float = 0.0) -> List[Tuple[int, float]]:
+        grams = char_ngrams(query, self.n)
+        if not grams:
+            return []
+        query_text = normalize_text(query)
+        counts: Counter = Counter()
+        for gram in grams:
+            postings = self._postings.get(gram)
+            if postings:
+                counts.update(postings)
+
+        scored: List[Tuple[int, float]] = []
+        for doc_id, common in counts.items():
+            size = self._sizes[doc_id]
+            score = 2.0 * common / (len(grams) + size)
+            # every n-gram of the shorter side is shared, check for real containment
+            if common == min(size, len(grams)):
+                doc_text = self._texts[doc_id]
+                if doc_text in query_text or query_text in doc_text:
+                    score = 1.0
+            if score >= min_score:
+                scored.append((doc_id, score))
+        scored.sort(key=lambda item: (-item[1], item[0]))
+        return scored[:limit]
+
+
+def reciprocal_rank_fusion(*rankings: List[int], k: int = 60) -> List[int]:
+    """Merge ranked id lists into one ranking, ids found by several retrievers move up"""
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, _id in enumerate(ranking):
+            scores[_id] = scores.get(_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda _id: -scores[_id])
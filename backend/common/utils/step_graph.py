@@ -0,0 +1,64 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, Tuple
+
+from common.utils.metrics import trace_stage
+
+
+class StepGraph:
+    """
+    Small async dependency graph.
+
+    Every step is a zero-argument callable returning an awaitable, it starts as soon as the steps it depends on are
+    done, so independent steps run concurrently. The wall time of each step is kept in `timings` and recorded as a
+    stage metric.
+    """
+
+    def __init__(self, name: str = ''):
+        self.name = name
+        self._steps: Dict[str, Tuple[Callable[[], Awaitable[Any]], Tuple[str, ...]]] = {}
+        self.timings: Dict[str, float] = {}
+
+    def __len__(self):
+        return len(self._steps)
+
+    def __contains__(self, name: str):
+        return name in self._steps
+
+    def add(self, name: str, fn: Callable[[], Awaitable[Any]], depends_on: Iterable[str] = ()):
+        depends_on = tuple(depends_on)
+        if name in self._steps:
+            raise ValueError(f'Step {name} already exists')
+        for dep in depends_on:
+            if dep not in self._steps:
+                raise ValueError(f'Step {name} depends on unknown step {dep}')
+        self._steps[name] = (fn, depends_on)
+
+    async def run(self) -> Dict[str, Any]:
+        """Run every step, returns step name -> result. The first failing step cancels the others and is raised"""
+        tasks: Dict[str, asyncio.Future] = {}
+
+        async def _run_step(name: str):
+            fn, depends_on = self._steps[name]
+            if depends_on:
+                await asyncio.gather(*(tasks[dep] for dep in depends_on))
+            start = time.perf_counter()
+            try:
+                with trace_stage(name, graph=self.name):
+                    return await fn()
+            finally:
+                self.timings[name] = time.perf_counter() - start
+
+        for step_name in self._steps:
+            tasks[step_name] = asyncio.ensure_future(_run_step(step_name))
+        try:
+            results = await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        return dict(zip(tasks.keys(), results, strict=True))
+
+    def format_timings(self) -> str:
+        return ', '.join(f'{name}: {cost:.2f}s' for name, cost in self.timings.items())
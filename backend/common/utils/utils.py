@@ -55,7 +55,6 @@ def deepcopy_ignore_extra(src, dest):
 def extract_nested_json(text):
     stack = []
     start_index = -1
-    results = []
 
     for i, char in enumerate(text):
         if char in '{[':
@@ -69,13 +68,11 @@ def extract_nested_json(text):
                     json_str = text[start_index:i + 1]
                     try:
                         orjson.loads(json_str)  # 验证有效性
-                        results.append(json_str)
+                        return json_str  # 只取第一个有效的JSON，不再校验后续候选
                     except:
                         pass
             else:
                 stack = []  # 括号不匹配则重置
-    if len(results) > 0 and results[0]:
-        return results[0]
     return None
 
 def string_to_numeric_hash(text: str, bits: Optional[int] = 64) -> int:
@@ -85,6 +82,33 @@ def string_to_numeric_hash(text: str, bits: Optional[int] = 64) -> int:
     return hash_num % max_bigint
 
 
+def batched(items: list, size: int):
+    size = max(1, size)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count without a tokenizer: one per CJK character, one per four other characters"""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Longest prefix of text whose estimate_tokens stays within max_tokens"""
+    if not text or estimate_tokens(text) <= max_tokens:
+        return text
+    cjk = 0
+    for index, ch in enumerate(text):
+        if ord(ch) >= 0x2E80:
+            cjk += 1
+        if cjk + (index + 1 - cjk + 3) // 4 > max_tokens:
+            return text[:index]
+    return text
+
+
 def setup_logging():
     # 确保日志目录存在
     log_dir = Path(settings.LOG_DIR)
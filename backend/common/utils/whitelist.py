@@ -8,6 +8,8 @@ wlist = [
     "/erdp-sqlbot",
     "/erdp-sqlbot/",
     "/docs",
+    "/health/*",
+    "/metrics",
     "/login/*",
     "*.json",
     "*.ico",
@@ -1,5 +1,6 @@
 import asyncio
 import os
+import time
 
 import sqlbot_xpack
 from alembic.config import Config
@@ -9,26 +10,40 @@ from fastapi.openapi.utils import get_openapi
 from fastapi.routing import APIRoute
 from fastapi.staticfiles import StaticFiles
 from fastapi_mcp import FastApiMCP
+from sqlalchemy import text
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from starlette.middleware.cors import CORSMiddleware
 
 from alembic import command
 from apps.ai_model.embedding import EmbeddingModelCache
+from apps.ai_model.http_client import close_http_clients
 from apps.api import api_router
-from common.utils.embedding_threads import fill_empty_table_and_ds_embeddings
+from apps.system.api import health, metrics
+from common.utils.embedding_threads import fill_empty_table_and_ds_embeddings, start_embedding_job_queue
 from apps.system.crud.aimodel_manage import async_model_info
 from apps.system.crud.assistant import init_dynamic_cors
 from apps.system.middleware.auth import TokenMiddleware
 from common.core.config import settings
+from common.core.db import engine
 from common.core.response_middleware import ResponseMiddleware, exception_handler
 from common.core.sqlbot_cache import init_sqlbot_cache
 from common.utils.embedding_threads import fill_empty_terminology_embeddings, fill_empty_data_training_embeddings
+from common.utils.metrics import init_tracing
 from common.utils.utils import SQLBotLogUtil
 
 
 def run_migrations():
-    alembic_cfg = Config("alembic.ini")
-    command.upgrade(alembic_cfg, "head")
+    if not settings.MIGRATION_ON_STARTUP:
+        SQLBotLogUtil.info("跳过启动时数据库迁移 (MIGRATION_ON_STARTUP=False)")
+        return
+    # only one worker migrates, the others wait on the lock and find the schema already at head
+    with engine.connect() as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": settings.MIGRATION_LOCK_KEY})
+        try:
+            alembic_cfg = Config("alembic.ini")
+            command.upgrade(alembic_cfg, "head")
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": settings.MIGRATION_LOCK_KEY})
 
 
 def init_terminology_embedding_data():
@@ -43,19 +58,44 @@ def init_table_and_ds_embedding():
     fill_empty_table_and_ds_embeddings()
 
 
+def warmup_embedding_model():
+    if not settings.EMBEDDING_ENABLED and not settings.TABLE_EMBEDDING_ENABLED:
+        return
+    try:
+        start_time = time.time()
+        EmbeddingModelCache.get_model()
+        SQLBotLogUtil.info(f"✅ Embedding 模型加载完成, 耗时 {time.time() - start_time:.2f} seconds")
+    except Exception:
+        SQLBotLogUtil.exception("Embedding 模型加载失败")
+
+
+background_tasks: set[asyncio.Task] = set()
+
+
+def run_in_background(func):
+    task = asyncio.create_task(asyncio.to_thread(func))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    run_migrations()
+    await asyncio.to_thread(run_migrations)
     init_sqlbot_cache()
+    init_tracing()
     init_dynamic_cors(app)
-    init_terminology_embedding_data()
-    init_data_training_embedding_data()
-    init_table_and_ds_embedding()
-    await asyncio.to_thread(EmbeddingModelCache.get_model)
+    # model warmup and embedding backfill never block serving, see /health/ready
+    run_in_background(warmup_embedding_model)
+    start_embedding_job_queue()
+    if settings.EMBEDDING_BACKFILL_ON_STARTUP:
+        init_terminology_embedding_data()
+        init_data_training_embedding_data()
+        init_table_and_ds_embedding()
     SQLBotLogUtil.info("✅ SQLBot 初始化完成")
     await sqlbot_xpack.core.clean_xpack_cache()
     await async_model_info()  # 异步加密已有模型的密钥和地址
     yield
+    await close_http_clients()
     SQLBotLogUtil.info("SQLBot 应用关闭")
 
 
@@ -101,6 +141,8 @@ if settings.all_cors_origins:
 app.add_middleware(TokenMiddleware)
 app.add_middleware(ResponseMiddleware)
 app.include_router(api_router, prefix=settings.API_V1_STR)
+app.include_router(health.router)
+app.include_router(metrics.router)
 
 # Register exception handlers
 app.add_exception_handler(StarletteHTTPException, exception_handler.http_exception_handler)